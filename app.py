@@ -1,78 +1,471 @@
-from fastapi import FastAPI, Form
+from fastapi import FastAPI, Form, Header, HTTPException
 from fastapi.responses import PlainTextResponse
-import psycopg2
-from urllib.parse import urlparse
+from psycopg_pool import AsyncConnectionPool
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from functools import partial
+from bisect import bisect_left
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
 import os
+import re
+import sys
+import json
+import queue
+import logging
+import time
+import hashlib
+import hmac
+import string
+import random
 import httpx
 import asyncio
-import africastalking
+import threading
+from docindex import IndexWatcher
+import smstext
+import cohort
 
 app = FastAPI()
 
 AT_USERNAME = os.getenv("AT_USERNAME")
 AT_API_KEY  = os.getenv("AT_API_KEY")
-africastalking.initialize(username=AT_USERNAME, api_key=AT_API_KEY)
-sms_service  = africastalking.SMS
 SENDER_ID    = os.getenv("AT_SENDER_ID", "98449")
+SMS_WORKERS  = int(os.getenv("SMS_WORKERS", "8"))
+SMS_BATCH_WINDOW = float(os.getenv("SMS_BATCH_WINDOW", "0.25"))   # seconds; 0 disables coalescing
+SMS_BATCH_HOT    = float(os.getenv("SMS_BATCH_HOT", "5"))          # seconds a sent body stays worth batching
+SMS_BATCH_MAX    = int(os.getenv("SMS_BATCH_MAX", "100"))          # recipients per API call
+SMS_RATE         = float(os.getenv("SMS_RATE", "10"))              # API calls per second
+SMS_BURST        = int(os.getenv("SMS_BURST", "20"))
+SMS_FAKE_LATENCY = os.getenv("SMS_FAKE_LATENCY", "")               # set to use FakeSMSGateway
+SMS_PART_SEGMENTS = int(os.getenv("SMS_PART_SEGMENTS", "3"))       # segments per numbered part
+SMS_GSM7_LANGS   = set(filter(None, os.getenv("SMS_GSM7_LANGS", "").split(",")))   # opt in, e.g. "en,sw"
 GEMINI_KEY   = os.getenv("GEMINI_API_KEY", "")
+GEMINI_URL   = os.getenv("GEMINI_URL", "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-001:generateContent")
+GEMINI_STREAM_URL = GEMINI_URL.replace(":generateContent", ":streamGenerateContent")
+GEMINI_STREAM = os.getenv("GEMINI_STREAM", "1") == "1"
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "50"))
+GEMINI_RETRIES = int(os.getenv("GEMINI_RETRIES", "2"))
+LLM_CACHE_SIZE   = int(os.getenv("LLM_CACHE_SIZE", "2000"))
+LLM_CACHE_TTL    = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_WARMUP = os.getenv("LLM_CACHE_WARMUP", "")   # "", "topics" or "all"
+JOB_WORKERS      = int(os.getenv("JOB_WORKERS", "8"))
+JOB_QUEUE_SIZE   = int(os.getenv("JOB_QUEUE_SIZE", "1000"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_SWEEP_INTERVAL = float(os.getenv("JOB_SWEEP_INTERVAL", "5"))
+JOB_STALE_AFTER  = float(os.getenv("JOB_STALE_AFTER", "300"))
+DOC_INDEX_DIR = os.getenv("DOC_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "index"))
+DOC_TOP_K     = int(os.getenv("DOC_TOP_K", "4"))
+DOC_INDEX_CHECK = float(os.getenv("DOC_INDEX_CHECK", "30"))   # seconds between CURRENT checks
+PROMPT_BUDGET_ASK = int(os.getenv("PROMPT_BUDGET_ASK", "2000"))   # est. prompt tokens per call site
+PROMPT_BUDGET_RAG = int(os.getenv("PROMPT_BUDGET_RAG", "3500"))
+HISTORY_KEEP_RAW  = int(os.getenv("HISTORY_KEEP_RAW", "3"))     # newest exchanges (2 rows each) never folded into the summary
+HISTORY_SUMMARISE_AT = int(os.getenv("HISTORY_SUMMARISE_AT", "12"))   # unsummarised rows that trigger a fold
+CHAT_PARTITIONED    = os.getenv("CHAT_HISTORY_PARTITIONED", "") == "1"   # new installs only
+CHAT_RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", "180"))
+CHAT_KEEP_TURNS     = int(os.getenv("CHAT_KEEP_TURNS", "40"))             # exchanges per phone; 0 keeps all
+CHAT_RETENTION_INTERVAL = float(os.getenv("CHAT_RETENTION_INTERVAL", "3600"))
+CHAT_RETENTION_BATCH    = int(os.getenv("CHAT_RETENTION_BATCH", "5000"))   # rows per DELETE, each its own commit
 DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN  = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX  = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT  = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+STUDENT_CACHE_SIZE = int(os.getenv("STUDENT_CACHE_SIZE", "50000"))
+STUDENT_CACHE_TTL  = float(os.getenv("STUDENT_CACHE_TTL", "900"))
+STUDENT_CACHE_URL  = os.getenv("STUDENT_CACHE_URL", "")
+WEB_WORKERS        = int(os.getenv("WEB_CONCURRENCY", "1"))   # uvicorn/gunicorn --workers default
+ADMIN_TOKEN     = os.getenv("ADMIN_TOKEN", "")                # /admin/* is disabled while unset
+USSD_SCREEN_MAX = int(os.getenv("USSD_SCREEN_MAX", "182"))    # UTF-8 bytes incl. "CON "/"END "
+USSD_SESSION_TTL = float(os.getenv("USSD_SESSION_TTL", "300"))  # gateway sessions end well before this
+REQUEST_IDS     = os.getenv("REQUEST_IDS", "") == "1"         # tag logs and jobs with a per-request id
+INBOUND_DEDUPE_WINDOW = float(os.getenv("INBOUND_DEDUPE_WINDOW", "60"))  # seconds; 0 disables de-duplication
+INBOUND_RATE      = float(os.getenv("INBOUND_RATE", "0.5"))     # sustained posts/second per phone; 0 disables
+INBOUND_BURST     = int(os.getenv("INBOUND_BURST", "15"))       # a whole assessment answered back to back
+INBOUND_TRACK_MAX = int(os.getenv("INBOUND_TRACK_MAX", "100000"))   # keys/phones held in memory
+INBOUND_GUARD_URL = os.getenv("INBOUND_GUARD_URL", "")          # optional redis shared by all workers
+LOG_LEVEL      = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS     = os.getenv("LOG_LEVELS", "")        # per category, e.g. "gemini=DEBUG,cache=WARNING"
+LOG_SAMPLE     = os.getenv("LOG_SAMPLE", "")        # share of sub-WARNING lines kept, e.g. "sms=0.1,ussd=0.1"
+LOG_FORMAT     = os.getenv("LOG_FORMAT", "json")    # "json" or "text"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))   # records beyond this are dropped, not waited on
 
 @app.get("/")
 def root():
-    return {"status": "EduTena API is running", "endpoints": {"sms": "/sms", "ussd": "/ussd"}}
+    return {"status": "EduTena API is running", "endpoints": {"sms": "/sms", "ussd": "/ussd", "metrics": "/metrics"}}
 
 # =============================================================
-#  DATABASE
+#  METRICS
+#  Each webhook opens a RequestContext (channel, state, optional
+#  request id) in a contextvar; asyncio copies it into every task
+#  the request starts. `with stage("db_read"):` times one step of
+#  the hot path and files it under that context. Stages that end
+#  before the state is known are held on the context and filed
+#  when the request ends. Jobs carry the request id in their
+#  payload, so a background answer can be tied to its webhook.
+#  Everything is exported on /metrics in Prometheus text format.
 # =============================================================
 
-def get_connection():
-    url = urlparse(DATABASE_URL)
-    return psycopg2.connect(database=url.path[1:], user=url.username,
-                            password=url.password, host=url.hostname, port=url.port)
+class LatencyHistogram:
+    """Bucketed latency per label tuple; buckets are made cumulative on export."""
+
+    BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.series: dict[tuple, list] = {}     # key -> [bucket counts..., +Inf bucket, count, sum]
+
+    def observe(self, key: tuple, seconds: float):
+        row = self.series.get(key)
+        if row is None: row = self.series[key] = [0] * (len(self.bounds) + 3)
+        row[bisect_left(self.bounds, seconds)] += 1
+        row[-2] += 1; row[-1] += seconds
+
+    def cumulative(self, row) -> list:
+        out, n = [], 0
+        for c in row[:len(self.bounds) + 1]: n += c; out.append(n)
+        return out
+
+    def prometheus(self, name: str, help: str, labels: tuple) -> list[str]:
+        lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+        for key, row in sorted(self.series.items()):
+            tags = ",".join(f'{k}="{v}"' for k, v in zip(labels, key))
+            for le, n in zip((*self.bounds, "+Inf"), self.cumulative(row)):
+                lines.append(f'{name}_bucket{{{tags},le="{le}"}} {n}')
+            lines.append(f"{name}_count{{{tags}}} {row[-2]}")
+            lines.append(f"{name}_sum{{{tags}}} {row[-1]:.6f}")
+        return lines
+
+request_latency = LatencyHistogram()     # (channel, state)
+stage_latency   = LatencyHistogram()     # (stage, channel, state)
+
+
+class RequestContext:
+    __slots__ = ("channel", "state", "rid", "pending")
+
+    def __init__(self, channel, state="-", rid=None, pending=None):
+        self.channel = channel; self.state = state; self.rid = rid
+        self.pending = pending                  # list while the state may still change, else None
+
+_request_ctx: ContextVar[RequestContext] = ContextVar("request_ctx", default=RequestContext("background"))
+
+def begin_request(channel) -> RequestContext:
+    ctx = RequestContext(channel, rid=os.urandom(6).hex() if REQUEST_IDS else None, pending=[])
+    _request_ctx.set(ctx); return ctx
+
+def end_request(ctx: RequestContext, seconds: float):
+    request_latency.observe((ctx.channel, ctx.state), seconds)
+    pending, ctx.pending = ctx.pending, None
+    for name, dt in pending or (): stage_latency.observe((name, ctx.channel, ctx.state), dt)
+
+def request_id() -> str | None:
+    return _request_ctx.get().rid
+
+
+class stage:
+    """with stage("gemini"): ... — adds the block's wall time to stage_latency."""
+
+    __slots__ = ("name", "t0")
+
+    def __init__(self, name): self.name = name
+
+    def __enter__(self): self.t0 = time.perf_counter(); return self
+
+    def __exit__(self, *exc):
+        dt = time.perf_counter() - self.t0
+        ctx = _request_ctx.get()
+        if ctx.pending is not None: ctx.pending.append((self.name, dt))
+        else: stage_latency.observe((self.name, ctx.channel, ctx.state), dt)
+
+def sql_stage(sql: str) -> str:
+    return "db_read" if sql.lstrip()[:6].upper() == "SELECT" else "db_write"
+
+def instrumentation_overhead(n: int = 20000) -> float:
+    """Seconds one stage() block adds, measured against an empty loop."""
+    ctx = RequestContext("bench", pending=None)
+    token = _request_ctx.set(ctx)
+    try:
+        t0 = time.perf_counter()
+        for _ in range(n): pass
+        base = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for _ in range(n):
+            with stage("bench"): pass
+        timed = time.perf_counter() - t0
+    finally:
+        _request_ctx.reset(token); stage_latency.series.pop(("bench", "bench", "-"), None)
+    return max(0.0, timed - base) / n
+
+
+# =============================================================
+#  LOGGING
+#  On the event loop a log call only checks the level, samples,
+#  stamps the request context and puts the record on a bounded
+#  queue; a listener thread formats it (JSON lines by default)
+#  and writes stdout. Each category is a child of the "edutena"
+#  logger with its own level. Warnings and errors are never
+#  sampled. Phone numbers are masked in the formatter, so call
+#  sites pass them unmasked.
+# =============================================================
+
+PHONE_RE   = re.compile(r"\+?\d{10,15}")
+LOG_FIELDS = ("rid", "channel", "state", "phone", "session", "label", "job", "kind")
+log_metrics = {"dropped": 0, "sampled_out": 0}
+
+def mask_phones(text: str) -> str:
+    return PHONE_RE.sub(lambda m: m.group()[:7] + "****", text)
 
-def init_db():
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS students (
+def _pairs(spec: str) -> dict:
+    return dict(p.strip().split("=", 1) for p in spec.split(",") if "=" in p)
+
+
+class LogContextFilter(logging.Filter):
+    """Caller-side: drops sampled-out records, then copies the request context onto the rest."""
+
+    def __init__(self, rates: dict):
+        super().__init__(); self.rates = rates
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            rate = self.rates.get(record.name)
+            if rate is not None and random.random() >= rate: log_metrics["sampled_out"] += 1; return False
+        ctx = _request_ctx.get()
+        if not hasattr(record, "rid"): record.rid = ctx.rid
+        if not hasattr(record, "channel"): record.channel = ctx.channel; record.state = ctx.state
+        return True
+
+
+class LogQueueHandler(QueueHandler):
+    """Hands records over untouched (formatting happens on the listener thread) and never blocks."""
+
+    def prepare(self, record): return record
+
+    def enqueue(self, record):
+        try: self.queue.put_nowait(record)
+        except queue.Full: log_metrics["dropped"] += 1
+
+
+class LogFormatter(logging.Formatter):
+    """One line per record: JSON, or "<time> LEVEL [category] message key=value ..."."""
+
+    def __init__(self, as_json: bool):
+        super().__init__(); self.as_json = as_json
+
+    def format(self, record):
+        out = {"ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+               "level": record.levelname, "cat": record.name.removeprefix("edutena."),
+               "msg": mask_phones(record.getMessage())}
+        for k in LOG_FIELDS:
+            v = getattr(record, k, None)
+            if v in (None, "", "-", "background"): continue
+            out[k] = mask_phones(v) if isinstance(v, str) and k != "rid" else v
+        if record.exc_info: out["exc"] = self.formatException(record.exc_info)
+        if self.as_json: return json.dumps(out, ensure_ascii=False, default=str)
+        ts, level, cat, msg = out.pop("ts"), out.pop("level"), out.pop("cat"), out.pop("msg")
+        exc = out.pop("exc", "")
+        return " ".join([ts, level, f"[{cat}]", msg, *(f"{k}={v}" for k, v in out.items())]) + (f"\n{exc}" if exc else "")
+
+
+def configure_logging() -> QueueListener:
+    root = logging.getLogger("edutena")
+    root.setLevel(LOG_LEVEL.upper()); root.propagate = False
+    for cat, level in _pairs(LOG_LEVELS).items(): logging.getLogger(f"edutena.{cat}").setLevel(level.upper())
+    q = queue.Queue(LOG_QUEUE_SIZE)
+    handler = LogQueueHandler(q)
+    handler.addFilter(LogContextFilter({f"edutena.{cat}": float(r) for cat, r in _pairs(LOG_SAMPLE).items()}))
+    root.handlers[:] = [handler]
+    out = logging.StreamHandler(sys.stdout); out.setFormatter(LogFormatter(LOG_FORMAT == "json"))
+    listener = QueueListener(q, out); listener.start()
+    return listener
+
+log_listener = configure_logging()
+log_db     = logging.getLogger("edutena.db")
+log_gemini = logging.getLogger("edutena.gemini")
+log_cache  = logging.getLogger("edutena.cache")
+log_chat   = logging.getLogger("edutena.chat")
+log_sms    = logging.getLogger("edutena.sms")
+log_ussd   = logging.getLogger("edutena.ussd")
+log_jobs   = logging.getLogger("edutena.jobs")
+
+
+# =============================================================
+#  DATABASE
+# =============================================================
+
+# One pool per worker, opened at startup. Connections are health-checked on
+# checkout, recycled after DB_POOL_LIFETIME seconds and committed when the
+# `async with db_pool.connection()` block exits cleanly.
+db_pool = AsyncConnectionPool(
+    DATABASE_URL or "", min_size=DB_POOL_MIN, max_size=DB_POOL_MAX,
+    timeout=DB_POOL_TIMEOUT, open=False, check=AsyncConnectionPool.check_connection,
+    max_lifetime=DB_POOL_LIFETIME,
+)
+
+# Timed from checkout to commit, so a slow pool shows up as a slow stage.
+async def db_execute(sql, params=None):
+    with stage(sql_stage(sql)):
+        async with db_pool.connection() as conn:
+            await conn.execute(sql, params)
+
+async def db_fetchone(sql, params=None):
+    with stage(sql_stage(sql)):
+        async with db_pool.connection() as conn:
+            cur = await conn.execute(sql, params); return await cur.fetchone()
+
+async def db_fetchall(sql, params=None):
+    with stage(sql_stage(sql)):
+        async with db_pool.connection() as conn:
+            cur = await conn.execute(sql, params); return await cur.fetchall()
+
+# Schema changes are numbered migrations, applied once per database and
+# recorded in schema_version. A worker whose schema is current pays one
+# catalogue lookup and one SELECT at startup; otherwise the first worker to
+# take the advisory lock applies what's missing in a single transaction and
+# the rest find nothing left to do once they get the lock.
+SCHEMA_LOCK = 0x45445401
+
+async def init_db():
+    started = time.perf_counter()
+    latest = MIGRATIONS[-1][0]
+    async with db_pool.connection() as conn:
+        cur = conn.cursor()
+        current = await schema_version(cur)
+        if current < latest:
+            await cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK,))
+            await cur.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                                     version INTEGER PRIMARY KEY, name TEXT NOT NULL,
+                                     applied_at TIMESTAMP DEFAULT NOW())""")
+            current = await schema_version(cur)
+            for version, name, migrate in MIGRATIONS:
+                if version <= current: continue
+                await migrate(cur)
+                await cur.execute("INSERT INTO schema_version(version,name) VALUES(%s,%s)", (version, name))
+                log_db.info("applied migration %d: %s", version, name)
+        await ensure_chat_partitions(cur)
+    log_db.info("schema at version %d (%.0f ms)", latest, 1000 * (time.perf_counter() - started))
+
+async def schema_version(cur) -> int:
+    await cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not (await cur.fetchone())[0]: return 0
+    await cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return (await cur.fetchone())[0]
+
+async def create_base_tables(cur):
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS learners (
             phone TEXT PRIMARY KEY, lang TEXT DEFAULT 'en',
             level TEXT, grade TEXT, term TEXT, pathway TEXT,
             math INTEGER, science INTEGER, social INTEGER,
-            creative INTEGER, technical INTEGER,
-            career_interest TEXT, state TEXT, mode TEXT
+            creative INTEGER, technical INTEGER, career_interest TEXT,
+            sms_state TEXT, sms_mode TEXT, ussd_state TEXT, ussd_mode TEXT,
+            last_channel TEXT, updated_at TIMESTAMP DEFAULT NOW()
         )
     """)
-    for col in ["lang","grade","term","pathway","career_interest","mode"]:
-        cur.execute(f"ALTER TABLE students ADD COLUMN IF NOT EXISTS {col} TEXT")
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS ussd_students (
-            phone TEXT PRIMARY KEY, lang TEXT DEFAULT 'en',
-            level TEXT, grade TEXT, term TEXT, pathway TEXT,
-            math INTEGER, science INTEGER, social INTEGER,
-            creative INTEGER, technical INTEGER,
-            career_interest TEXT, state TEXT, mode TEXT
+    if CHAT_PARTITIONED:
+        await cur.execute("""
+            CREATE TABLE IF NOT EXISTS chat_history (
+                id BIGSERIAL, phone TEXT, role TEXT, message TEXT,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        """)
+    else:
+        await cur.execute("""
+            CREATE TABLE IF NOT EXISTS chat_history (
+                id SERIAL PRIMARY KEY, phone TEXT, role TEXT,
+                message TEXT, created_at TIMESTAMP DEFAULT NOW()
+            )
+        """)
+    # Serves load_conversation's "WHERE phone ORDER BY created_at DESC LIMIT n" as an index range scan.
+    await cur.execute("CREATE INDEX IF NOT EXISTS chat_history_phone_created_idx "
+                      "ON chat_history(phone, created_at DESC)")
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGSERIAL PRIMARY KEY, kind TEXT NOT NULL, payload JSONB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT, run_after TIMESTAMP DEFAULT NOW(),
+            created_at TIMESTAMP DEFAULT NOW(), updated_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+    await cur.execute("CREATE INDEX IF NOT EXISTS jobs_pending_idx ON jobs(status, run_after) WHERE status <> 'failed'")
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            phone TEXT PRIMARY KEY, summary TEXT NOT NULL,
+            upto_id BIGINT NOT NULL, updated_at TIMESTAMP DEFAULT NOW()
         )
     """)
-    for col in ["lang","grade","term","pathway","career_interest","mode"]:
-        cur.execute(f"ALTER TABLE ussd_students ADD COLUMN IF NOT EXISTS {col} TEXT")
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS chat_history (
-            id SERIAL PRIMARY KEY, phone TEXT, role TEXT,
-            message TEXT, created_at TIMESTAMP DEFAULT NOW()
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY, response TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
         )
     """)
-    for table in ["students", "ussd_students"]:
-        cur.execute(f"""
+
+# Before the merge each channel had its own table. Folded into learners once;
+# the old tables are renamed *_legacy afterwards.
+async def migrate_student_tables(cur):
+    await cur.execute("SELECT to_regclass('students') IS NOT NULL, to_regclass('ussd_students') IS NOT NULL")
+    has_sms, has_ussd = await cur.fetchone()
+    profile = "lang,level,grade,term,pathway,math,science,social,creative,technical,career_interest"
+    for table, channel, present in (("students", "sms", has_sms), ("ussd_students", "ussd", has_ussd)):
+        if not present: continue
+        # Same clean-up the old startup ran on every boot: rows with an unknown language start over.
+        await cur.execute(f"""
             UPDATE {table} SET lang='en', state='LANG',
                 level=NULL, grade=NULL, term=NULL, pathway=NULL,
                 math=NULL, science=NULL, social=NULL,
                 creative=NULL, technical=NULL, career_interest=NULL
             WHERE lang NOT IN ('en','sw','lh','ki') OR lang IS NULL
         """)
-    conn.commit(); cur.close(); conn.close()
+        # SMS is copied first, so where a phone has both, its SMS profile wins and USSD fills gaps.
+        fill = ",".join(f"{c}=COALESCE(learners.{c},EXCLUDED.{c})" for c in profile.split(","))
+        await cur.execute(f"""
+            INSERT INTO learners(phone,{profile},{channel}_state,{channel}_mode,last_channel)
+            SELECT phone,{profile},state,mode,'{channel}' FROM {table}
+            ON CONFLICT (phone) DO UPDATE SET {fill},
+                {channel}_state=EXCLUDED.{channel}_state, {channel}_mode=EXCLUDED.{channel}_mode
+        """)
+        moved = cur.rowcount
+        await cur.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+        log_db.info("merged %d %s rows into learners", moved, table)
+
+# Serves the retention pass's "DELETE FROM llm_cache WHERE created_at < ..." as a range scan.
+async def index_llm_cache_age(cur):
+    await cur.execute("CREATE INDEX IF NOT EXISTS llm_cache_created_idx ON llm_cache(created_at)")
+
+# Serves the retention pass's batched "WHERE created_at < ..." on an unpartitioned chat_history;
+# per-phone trimming uses chat_history_phone_created_idx.
+async def index_chat_history_age(cur):
+    await cur.execute("CREATE INDEX IF NOT EXISTS chat_history_created_idx ON chat_history(created_at)")
+
+# Append only: a released version is never edited, its successor fixes it.
+MIGRATIONS = [
+    (1, "base tables", create_base_tables),
+    (2, "merge students and ussd_students into learners", migrate_student_tables),
+    (3, "index llm_cache by age", index_llm_cache_age),
+    (4, "index chat_history by age", index_chat_history_age),
+]
 
 @app.on_event("startup")
-def startup():
-    init_db()
+async def startup():
+    global gemini_client
+    started = time.perf_counter()
+    gemini_client = new_gemini_client()
+    await db_pool.open(wait=True)
+    await init_db()
+    if LLM_CACHE_WARMUP and GEMINI_KEY:
+        asyncio.create_task(warm_llm_cache(LLM_CACHE_WARMUP == "all"))
+    start_job_workers()
+    _background_tasks.append(asyncio.create_task(_chat_retention_loop()))
+    log_db.info("startup done in %.0f ms", 1000 * (time.perf_counter() - started))
+
+@app.on_event("shutdown")
+async def shutdown():
+    await stop_job_workers()
+    await gemini_client.aclose()
+    await db_pool.close()
+    await sms_dispatcher.drain()
+    _sms_executor.shutdown(wait=True)
+    log_listener.stop()
 
 # =============================================================
 #  SHARED CONSTANTS
@@ -271,6 +664,7 @@ UI = {
         "paused":              "Still paused. Reply RESUME to continue your assessment.",
         "thank_you":           "Thank you for using EduTena CBE. Good luck!",
         "error":               "Something went wrong. Please try again.",
+        "slow_down":           "You are sending messages too fast. Please wait a moment and try again.",
         "resume_fallback":     "Reply START to begin your assessment.",
         "rag_welcome":         "CBE Assistant ready!\nAsk me anything about:\n- CBE subjects & pathways\n- Assignment help\n- How CBE works\n- Career questions\n\nJust type your question.\nReply MENU to go back.",
         "rag_menu_reminder":   "Reply MENU to return to the main menu.",
@@ -318,6 +712,7 @@ UI = {
         "paused":              "Bado imesimamishwa. Jibu RESUME kuendelea na tathmini yako.",
         "thank_you":           "Asante kwa kutumia EduTena CBE. Kila la heri!",
         "error":               "Hitilafu imetokea. Tafadhali jaribu tena.",
+        "slow_down":           "Unatuma jumbe haraka sana. Tafadhali subiri kidogo kisha ujaribu tena.",
         "resume_fallback":     "Jibu START kuanza tathmini yako.",
         "rag_welcome":         "Msaidizi wa CBE yuko tayari!\nNiulize chochote kuhusu:\n- Masomo & njia za CBE\n- Msaada wa kazi za nyumbani\n- Jinsi CBE inavyofanya kazi\n- Maswali ya kazi\n\nAndika swali lako.\nJibu MENU kurudi.",
         "rag_menu_reminder":   "Jibu MENU kurudi menyu kuu.",
@@ -365,6 +760,7 @@ UI = {
         "paused":              "Bado imesimamishwa. Jibu RESUME kuendelea.",
         "thank_you":           "Asante okhutumia EduTena CBE. Kila la heri!",
         "error":               "Hitilafu imetokea. Tafadhali jaribu tena.",
+        "slow_down":           "Unatuma jumbe haraka sana. Tafadhali subiri kidogo kisha ujaribu tena.",
         "resume_fallback":     "Jibu START okhuanza tathmini yako.",
         "rag_welcome":         "Msaidizi wa CBE yuko tayari!\nNiulize chochote:\n- Masomo & njia za CBE\n- Msaada wa kazi\n- Jinsi CBE inavyofanya kazi\n\nAndika swali lako.\nJibu MENU kurudi.",
         "rag_menu_reminder":   "Jibu MENU kurudi menyu kuu.",
@@ -419,9 +815,24 @@ UI = {
 }
 
 
+def _validate_ui():
+    """Every language must use exactly the placeholders of the English string."""
+    fields = lambda s: {f for _, f, _, _ in string.Formatter().parse(s) if f is not None}
+    bad = [f"{lang}.{key}: {sorted(fields(text))} != {sorted(fields(UI['en'][key]))}"
+           for lang, table in UI.items() for key, text in table.items()
+           if key in UI["en"] and fields(text) != fields(UI["en"][key])]
+    bad += [f"{lang}.{key}: not in en" for lang, table in UI.items() for key in table if key not in UI["en"]]
+    if bad: raise ValueError("UI placeholder mismatch:\n" + "\n".join(bad))
+
+_validate_ui()
+
+# Fallbacks resolved once: CATALOGUE[lang][key] is the final template.
+CATALOGUE = {lang: {key: UI[lang].get(key) or en_text for key, en_text in UI["en"].items()} for lang in UI}
+
+
 def t(lang: str, key: str, **kwargs) -> str:
     """Translate key to lang; fall back to English; support format kwargs."""
-    text = UI.get(lang, UI["en"]).get(key) or UI["en"].get(key, f"[{key}]")
+    text = CATALOGUE.get(lang, CATALOGUE["en"]).get(key, f"[{key}]")
     return text.format(**kwargs) if kwargs else text
 
 
@@ -459,9 +870,15 @@ OTHER RULES:
 - If asked something completely unrelated to CBE/education, politely redirect
 """
 
-DOCUMENT_CONTEXT = """
-[CBE curriculum document context will be injected here once linked.]
-"""
+# Built offline by `python docindex.py build`; opened on the first RAG question and
+# swapped for the newest published generation without a restart.
+doc_index = IndexWatcher(DOC_INDEX_DIR, DOC_INDEX_CHECK)
+
+def retrieve_context(question: str) -> list[str]:
+    """Top DOC_TOP_K chunks from the data/ documents relevant to question, best first."""
+    index = doc_index.current()
+    if index is None: return []
+    return [f"[{src}] {text}" for text, _, src in index.search(question, DOC_TOP_K)]
 
 CBE_ASSISTANT_SYSTEM = """\
 You are EduTena CBE Assistant — a friendly, knowledgeable tutor for
@@ -489,38 +906,233 @@ OTHER RULES:
 """
 
 
+# =============================================================
+#  LLM RESPONSE CACHE
+#  Deterministic prompts (canned USSD topics, career narratives)
+#  are answered from memory, then from the llm_cache table.
+# =============================================================
+
+class LLMCache:
+    """Prompt-keyed response cache: bounded in-process LRU over a Postgres tier."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize; self.ttl = ttl
+        self._local = OrderedDict()
+        self.hits = 0; self.misses = 0
+
+    @staticmethod
+    def key(prompt, max_tokens, temperature):
+        return hashlib.sha256(f"{max_tokens}|{temperature}|{prompt}".encode()).hexdigest()
+
+    def _remember(self, key, text):
+        self._local[key] = (time.monotonic() + self.ttl, text)
+        self._local.move_to_end(key)
+        while len(self._local) > self.maxsize: self._local.popitem(last=False)
+
+    async def get(self, key):
+        entry = self._local.get(key)
+        if entry and entry[0] > time.monotonic():
+            self._local.move_to_end(key); self.hits += 1; return entry[1]
+        row = await db_fetchone("SELECT response FROM llm_cache WHERE key=%s "
+                                "AND created_at > NOW() - make_interval(secs => %s)", (key, self.ttl))
+        if row: self._remember(key, row[0]); self.hits += 1; return row[0]
+        self.misses += 1; return None
+
+    async def put(self, key, text):
+        self._remember(key, text)
+        await db_execute("INSERT INTO llm_cache(key,response) VALUES(%s,%s) ON CONFLICT (key) "
+                         "DO UPDATE SET response=EXCLUDED.response, created_at=NOW()", (key, text))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._local)}
+
+
+llm_cache = LLMCache(LLM_CACHE_SIZE, LLM_CACHE_TTL)
+
+
 # =============================================================
 #  GEMINI CALLER
 # =============================================================
 
-async def gemini_call(prompt: str, max_tokens: int, temperature: float, label: str) -> str | None:
+# One keep-alive HTTP/2 client per worker, opened at startup, so LLM calls skip
+# DNS + TCP + TLS after the first request. Reads get the long timeout; a
+# connect that takes more than a few seconds is better retried.
+gemini_client: httpx.AsyncClient | None = None
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+def new_gemini_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(25, connect=5),
+        limits=httpx.Limits(max_connections=GEMINI_MAX_CONNECTIONS,
+                            max_keepalive_connections=GEMINI_MAX_CONNECTIONS, keepalive_expiry=60),
+    )
+
+def _retry_delay(r: httpx.Response, attempt: int) -> float:
+    """Retry-After if the server sent one, else full-jitter exponential backoff."""
+    ra = r.headers.get("retry-after", "")
+    return min(float(ra), 10.0) if ra.isdigit() else random.uniform(0, 0.5 * 2 ** attempt)
+
+async def gemini_post(body: dict, label: str) -> httpx.Response:
+    """POST to Gemini, retrying 429/5xx with full-jitter exponential backoff."""
+    for attempt in range(GEMINI_RETRIES + 1):
+        with stage("gemini"):
+            r = await gemini_client.post(GEMINI_URL, params={"key": GEMINI_KEY}, json=body)
+        if r.status_code not in RETRY_STATUS or attempt == GEMINI_RETRIES: return r
+        delay = _retry_delay(r, attempt)
+        log_gemini.warning("HTTP %s, retry %d in %.2fs", r.status_code, attempt + 1, delay, extra={"label": label})
+        await asyncio.sleep(delay)
+
+async def gemini_call(prompt: str, max_tokens: int, temperature: float, label: str,
+                      cache: bool = False) -> str | None:
+    if cache:
+        key = LLMCache.key(prompt, max_tokens, temperature)
+        try:
+            hit = await llm_cache.get(key)
+            if hit: return hit
+        except Exception as e: log_gemini.warning("cache read failed: %s", e, extra={"label": label})
+    a = await _gemini_generate(prompt, max_tokens, temperature, label)
+    if cache and a and a != "__SAFETY__":
+        try: await llm_cache.put(key, a)
+        except Exception as e: log_gemini.warning("cache write failed: %s", e, extra={"label": label})
+    return a
+
+async def gemini_call_stream(prompt: str, max_tokens: int, temperature: float, label: str,
+                             on_text, cache: bool = False) -> str | None:
+    """Like gemini_call, but hands text to on_text as it arrives from streamGenerateContent.
+
+    Returns the full answer (already delivered) once the stream has ended with a
+    finishReason, "__SAFETY__", or None. None includes a stream that broke off
+    part-way: whatever reached on_text is then incomplete and is neither cached
+    nor worth saving. Opening the stream is retried like gemini_post; nothing has
+    reached on_text until it answers 200.
+    """
+    if cache:
+        key = LLMCache.key(prompt, max_tokens, temperature)
+        try:
+            hit = await llm_cache.get(key)
+            if hit: await on_text(hit); return hit
+        except Exception as e: log_gemini.warning("cache read failed: %s", e, extra={"label": label})
+    parts, meta, finished = [], {}, False
+    timer = stage("gemini").__enter__()
     try:
-        async with httpx.AsyncClient(timeout=25) as client:
-            r = await client.post(
-                f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-001:generateContent?key={GEMINI_KEY}",
-                json={"contents": [{"parts": [{"text": prompt}]}],
-                      "generationConfig": {"maxOutputTokens": max_tokens, "temperature": temperature}}
-            )
-            data = r.json()
-            print(f"[{label}] HTTP {r.status_code} | keys: {list(data.keys())}")
-            if "error" in data: print(f"[{label}] {data['error']}"); return None
-            candidates = data.get("candidates", [])
-            if not candidates: print(f"[{label}] empty candidates: {data}"); return None
-            c = candidates[0]
-            if c.get("finishReason") == "SAFETY": return "__SAFETY__"
-            return c["content"]["parts"][0]["text"].strip()
+        body = {"contents": [{"parts": [{"text": prompt}]}],
+                "generationConfig": {"maxOutputTokens": max_tokens, "temperature": temperature}}
+        request = gemini_client.build_request("POST", GEMINI_STREAM_URL, params={"key": GEMINI_KEY, "alt": "sse"},
+                                              json=body)
+        for attempt in range(GEMINI_RETRIES + 1):
+            r = await gemini_client.send(request, stream=True)
+            if r.status_code not in RETRY_STATUS or attempt == GEMINI_RETRIES: break
+            await r.aclose()
+            delay = _retry_delay(r, attempt)
+            log_gemini.warning("stream HTTP %s, retry %d in %.2fs", r.status_code, attempt + 1, delay,
+                               extra={"label": label})
+            await asyncio.sleep(delay)
+        try:
+            if r.status_code != 200:
+                log_gemini.error("stream HTTP %s: %r", r.status_code, (await r.aread())[:300], extra={"label": label})
+                return None
+            async for line in r.aiter_lines():
+                if not line.startswith("data:"): continue
+                data = json.loads(line[5:])
+                meta = data.get("usageMetadata", meta)
+                c = (data.get("candidates") or [{}])[0]
+                if c.get("finishReason") == "SAFETY": return "__SAFETY__"
+                text = "".join(p.get("text", "") for p in c.get("content", {}).get("parts", []))
+                if text: parts.append(text); await on_text(text)
+                finished = finished or bool(c.get("finishReason"))
+        finally:
+            await r.aclose()
     except Exception as e:
-        print(f"[{label}] {type(e).__name__}: {e}"); return None
+        log_gemini.error("stream %s: %s", type(e).__name__, e, extra={"label": label})
+    finally:
+        timer.__exit__()     # includes time spent in on_text, i.e. queueing the first parts
+    usage = llm_usage.setdefault(label, {"calls": 0, "prompt_tokens": 0, "output_tokens": 0})
+    usage["calls"] += 1
+    usage["prompt_tokens"] += meta.get("promptTokenCount", 0)
+    usage["output_tokens"] += meta.get("candidatesTokenCount", 0)
+    if not finished:
+        if parts: log_gemini.warning("stream cut off after %d chars", sum(map(len, parts)), extra={"label": label})
+        return None
+    a = "".join(parts).strip() or None
+    if cache and a:
+        try: await llm_cache.put(key, a)
+        except Exception as e: log_gemini.warning("cache write failed: %s", e, extra={"label": label})
+    return a
+
+async def _gemini_generate(prompt, max_tokens, temperature, label):
+    try:
+        r = await gemini_post({"contents": [{"parts": [{"text": prompt}]}],
+                               "generationConfig": {"maxOutputTokens": max_tokens, "temperature": temperature}}, label)
+        data = r.json()
+        log_gemini.debug("HTTP %s", r.status_code, extra={"label": label})
+        if "error" in data: log_gemini.error("%s", data["error"], extra={"label": label}); return None
+        candidates = data.get("candidates", [])
+        if not candidates: log_gemini.warning("empty candidates: %s", data, extra={"label": label}); return None
+        usage = llm_usage.setdefault(label, {"calls": 0, "prompt_tokens": 0, "output_tokens": 0})
+        meta = data.get("usageMetadata", {})
+        usage["calls"] += 1
+        usage["prompt_tokens"] += meta.get("promptTokenCount", 0)
+        usage["output_tokens"] += meta.get("candidatesTokenCount", 0)
+        c = candidates[0]
+        if c.get("finishReason") == "SAFETY": return "__SAFETY__"
+        return c["content"]["parts"][0]["text"].strip()
+    except Exception as e:
+        log_gemini.error("%s: %s", type(e).__name__, e, extra={"label": label}); return None
+
+
+# =============================================================
+#  PROMPT BUDGET
+#  Fixed text (system prompt, question, instructions) is always
+#  sent. What is left of the call site's budget goes, in order, to
+#  retrieved document chunks (best first, at most 60%), the rolling
+#  conversation summary, then raw turns newest-first. Selection is
+#  whole items only, so the same inputs give the same prompt.
+# =============================================================
+
+HISTORY_TURN_CAP = 400   # est. tokens; a single long answer can't crowd out the rest
+llm_usage: dict[str, dict] = {}     # label -> API-reported token totals
+prompt_stats: dict[str, dict] = {}  # label -> our estimates and what was trimmed
+
+def estimate_tokens(text: str) -> int:
+    # ~4 chars per token for Gemini on English/Swahili prose; close enough to budget with.
+    return (len(text) + 3) // 4
+
+def _clip(text, tokens):
+    return text if estimate_tokens(text) <= tokens else text[:tokens * 4].rsplit(" ", 1)[0] + " …"
+
+def fit_context(label, budget, fixed, chunks=(), summary="", rows=()):
+    """Choose the chunks, summary and history lines that fit in budget beyond `fixed`."""
+    left = budget - estimate_tokens(fixed)
+    docs, doc_room = [], int(left * 0.6)
+    for chunk in chunks:
+        cost = estimate_tokens(chunk) + 1
+        if cost > doc_room: break
+        docs.append(chunk); doc_room -= cost; left -= cost
+    summary = _clip(summary, max(left // 4, 0)) if summary else ""
+    left -= estimate_tokens(summary)
+    lines = []
+    for role, message in reversed(rows):
+        line = f"{role.upper()}: {_clip(message, HISTORY_TURN_CAP)}\n"
+        cost = estimate_tokens(line)
+        if cost > left: break
+        lines.append(line); left -= cost
+    st = prompt_stats.setdefault(label, {"calls": 0, "est_tokens": 0, "turns_dropped": 0, "chunks_dropped": 0})
+    st["calls"] += 1; st["est_tokens"] += budget - left
+    st["turns_dropped"] += len(rows) - len(lines); st["chunks_dropped"] += len(chunks) - len(docs)
+    return docs, summary, "".join(reversed(lines))
+
+def _history_block(summary, history):
+    return (f"SUMMARY OF EARLIER CONVERSATION:\n{summary}\n\n" if summary else "") + \
+           f"CONVERSATION HISTORY:\n{history}\n"
 
 
 # =============================================================
 #  GEMINI 1 — CAREER NARRATIVE
 # =============================================================
 
-async def gemini_career_narrative(grade, pathway, career, subjects, demand, lang) -> str:
-    if not GEMINI_KEY:
-        return t(lang, "done")
-    prompt = (
+def _career_narrative_prompt(grade, pathway, career, subjects, demand, lang):
+    return (
         f"{cbe_system_prompt(lang)}\n\n"
         f"TASK: Write a personalised, motivating message for a Kenyan student "
         f"who just chose their career interest.\n\n"
@@ -535,7 +1147,13 @@ async def gemini_career_narrative(grade, pathway, career, subjects, demand, lang
         f"5. End with genuine encouragement mentioning the Kenya job market opportunity\n\n"
         f"Write as many sentences as needed. Do NOT be generic. Be warm and Kenyan.\n\nMessage:"
     )
-    a = await gemini_call(prompt, 700, 0.7, "career_narrative")
+
+async def gemini_career_narrative(grade, pathway, career, subjects, demand, lang) -> str:
+    if not GEMINI_KEY:
+        return t(lang, "done")
+    # Fully determined by (grade, pathway, career, lang), so safe to share across students.
+    prompt = _career_narrative_prompt(grade, pathway, career, subjects, demand, lang)
+    a = await gemini_call(prompt, 700, 0.7, "career_narrative", cache=True)
     return a if (a and a != "__SAFETY__") else f"Great choice! Focus on {subjects} and build your CBE portfolio."
 
 
@@ -571,20 +1189,17 @@ async def gemini_jss_suggestions(grade, term, math, science, social, creative, t
 
 async def ask_gemini(phone, question, lang="en", context_state="", channel="sms") -> str:
     if not GEMINI_KEY: return t(lang, "resume_fallback")
-    history = "".join(f"{r.upper()}: {m}\n" for r, m in get_chat_history(phone, 6))
+    summary, rows = await load_conversation(phone)
     flow = (f"\nNote: Student is mid-assessment (step: {context_state}). "
             f"They can reply RESUME to continue.\n") if context_state else ""
     resume = t(lang, "resume_fallback")
-    prompt = (
-        f"{cbe_system_prompt(lang)}{flow}\n"
-        f"CONVERSATION HISTORY:\n{history}\n"
-        f"STUDENT QUESTION: {question}\n\n"
-        f"Answer fully and clearly — do not truncate. End with: '{resume}'"
-    )
-    a = await gemini_call(prompt, 900, 0.4, "ask_gemini")
+    head = f"{cbe_system_prompt(lang)}{flow}\n"
+    tail = (f"STUDENT QUESTION: {question}\n\n"
+            f"Answer fully and clearly — do not truncate. End with: '{resume}'")
+    _, summary, history = fit_context("ask_gemini", PROMPT_BUDGET_ASK, head + tail, summary=summary, rows=rows)
+    a = await gemini_call(head + _history_block(summary, history) + tail, 900, 0.4, "ask_gemini")
     if not a or a == "__SAFETY__": return t(lang, "resume_fallback")
-    save_chat(phone, "user", question)
-    save_chat(phone, "assistant", a)
+    await save_turn(phone, question, a, len(rows))
     return a
 
 
@@ -592,36 +1207,201 @@ async def ask_gemini(phone, question, lang="en", context_state="", channel="sms"
 #  GEMINI 4 — RAG CHAT
 # =============================================================
 
-async def ask_gemini_rag(phone, question, lang) -> str:
-    if not GEMINI_KEY: return t(lang, "done")
-    history = "".join(f"{r.upper()}: {m}\n" for r, m in get_chat_history(phone, 8))
-    doc = (f"\nREFERENCE DOCUMENTS:\n{DOCUMENT_CONTEXT}\n"
-           if DOCUMENT_CONTEXT.strip() and not DOCUMENT_CONTEXT.strip().startswith("[")
-           else "(No documents linked yet — use your CBE knowledge.)")
+def _rag_prompt(question, lang, summary="", rows=()):
+    tail = (f"STUDENT: {question}\n\n"
+            f"EDUTENA — answer fully. Never truncate. "
+            f"End with: '{t(lang, 'rag_menu_reminder')}'")
+    fixed = CBE_ASSISTANT_SYSTEM.format(document_context="", lang_instruction=_lang_instruction(lang)) + tail
+    chunks, summary, history = fit_context("rag_chat", PROMPT_BUDGET_RAG, fixed,
+                                           retrieve_context(question), summary, rows)
+    doc = ("\nREFERENCE DOCUMENTS:\n" + "\n\n".join(chunks) + "\n" if chunks
+           else "(No matching documents — use your CBE knowledge.)")
     system = CBE_ASSISTANT_SYSTEM.format(document_context=doc, lang_instruction=_lang_instruction(lang))
-    prompt = (
-        f"{system}\n\nCONVERSATION HISTORY:\n{history}\n"
-        f"STUDENT: {question}\n\n"
-        f"EDUTENA — answer fully. Never truncate. "
-        f"End with: '{t(lang, 'rag_menu_reminder')}'"
-    )
-    a = await gemini_call(prompt, 1600, 0.5, "rag_chat")
+    return f"{system}\n\n{_history_block(summary, history)}{tail}"
+
+async def ask_gemini_rag(phone, question, lang, history_turns=8) -> str:
+    """history_turns=0 gives a history-free, cacheable prompt (canned USSD topics)."""
+    if not GEMINI_KEY: return t(lang, "done")
+    summary, rows = (await load_conversation(phone, max(history_turns, HISTORY_SUMMARISE_AT + 2))
+                     if history_turns else ("", []))
+    a = await gemini_call(_rag_prompt(question, lang, summary, rows), 1600, 0.5, "rag_chat",
+                          cache=not history_turns)
     if not a or a == "__SAFETY__": return t(lang, "error")
-    save_chat(phone, "user", question)
-    save_chat(phone, "assistant", a)
+    await save_turn(phone, question, a, len(rows))
     return a
 
+async def reply_gemini_rag(phone, question, lang, history_turns=8, header=""):
+    """Answer by SMS, sending each finished segment while Gemini is still generating."""
+    if not (GEMINI_KEY and GEMINI_STREAM):
+        await deliver(phone, [header + await ask_gemini_rag(phone, question, lang, history_turns)], lang); return
+    summary, rows = (await load_conversation(phone, max(history_turns, HISTORY_SUMMARISE_AT + 2))
+                     if history_turns else ("", []))
+    out = SMSStreamer(phone, lang, header)
+    a = await gemini_call_stream(_rag_prompt(question, lang, summary, rows), 1600, 0.5, "rag_chat",
+                                 out.feed, cache=not history_turns)
+    if not a or a == "__SAFETY__": await out.feed(("\n\n" if out.started else "") + t(lang, "error"))
+    await out.close()
+    if a and a != "__SAFETY__": await save_turn(phone, question, a, len(rows))
+
+
+USSD_RAG_TOPICS = {
+    "1": "Can you explain in detail what CBE (Competency Based Education) and CBC (Competency Based Curriculum) mean in Kenya? How is it different from what came before and why was it introduced?",
+    "2": "Please explain the three Senior Secondary CBE pathways in detail — STEM, Social Sciences, and Arts & Sports Science. What subjects does each contain, what competencies are assessed, and what careers does each pathway lead to?",
+    "3": "How does a student build a CBE competency portfolio for university entry? What should it include, how is it assessed, who reviews it, and which universities in Kenya already accept CBE portfolios?",
+    "4": "What is the full difference between the old 844 KCSE system and the new CBE system in Kenya? How does university entry work now versus before? What does this mean for students currently in school?",
+    "5": "How do Kenyan universities and colleges admit students under CBE? Which specific institutions have confirmed CBE portfolio pathways, what are their requirements, and how does the process work step by step?",
+}
+
+async def warm_llm_cache(include_narratives=False):
+    """Pre-answer the canned USSD topics (and optionally every career narrative)."""
+    sem = asyncio.Semaphore(4)
+    async def one(prompt, max_tokens, temperature):
+        async with sem: await gemini_call(prompt, max_tokens, temperature, "warmup", cache=True)
+    jobs = [one(_rag_prompt(q, lang), 1600, 0.5) for q in USSD_RAG_TOPICS.values() for lang in UI]
+    if include_narratives:
+        jobs += [one(_career_narrative_prompt(grade, pw, name, subjects, demand, lang), 700, 0.7)
+                 for pw, careers in SENIOR_CAREERS.items()
+                 for name, demand, _, subjects, *_ in careers
+                 for grade in SENIOR_GRADES.values() for lang in UI]
+    await asyncio.gather(*jobs)
+    log_cache.info("LLM cache warm-up done: %s", llm_cache.stats())
 
-def get_chat_history(phone, limit=6):
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("SELECT role,message FROM chat_history WHERE phone=%s ORDER BY created_at DESC LIMIT %s", (phone, limit))
-    rows = cur.fetchall(); cur.close(); conn.close()
-    return list(reversed(rows))
 
-def save_chat(phone, role, message):
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("INSERT INTO chat_history(phone,role,message) VALUES(%s,%s,%s)", (phone, role, message))
-    conn.commit(); cur.close(); conn.close()
+# =============================================================
+#  ROLLING CONVERSATION SUMMARY
+#  Turns older than the newest HISTORY_KEEP_RAW exchanges are
+#  folded into chat_summaries by a background job, so prompts carry
+#  a short summary instead of ever more raw answers.
+# =============================================================
+
+_summaries_pending: set[str] = set()
+
+async def load_conversation(phone, limit=HISTORY_SUMMARISE_AT + 2):
+    """(summary, [(role, message), ...] oldest first) — the turns not yet summarised."""
+    rows = await db_fetchall("""SELECT s.summary, h.role, h.message FROM (SELECT 1) one
+                                LEFT JOIN chat_summaries s ON s.phone=%s
+                                LEFT JOIN LATERAL (SELECT role, message, created_at FROM chat_history
+                                    WHERE phone=%s AND id > COALESCE(s.upto_id, 0)
+                                    ORDER BY created_at DESC LIMIT %s) h ON true
+                                ORDER BY h.created_at""", (phone, phone, limit))
+    return rows[0][0] or "", [(r, m) for _, r, m in rows if r is not None]
+
+async def save_turn(phone, question, answer, unsummarised=0):
+    """Store both sides of an exchange in one statement; fold old turns when they pile up."""
+    # clock_timestamp() (not NOW()) so the two rows keep their order by created_at.
+    await db_execute("""INSERT INTO chat_history(phone,role,message,created_at)
+                        VALUES(%s,'user',%s,clock_timestamp()),(%s,'assistant',%s,clock_timestamp())""",
+                     (phone, question, phone, answer))
+    if unsummarised + 2 >= HISTORY_SUMMARISE_AT and phone not in _summaries_pending:
+        _summaries_pending.add(phone)
+        try: await enqueue_job("summarise_history", phone=phone)
+        except Exception: _summaries_pending.discard(phone); raise
+
+async def _summarise_history(phone):
+    try:
+        row = await db_fetchone("SELECT summary, upto_id FROM chat_summaries WHERE phone=%s", (phone,))
+        summary, upto = row or ("", 0)
+        turns = await db_fetchall("SELECT id, role, message FROM chat_history WHERE phone=%s AND id > %s ORDER BY id",
+                                  (phone, upto))
+        fold = turns[:max(0, len(turns) - 2 * HISTORY_KEEP_RAW)]   # a question and its answer per exchange
+        if not fold: return
+        convo = "".join(f"{r.upper()}: {_clip(m, HISTORY_TURN_CAP)}\n" for _, r, m in fold)
+        prompt = ("Update the running summary of a student's conversation with a CBE tutor. "
+                  "Keep facts about the student (grade, pathway, interests, struggles) and open questions. "
+                  "Write at most 120 words in the conversation's language.\n\n"
+                  f"PREVIOUS SUMMARY:\n{summary or '(none)'}\n\nNEW TURNS:\n{convo}\nUPDATED SUMMARY:")
+        a = await gemini_call(prompt, 300, 0.2, "history_summary")
+        if not a or a == "__SAFETY__": raise RuntimeError("no summary returned")
+        await db_execute("""INSERT INTO chat_summaries(phone,summary,upto_id) VALUES(%s,%s,%s)
+                            ON CONFLICT (phone) DO UPDATE SET summary=EXCLUDED.summary,
+                                upto_id=EXCLUDED.upto_id, updated_at=NOW()""", (phone, a, fold[-1][0]))
+    finally:
+        _summaries_pending.discard(phone)
+
+
+# =============================================================
+#  CHAT HISTORY RETENTION
+# =============================================================
+
+CHAT_RETENTION_LOCK = 0x45445554   # pg advisory lock id: one worker runs retention at a time
+
+def _month_start(year, month):
+    return f"{year + (month - 1) // 12:04d}-{(month - 1) % 12 + 1:02d}-01"
+
+async def ensure_chat_partitions(cur, months_ahead=2):
+    """Create this month's and the next few monthly partitions, if chat_history is partitioned."""
+    await cur.execute("SELECT relkind FROM pg_class WHERE relname='chat_history'")
+    row = await cur.fetchone()
+    if not row or row[0] != "p": return
+    now = time.gmtime()
+    for m in range(now.tm_mon, now.tm_mon + months_ahead + 1):
+        lo, hi = _month_start(now.tm_year, m), _month_start(now.tm_year, m + 1)
+        await cur.execute(f"CREATE TABLE IF NOT EXISTS chat_history_p{lo[:7].replace('-', '')} "
+                          f"PARTITION OF chat_history FOR VALUES FROM ('{lo}') TO ('{hi}')")
+
+async def _delete_in_batches(conn, sql, params) -> int:
+    """Run sql (a DELETE whose last parameter is a LIMIT) until a batch comes back short."""
+    total = 0
+    while True:
+        cur = await conn.execute(sql, (*params, CHAT_RETENTION_BATCH))
+        await conn.commit()
+        total += cur.rowcount
+        if cur.rowcount < CHAT_RETENTION_BATCH: return total
+
+async def compact_chat_history():
+    """Drop turns older than CHAT_RETENTION_DAYS and all but the newest CHAT_KEEP_TURNS per phone.
+
+    Also deletes llm_cache rows older than LLM_CACHE_TTL: reads skip them, so nothing else would.
+    Deletes run CHAT_RETENTION_BATCH rows at a time, each committed, so a large backlog never
+    holds one long transaction; the advisory lock is session-level for that reason.
+    """
+    async with db_pool.connection() as conn:
+        cur = conn.cursor()
+        await cur.execute("SELECT pg_try_advisory_lock(%s)", (CHAT_RETENTION_LOCK,))
+        if not (await cur.fetchone())[0]: return None
+        try:
+            await ensure_chat_partitions(cur)
+            cutoff = time.strftime("%Y%m", time.gmtime(time.time() - CHAT_RETENTION_DAYS * 86400))
+            await cur.execute("""SELECT c.relname FROM pg_inherits i
+                                 JOIN pg_class c ON c.oid=i.inhrelid JOIN pg_class p ON p.oid=i.inhparent
+                                 WHERE p.relname='chat_history'""")
+            dropped = [r[0] for r in await cur.fetchall() if r[0].startswith("chat_history_p") and r[0][14:] < cutoff]
+            for name in dropped: await cur.execute(f"DROP TABLE {name}")
+            await conn.commit()
+            expired = await _delete_in_batches(conn, """
+                DELETE FROM chat_history WHERE id IN (SELECT id FROM chat_history
+                    WHERE created_at < NOW() - make_interval(days => %s) LIMIT %s)""", (CHAT_RETENTION_DAYS,))
+            trimmed = 0
+            if CHAT_KEEP_TURNS:         # a turn is two rows, the question and the answer
+                keep = 2 * CHAT_KEEP_TURNS
+                await cur.execute("SELECT phone FROM chat_history GROUP BY phone HAVING count(*) > %s", (keep,))
+                phones = [r[0] for r in await cur.fetchall()]
+                # Per phone: one index probe for its oldest kept row, then older rows by index range.
+                chunk = 500
+                for i in range(0, len(phones), chunk):
+                    trimmed += await _delete_in_batches(conn, """
+                        DELETE FROM chat_history WHERE id IN (SELECT h.id FROM unnest(%s::text[]) p(phone)
+                            CROSS JOIN LATERAL (SELECT created_at FROM chat_history WHERE phone=p.phone
+                                                ORDER BY created_at DESC OFFSET %s LIMIT 1) edge
+                            JOIN chat_history h ON h.phone=p.phone AND h.created_at < edge.created_at
+                            LIMIT %s)""", (phones[i:i + chunk], keep - 1))
+            cache_expired = await _delete_in_batches(conn, """
+                DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache
+                    WHERE created_at < NOW() - make_interval(secs => %s) LIMIT %s)""", (LLM_CACHE_TTL,))
+        finally:
+            await conn.rollback()
+            await cur.execute("SELECT pg_advisory_unlock(%s)", (CHAT_RETENTION_LOCK,))
+    return {"partitions_dropped": len(dropped), "expired": expired, "trimmed": trimmed,
+            "llm_cache_expired": cache_expired}
+
+async def _chat_retention_loop():
+    while True:
+        await asyncio.sleep(CHAT_RETENTION_INTERVAL)
+        try:
+            result = await compact_chat_history()
+            if result: log_chat.info("retention: %s", result)
+        except Exception as e:
+            log_chat.error("retention %s: %s", type(e).__name__, e)
 
 
 # =============================================================
@@ -640,7 +1420,7 @@ def is_cbe_question(text, state=""):
     if len(text.strip()) > 3 and not text.strip().isdigit(): return True
     return False
 
-def pause_state(phone, current_state, save_fn): save_fn(phone, "state", f"PAUSED_{current_state}")
+async def pause_state(phone, current_state): await save_student("sms", phone, state=f"PAUSED_{current_state}")
 def get_paused_state(state): return state[len("PAUSED_"):] if (state and state.startswith("PAUSED_")) else None
 
 
@@ -656,6 +1436,10 @@ def calculate_pathway_from_scores(math, science, social, creative, technical):
     elif soc >= stem and soc >= arts: return "Social Sciences"
     else: return "Arts & Sports Science"
 
+# The cohort reports score in bulk with cohort.pathway_codes; keep the two in step.
+if cohort.verify_parity(calculate_pathway_from_scores):
+    raise ValueError("cohort.pathway_codes disagrees with calculate_pathway_from_scores")
+
 
 # =============================================================
 #  IMPROVEMENT SUGGESTIONS FALLBACK
@@ -684,41 +1468,78 @@ def get_improvement_suggestions(math, science, social, creative, technical, lang
 #  CAREER BUILDERS
 # =============================================================
 
-def get_career_list_sms(pathway, lang, grade):
+# Every career screen depends only on (pathway, lang[, grade | career]), so the
+# _build_* functions run once per combination at import and the get_* lookups
+# below are plain dict hits. Unknown keys fall through to the builder.
+
+def _build_career_list_sms(pathway, lang, grade):
     careers = SENIOR_CAREERS.get(pathway, SENIOR_CAREERS["STEM"])
-    msg = t(lang, "career_hdr", pathway=pathway, grade=grade)
-    for i, (name, demand, trend, *_) in enumerate(careers[:5], 1):
-        msg += f"{i}. {name}\n   {demand} | {trend}\n"
-    return msg + t(lang, "career_footer")
+    return "".join([t(lang, "career_hdr", pathway=pathway, grade=grade),
+                    *(f"{i}. {name}\n   {demand} | {trend}\n" for i, (name, demand, trend, *_) in enumerate(careers[:5], 1)),
+                    t(lang, "career_footer")])
 
-def get_all_careers_sms(pathway, lang):
+def _build_all_careers_sms(pathway, lang):
     careers = SENIOR_CAREERS.get(pathway, SENIOR_CAREERS["STEM"])
-    msg = t(lang, "all_career_hdr", pathway=pathway)
-    for i, (name, demand, *_) in enumerate(careers, 1):
-        msg += f"{i}. {name} — {demand}\n"
-    return msg + t(lang, "all_career_footer")
+    return "".join([t(lang, "all_career_hdr", pathway=pathway),
+                    *(f"{i}. {name} — {demand}\n" for i, (name, demand, *_) in enumerate(careers, 1)),
+                    t(lang, "all_career_footer")])
 
-def get_career_detail_sms(pathway, career_idx, lang):
+def _build_career_detail(pathway, career_idx, lang, key):
     careers = SENIOR_CAREERS.get(pathway, SENIOR_CAREERS["STEM"])
     if career_idx < 0 or career_idx >= len(careers): return t(lang, "invalid_career")
     name, demand, trend, subjects, unis, reqs = careers[career_idx]
-    return t(lang, "career_detail", name=name, demand=demand, trend=trend,
-             subjects=subjects, unis=unis, reqs=reqs)
+    return t(lang, key, name=name, demand=demand, trend=trend, subjects=subjects, unis=unis, reqs=reqs)
 
-def get_career_ussd_list(pathway):
+def _build_career_ussd_list(pathway):
     careers = SENIOR_CAREERS.get(pathway, SENIOR_CAREERS["STEM"])
-    lines = f"{pathway}\nSelect Career:\n"
-    for i, (name, demand, *_) in enumerate(careers[:6], 1):
-        lines += f"{i}. {name[:16]} {demand}\n"
-    return lines + "7. More careers"
+    return "".join([f"{pathway}\nSelect Career:\n",
+                    *(f"{i}. {name[:16]} {demand}\n" for i, (name, demand, *_) in enumerate(careers[:6], 1)),
+                    "7. More careers"])
+
+def _build_career_ussd_all(pathway):
+    careers = SENIOR_CAREERS.get(pathway, [])
+    return "".join([f"{pathway} — All:\n",
+                    *(f"{i}. {name[:15]} {demand}\n" for i, (name, demand, *_) in enumerate(careers, 1))])
+
+_ALL_GRADES = ("", *JSS_GRADES.values(), *SENIOR_GRADES.values())
+_CAREER_IDX = [(pw, i) for pw, careers in SENIOR_CAREERS.items() for i in range(len(careers))]
+CAREER_LIST_SMS   = {(pw, lang, gr): _build_career_list_sms(pw, lang, gr)
+                     for pw in SENIOR_CAREERS for lang in UI for gr in _ALL_GRADES}
+CAREER_ALL_SMS    = {(pw, lang): _build_all_careers_sms(pw, lang) for pw in SENIOR_CAREERS for lang in UI}
+CAREER_DETAIL_SMS = {(pw, i, lang): _build_career_detail(pw, i, lang, "career_detail")
+                     for pw, i in _CAREER_IDX for lang in UI}
+CAREER_USSD_END   = {(pw, i, lang): _build_career_detail(pw, i, lang, "ussd_career_end")
+                     for pw, i in _CAREER_IDX for lang in UI}
+CAREER_USSD_LIST  = {pw: _build_career_ussd_list(pw) for pw in SENIOR_CAREERS}
+CAREER_USSD_ALL   = {pw: _build_career_ussd_all(pw) for pw in SENIOR_CAREERS}
+RATE_PROMPTS      = {(channel, lang, key): t(lang, key, opts=opts)
+                     for channel, opts in (("sms", RATING_OPTIONS_SMS), ("ussd", RATING_OPTIONS_USSD))
+                     for lang in UI for key in ("rate_math", "rate_science", "rate_social",
+                                                "rate_creative", "rate_technical")}
+
+def get_career_list_sms(pathway, lang, grade):
+    return CAREER_LIST_SMS.get((pathway, lang, grade)) or _build_career_list_sms(pathway, lang, grade)
+
+def get_all_careers_sms(pathway, lang):
+    return CAREER_ALL_SMS.get((pathway, lang)) or _build_all_careers_sms(pathway, lang)
+
+def get_career_detail_sms(pathway, career_idx, lang):
+    return (CAREER_DETAIL_SMS.get((pathway, career_idx, lang))
+            or _build_career_detail(pathway, career_idx, lang, "career_detail"))
+
+def get_career_ussd_list(pathway):
+    return CAREER_USSD_LIST.get(pathway) or _build_career_ussd_list(pathway)
+
+def get_career_ussd_all(pathway):
+    return CAREER_USSD_ALL.get(pathway) or _build_career_ussd_all(pathway)
 
 def get_career_ussd_end(pathway, career_idx, lang):
     """Full career detail on USSD END screen — mirrors SMS detail."""
-    careers = SENIOR_CAREERS.get(pathway, SENIOR_CAREERS["STEM"])
-    if career_idx < 0 or career_idx >= len(careers): return t(lang, "invalid_career")
-    name, demand, trend, subjects, unis, reqs = careers[career_idx]
-    return t(lang, "ussd_career_end", name=name, demand=demand, trend=trend,
-             subjects=subjects, unis=unis, reqs=reqs)
+    return (CAREER_USSD_END.get((pathway, career_idx, lang))
+            or _build_career_detail(pathway, career_idx, lang, "ussd_career_end"))
+
+def rate_prompt(lang, key, channel="sms"):
+    return RATE_PROMPTS[(channel, lang if lang in UI else "en", key)]
 
 def score_summary(math, science, social, creative, technical):
     lb = {4:"E", 3:"M", 2:"A", 1:"B"}
@@ -728,44 +1549,593 @@ def score_summary(math, science, social, creative, technical):
 
 
 # =============================================================
-#  SMS DB HELPERS
+#  STUDENT STORE
 # =============================================================
 
-SMS_ALLOWED = {"lang","level","grade","term","pathway","math","science","social",
-               "creative","technical","career_interest","state","mode"}
+# One learners row per phone: the profile (language, assessment, pathway) is
+# shared by both channels; each channel keeps its own conversation state/mode.
+# Callers see a per-channel view with the historic column order, where
+# "state"/"mode" are that channel's columns.
+STUDENT_PROFILE = ("lang","level","grade","term","pathway","math","science","social",
+                   "creative","technical","career_interest")
+STUDENT_ALLOWED = {*STUDENT_PROFILE, "state", "mode"}
+STUDENT_COLS = "phone," + ",".join(STUDENT_PROFILE) + ",state,mode"
+LEARNER_COLS = "phone," + ",".join(STUDENT_PROFILE) + ",sms_state,sms_mode,ussd_state,ussd_mode"
 
-def sms_save(phone, field, value):
-    if field not in SMS_ALLOWED: raise ValueError(f"Invalid field: {field}")
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("INSERT INTO students(phone) VALUES(%s) ON CONFLICT DO NOTHING", (phone,))
-    cur.execute(f"UPDATE students SET {field}=%s WHERE phone=%s", (value, phone))
-    conn.commit(); cur.close(); conn.close()
 
-def sms_get(phone):
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("""SELECT phone,lang,level,grade,term,pathway,math,science,social,
-                          creative,technical,career_interest,state,mode
-                   FROM students WHERE phone=%s""", (phone,))
-    s = cur.fetchone(); cur.close(); conn.close(); return s
+class RedisRowBackend:
+    """Shared row cache so several uvicorn workers see each other's writes.
+    Needs the optional `redis` package; enabled by setting STUDENT_CACHE_URL."""
+
+    def __init__(self, url, ttl):
+        import redis.asyncio as redis
+        self._r = redis.from_url(url); self.ttl = int(ttl)
+
+    async def get(self, key):
+        raw = await self._r.get(f"student:{key[0]}:{key[1]}")
+        return tuple(json.loads(raw)) if raw else None
+
+    async def set(self, key, row):
+        await self._r.set(f"student:{key[0]}:{key[1]}", json.dumps(row), ex=self.ttl)
+
+    async def delete(self, key):
+        await self._r.delete(f"student:{key[0]}:{key[1]}")
+
+
+class StudentCache:
+    """Bounded LRU + TTL cache of student rows keyed by (channel, phone).
+
+    Rows are written through on every save (from the upsert's RETURNING), so
+    a warm session never reads Postgres. With a shared backend configured the
+    backend is the cache of record and the local LRU is bypassed, otherwise a
+    worker could serve a row another worker has since changed.
+    """
+
+    def __init__(self, maxsize, ttl, backend=None):
+        self.maxsize = maxsize; self.ttl = ttl; self.backend = backend
+        self._rows = OrderedDict()
+        self.hits = 0; self.misses = 0
+
+    async def get(self, key):
+        if self.backend:
+            try: row = await self.backend.get(key)
+            except Exception as e: log_cache.warning("backend get failed: %s", e); row = None
+        else:
+            entry = self._rows.get(key); row = None
+            if entry and entry[0] > time.monotonic():
+                self._rows.move_to_end(key); row = entry[1]
+            elif entry:
+                del self._rows[key]
+        if row is None: self.misses += 1
+        else: self.hits += 1
+        return row
+
+    async def put(self, key, row):
+        if self.backend:
+            try: await self.backend.set(key, row)
+            except Exception as e: log_cache.warning("backend set failed: %s", e)
+            return
+        self._rows[key] = (time.monotonic() + self.ttl, row)
+        self._rows.move_to_end(key)
+        while len(self._rows) > self.maxsize: self._rows.popitem(last=False)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._rows)}
+
+
+# Without a shared backend each worker would keep its own copy of a learner's row and could
+# answer from a state another worker has since moved on from; one worker per process is safe.
+if WEB_WORKERS > 1 and not STUDENT_CACHE_URL:
+    log_cache.warning("%d workers and no STUDENT_CACHE_URL: student row cache disabled", WEB_WORKERS)
+student_cache = StudentCache(STUDENT_CACHE_SIZE if WEB_WORKERS == 1 or STUDENT_CACHE_URL else 0, STUDENT_CACHE_TTL,
+                             RedisRowBackend(STUDENT_CACHE_URL, STUDENT_CACHE_TTL) if STUDENT_CACHE_URL else None)
+
+async def _cache_learner(row):
+    """Cache both channel views of a learners row; returns them by channel."""
+    n = 1 + len(STUDENT_PROFILE)
+    views = {"sms": tuple(row[:n]) + tuple(row[n:n + 2]), "ussd": tuple(row[:n]) + tuple(row[n + 2:n + 4])}
+    for channel, view in views.items(): await student_cache.put((channel, row[0]), view)
+    return views
+
+async def get_student(channel, phone):
+    row = await student_cache.get((channel, phone))
+    if row is None:
+        full = await db_fetchone(f"SELECT {LEARNER_COLS} FROM learners WHERE phone=%s", (phone,))
+        if full: row = (await _cache_learner(full))[channel]
+    return row
+
+async def save_student(channel, phone, **fields):
+    """Write every field changed this turn as one upsert (one statement, one commit)."""
+    for field in fields:
+        if field not in STUDENT_ALLOWED: raise ValueError(f"Invalid field: {field}")
+    cols = [f"{channel}_{f}" if f in ("state", "mode") else f for f in fields] + ["last_channel"]
+    sets = ",".join(f"{c}=EXCLUDED.{c}" for c in cols) + ",updated_at=NOW()"
+    row = await db_fetchone(f"INSERT INTO learners(phone,{','.join(cols)}) VALUES(%s{',%s' * len(cols)}) "
+                            f"ON CONFLICT (phone) DO UPDATE SET {sets} RETURNING {LEARNER_COLS}",
+                            (phone, *fields.values(), channel))
+    await _cache_learner(row)
+
+
+# =============================================================
+#  OUTBOUND SMS
+#  Identical bodies queued within SMS_BATCH_WINDOW go out as one
+#  multi-recipient API call (canned topic answers, "done" texts,
+#  career sheets). Only a body that already went out in the last
+#  SMS_BATCH_HOT seconds waits for the window; a one-off reply, and
+#  each numbered part of a long one, is sent at once. Calls are
+#  paced by a token bucket.
+# =============================================================
+
+# The Africa's Talking SDK is blocking (requests under the hood), so sends run on
+# a small dedicated pool. A slow gateway then only ties up SMS_WORKERS threads
+# instead of the event loop serving every other /sms and /ussd request.
+_sms_executor = ThreadPoolExecutor(max_workers=SMS_WORKERS, thread_name_prefix="sms")
+
+
+class FakeSMSGateway:
+    """Stand-in for africastalking.SMS: records sends and answers like the real API."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency; self.sent = []
+
+    def send(self, message, recipients, sender_id=None):
+        if self.latency: time.sleep(self.latency)
+        self.sent.append((message, list(recipients)))
+        return {"SMSMessageData": {"Message": f"Sent to {len(recipients)}/{len(recipients)}",
+                                   "Recipients": [{"number": r, "status": "Success", "statusCode": 101,
+                                                   "messageId": f"fake-{len(self.sent)}-{i}"}
+                                                  for i, r in enumerate(recipients)]}}
+
+
+class AfricasTalkingGateway:
+    """africastalking.SMS, imported and initialised on the first send instead of at import."""
+
+    def __init__(self, username, api_key):
+        self.username = username; self.api_key = api_key
+        self._sms = None; self._lock = threading.Lock()
+
+    def send(self, message, recipients, sender_id=None):
+        if self._sms is None:
+            with self._lock:                    # sends arrive on several executor threads
+                if self._sms is None:
+                    import africastalking
+                    africastalking.initialize(username=self.username, api_key=self.api_key)
+                    self._sms = africastalking.SMS
+        return self._sms.send(message=message, recipients=recipients, sender_id=sender_id)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate; self.capacity = burst; self.tokens = float(burst)
+        self.updated = time.monotonic(); self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1: self.tokens -= 1; return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SMSDispatcher:
+    """Coalesces identical outbound bodies into multi-recipient sends.
+
+    send() resolves with that recipient's entry from the gateway response
+    (status, statusCode, messageId, ...) or {"status": "Failed", "error": ...}.
+    """
+
+    def __init__(self, gateway, window, max_recipients, bucket, hot_for=SMS_BATCH_HOT):
+        self.gateway = gateway; self.window = window
+        self.max_recipients = max_recipients; self.bucket = bucket; self.hot_for = hot_for
+        self._pending: dict[str, list] = {}
+        self._recent: OrderedDict[str, float] = OrderedDict()   # body -> when it last went out
+        self._flushes: set[asyncio.Task] = set()
+        self.stats = {"messages": 0, "api_calls": 0, "failed": 0}
+
+    async def send(self, phone, message):
+        fut = asyncio.get_running_loop().create_future()
+        batch = self._pending.setdefault(message, [])
+        batch.append((phone, fut)); self.stats["messages"] += 1
+        if len(batch) == 1 or len(batch) >= self.max_recipients:
+            delay = self.window if len(batch) == 1 and self._hot(message) else 0
+            task = asyncio.create_task(self._flush(message, delay))
+            self._flushes.add(task); task.add_done_callback(self._flushes.discard)
+        return await fut
+
+    def _hot(self, message):
+        """Whether message went out recently enough that others are likely to follow."""
+        now = time.monotonic()
+        while self._recent and now - next(iter(self._recent.values())) > self.hot_for:
+            self._recent.popitem(last=False)
+        return message in self._recent
+
+    async def _flush(self, message, delay):
+        if delay: await asyncio.sleep(delay)
+        batch = self._pending.pop(message, None)
+        self._recent[message] = time.monotonic(); self._recent.move_to_end(message)
+        while batch:
+            chunk, batch = batch[:self.max_recipients], batch[self.max_recipients:]
+            await self._send_chunk(message, chunk)
+
+    async def _send_chunk(self, message, chunk):
+        await self.bucket.acquire()
+        self.stats["api_calls"] += 1
+        phones = list(dict.fromkeys(p for p, _ in chunk))
+        try:
+            resp = await asyncio.get_running_loop().run_in_executor(
+                _sms_executor, partial(self.gateway.send, message=message, recipients=phones, sender_id=SENDER_ID))
+            by_number = {r.get("number"): r for r in resp.get("SMSMessageData", {}).get("Recipients", [])}
+        except Exception as e:
+            by_number = {}; error = f"{type(e).__name__}: {e}"
+        else:
+            error = resp.get("SMSMessageData", {}).get("Message", "no recipient status")
+        for phone, fut in chunk:
+            result = by_number.get(phone) or {"number": phone, "status": "Failed", "error": error}
+            if result.get("status") != "Success": self.stats["failed"] += 1
+            if not fut.done(): fut.set_result(result)
+
+    async def drain(self):
+        for message in list(self._pending):
+            self._flushes.add(asyncio.create_task(self._flush(message, 0)))
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+sms_dispatcher = SMSDispatcher(
+    FakeSMSGateway(float(SMS_FAKE_LATENCY)) if SMS_FAKE_LATENCY else AfricasTalkingGateway(AT_USERNAME, AT_API_KEY),
+    SMS_BATCH_WINDOW, SMS_BATCH_MAX, TokenBucket(SMS_RATE, SMS_BURST))
+
+
+# =============================================================
+#  SMS REPLIES
+# =============================================================
+
+def sms_text(message, lang):
+    """Transliterate to GSM-7 for languages where that's switched on (SMS_GSM7_LANGS)."""
+    return smstext.transliterate(message) if lang in SMS_GSM7_LANGS else message
+
+
+class SMSStreamer:
+    """Buffers streamed text and sends each part as soon as it is complete.
+
+    A part is cut at a sentence (else word) boundary once the buffer holds more
+    than SMS_PART_SEGMENTS segments. Sends are chained so the stream keeps being
+    read while a part is in flight, and parts still leave in order.
+    """
+
+    def __init__(self, phone, lang, header=""):
+        self.phone = phone; self.lang = lang; self.buf = sms_text(header, lang)
+        self.started = False; self._last: asyncio.Task | None = None
+        self.unsent: list[str] = []      # from the first refused part on, queued by close()
+
+    async def feed(self, text):
+        self.buf += sms_text(text, self.lang); self.started = True
+        while smstext.segments(self.buf) > SMS_PART_SEGMENTS:
+            cut = smstext.fit(self.buf, SMS_PART_SEGMENTS)
+            self._send(self.buf[:cut].strip()); self.buf = self.buf[cut:]
+
+    def _send(self, piece):
+        if not piece: return
+        prev = self._last
+        async def chained():
+            if prev: await prev
+            if self.unsent: self.unsent.append(piece); return       # stay behind the refused part
+            try: await send_reply(self.phone, piece, self.lang)
+            except SMSSendError: self.unsent.append(piece)
+        self._last = asyncio.create_task(chained())
+
+    async def close(self):
+        """Send what is left; parts the gateway refused go out as a send_sms job, so a retry
+        neither repeats the parts already delivered nor asks Gemini again."""
+        self._send(self.buf.strip()); self.buf = ""
+        if self._last: await self._last
+        if self.unsent:
+            log_sms.warning("%d part(s) refused, queued", len(self.unsent), extra={"phone": self.phone})
+            await enqueue_job("send_sms", phone=self.phone, messages=self.unsent, lang=self.lang)
+
+
+sms_billing = {"messages": 0, "parts": 0, "segments": 0, "segments_saved": 0}
+
+class SMSSendError(RuntimeError):
+    """The gateway did not accept a part; raised so a job retries the send."""
+
+
+def sms_parts(message, lang):
+    return smstext.split(sms_text(message, lang), SMS_PART_SEGMENTS)
+
+async def send_reply(to_phone, message, lang="en", skip=0, on_part=None):
+    """Send message in the cheapest encoding, as numbered parts if it is long.
+
+    Raises SMSSendError on the first part the gateway doesn't accept. skip leaves
+    out parts already delivered; on_part(i) is awaited once part i is accepted.
+    """
+    text = sms_text(message, lang)
+    parts = smstext.split(text, SMS_PART_SEGMENTS)
+    segs = sum(smstext.segments(p) for p in parts[skip:])
+    sms_billing["messages"] += not skip; sms_billing["parts"] += len(parts[skip:]); sms_billing["segments"] += segs
+    if text != message and not skip:
+        sms_billing["segments_saved"] += max(0, smstext.segments(message) - smstext.segments(text))
+    with stage("sms_send"):
+        for i, part in enumerate(parts):
+            if i < skip: continue
+            result = await sms_dispatcher.send(to_phone, part)
+            if result.get("status") != "Success":
+                raise SMSSendError(result.get("error") or result.get("status") or "send failed")
+            if on_part: await on_part(i)
+    log_sms.info("out (%d part(s), %d seg): %.120s", len(parts) - skip, segs, text, extra={"phone": to_phone})
+
+# =============================================================
+#  FLOW ENGINE
+#  The assessment flow, written once for SMS and USSD. FLOW maps a
+#  state to its rule: `options` validates the reply (a lookup table
+#  such as RATING_MAP/TERMS), `field` is where the parsed value
+#  goes, `next` is the following state (or a table per value or per
+#  channel, or a function of the session), `error` is the UI key for
+#  bad input. SCREENS renders each state's prompt per channel. The
+#  few states that really differ by channel (TECH outcome, career
+#  pickers, DONE) are handlers with the same result shape. A step
+#  is one dict lookup: flow_step(channel, state, reply, fields) ->
+#  (next state, screen, side effects, final) or None for a state
+#  the flow doesn't know. Side effects are (job kind, payload);
+#  each webhook decides whether to run or enqueue them.
+# =============================================================
+
+STUDENT_FIELDS = STUDENT_COLS.split(",")
+USSD_LANG_SCREEN = "Welcome / Karibu\nEduTena CBE\n\nChagua / Select:\n1. English\n2. Kiswahili\n3. Kiluhya\n4. Gĩkũyũ"
+CAREER_PICK = {"CAREER_SELECT": 5, "CAREER_SELECT_ALL": 10, "USSD_CAREER_SELECT": 6, "USSD_CAREER_SELECT_ALL": 10}
+
+def student_fields(row) -> dict:
+    return dict(zip(STUDENT_FIELDS, row)) if row else {}
+
+def _lang(f): return f.get("lang") if f.get("lang") in UI else "en"
+
+def _per(value, channel):
+    return value[channel] if isinstance(value, dict) and channel in value else value
+
+def _rate_screen(key):
+    return lambda ch, lang, f: rate_prompt(lang, key, ch)
+
+SCREENS = {
+    "LANG":           {"sms": lambda ch, lang, f: t("en","welcome_lang"), "ussd": lambda ch, lang, f: USSD_LANG_SCREEN},
+    "MODE_SELECT":    {"sms": "mode_select", "ussd": "mode_ussd_2"},
+    "RAG_CHAT":       "rag_welcome",
+    "USSD_RAG_TOPIC": "ussd_rag_menu",
+    "LEVEL":          "welcome",
+    "JSS_GRADE":      "jss_grade",
+    "SENIOR_GRADE":   "senior_grade",
+    "TERM":           "term",
+    "SENIOR_PATHWAY": "senior_pathway",
+    "MATH":     _rate_screen("rate_math"),
+    "SCIENCE":  _rate_screen("rate_science"),
+    "SOCIAL":   _rate_screen("rate_social"),
+    "CREATIVE": _rate_screen("rate_creative"),
+    "TECH":     _rate_screen("rate_technical"),
+    "CAREER_SELECT":          lambda ch, lang, f: get_career_list_sms(f.get("pathway") or "", lang, f.get("grade") or ""),
+    "CAREER_SELECT_ALL":      lambda ch, lang, f: get_all_careers_sms(f.get("pathway") or "", lang),
+    "USSD_CAREER_SELECT":     lambda ch, lang, f: get_career_ussd_list(f.get("pathway")),
+    "USSD_CAREER_SELECT_ALL": lambda ch, lang, f: get_career_ussd_all(f.get("pathway")),
+}
+
+def flow_render(channel, state, f) -> str | None:
+    """Prompt for state on channel, or None if the state has no screen of its own."""
+    screen = _per(SCREENS.get(state), channel)
+    if screen is None: return None
+    return t(_lang(f), screen) if isinstance(screen, str) else screen(channel, _lang(f), f)
+
+def _tech_outcome(ch, f, lang):
+    gr = f.get("grade") or ""; tv = f.get("term") or ""
+    m,sci,so,cr,tc = (f.get(k) for k in ("math","science","social","creative","technical"))
+    if gr == "Grade 9":
+        pw = f["pathway"] = calculate_pathway_from_scores(m,sci,so,cr,tc)
+        if ch == "sms": return "DONE", t(lang,"pathway_msg",pathway=pw), [], False
+        scores_d = {"Math":m or 0,"Science":sci or 0,"Social":so or 0,"Creative":cr or 0,"Technical":tc or 0}
+        top_str = " & ".join(n for n,_ in sorted(scores_d.items(), key=lambda x:-x[1])[:2])
+        return "RESULT", t(lang,"ussd_pathway_result", pathway=pw, top=top_str,
+                           summary=score_summary(m,sci,so,cr,tc)), [], False
+    job = ("jss_suggestions", {"grade": gr, "term": tv, "math": m, "sci": sci, "soc": so, "cre": cr,
+                               "tec": tc, "lang": lang})
+    if ch == "sms": return "DONE", "", [job], False        # the suggestions are the reply
+    scores_d = {"Math":m or 0,"Science":sci or 0,"Social Studies":so or 0,"Creative Arts":cr or 0,"Technical":tc or 0}
+    sorted_sc = sorted(scores_d.items(),key=lambda x:-x[1])
+    weak_list = [n for n,v in sorted_sc if v<=2]
+    weak_str  = ", ".join(weak_list[:2]) if weak_list else ("None" if lang=="en" else "Hakuna")
+    return "DONE", t(lang,"ussd_jss_result",grade=gr,term=tv,strongest=sorted_sc[0][0],weak=weak_str), [job], False
+
+def _flow_reset(ch, f):
+    f.clear(); return "LANG", flow_render(ch, "LANG", f), [], False
+
+def _rag_topic(ch, step, f, lang):
+    if step in USSD_RAG_TOPICS:
+        job = ("rag_answer", {"question": USSD_RAG_TOPICS[step], "lang": lang, "history_turns": 0})
+        return "DONE", t(lang,"ussd_rag_sending"), [job], True
+    if step == "6": return "DONE", t(lang,"ussd_rag_sms_tip"), [], True
+    return "USSD_RAG_TOPIC", t(lang,"ussd_rag_menu"), [], False
+
+def _result(ch, step, f, lang):
+    f["pathway"] = f.get("pathway") or calculate_pathway_from_scores(
+        *(f.get(k) for k in ("math","science","social","creative","technical")))
+    nxt = {"1": "USSD_CAREER_SELECT", "2": "USSD_CAREER_SELECT_ALL"}.get(step)
+    if nxt: return nxt, flow_render(ch, nxt, f), [], False
+    if step == "3": return _flow_reset(ch, f)
+    return "RESULT", t(lang,"thank_you"), [], True
+
+def _career_pick(state):
+    def handler(ch, step, f, lang):
+        pw = f.get("pathway")
+        if not pw: return state, t(lang,"no_pathway"), [], False
+        if step.isdigit() and 1 <= int(step) <= CAREER_PICK[state]:
+            idx = int(step)-1
+            f["career_interest"] = SENIOR_CAREERS[pw][idx][0]
+            job = ("career_detail", {"pathway": pw, "career_idx": idx, "lang": lang, "grade": f.get("grade") or ""})
+            if ch == "sms": return "DONE", "", [job], False    # detail + narrative go out as the effect
+            return "DONE", get_career_ussd_end(pw,idx,lang), [job], True
+        more = {"CAREER_SELECT": ("MORE", "CAREER_SELECT_ALL"), "USSD_CAREER_SELECT": ("7", "USSD_CAREER_SELECT_ALL")}
+        if state in more and step.upper() == more[state][0]:
+            return more[state][1], flow_render(ch, more[state][1], f), [], False
+        if ch == "sms": return state, t(lang,"invalid_career"), [], False
+        return state, flow_render(ch, state, f), [], False
+    return handler
+
+def _done(ch, step, f, lang):
+    if ch == "sms": return "DONE", t(lang,"done"), [], False
+    if step == "1": return _flow_reset(ch, f)
+    return "DONE", t(lang,"thank_you"), [], True
+
+def _rating(field, nxt):
+    return {"options": RATING_MAP, "field": field, "next": nxt, "error": "invalid_rating"}
+
+FLOW = {
+    "LANG":           {"options": LANG_MAP, "field": "lang", "next": "MODE_SELECT",
+                       "error": {"sms": "welcome_lang", "ussd": "invalid_lang"}, "error_lang": "en"},
+    "MODE_SELECT":    {"options": {"1": "assessment", "2": "rag"}, "field": "mode",
+                       "next": {"assessment": "LEVEL", "rag": {"sms": "RAG_CHAT", "ussd": "USSD_RAG_TOPIC"}},
+                       "error": {"sms": "mode_err", "ussd": "mode_ussd_err"}},
+    "LEVEL":          {"options": {"1": "JSS", "2": "Senior"}, "field": "level",
+                       "next": {"JSS": "JSS_GRADE", "Senior": "SENIOR_GRADE"}, "error": "level_err"},
+    "JSS_GRADE":      {"options": JSS_GRADES, "field": "grade", "next": "TERM", "error": "grade_err"},
+    "SENIOR_GRADE":   {"options": SENIOR_GRADES, "field": "grade", "next": "SENIOR_PATHWAY", "error": "grade_err"},
+    "TERM":           {"options": TERMS, "field": "term", "next": "MATH", "error": "term_err"},
+    "SENIOR_PATHWAY": {"options": PATHWAYS, "field": "pathway", "error": "pathway_err",
+                       "next": {"sms": "CAREER_SELECT", "ussd": "USSD_CAREER_SELECT"}},
+    "MATH":     _rating("math", "SCIENCE"),
+    "SCIENCE":  _rating("science", "SOCIAL"),
+    "SOCIAL":   _rating("social", "CREATIVE"),
+    "CREATIVE": _rating("creative", "TECH"),
+    "TECH":     _rating("technical", _tech_outcome),
+    "USSD_RAG_TOPIC": _rag_topic,
+    "RESULT":         _result,
+    **{state: _career_pick(state) for state in CAREER_PICK},
+    "DONE":           _done,
+}
+
+def flow_step(channel, state, step, f):
+    """Apply one reply to the session fields f (updated in place)."""
+    rule = FLOW.get(state)
+    if rule is None: return None
+    if callable(rule): return rule(channel, step, f, _lang(f))
+    value = rule["options"].get(step)
+    if not value: return state, t(rule.get("error_lang") or _lang(f), _per(rule["error"], channel)), [], False
+    f[rule["field"]] = value
+    nxt = rule["next"]
+    if isinstance(nxt, dict) and value in nxt: nxt = nxt[value]
+    nxt = _per(nxt, channel)
+    if callable(nxt): return nxt(channel, f, _lang(f))
+    return nxt, flow_render(channel, nxt, f), [], False
 
-async def send_reply(to_phone, message):
-    try:
-        sms_service.send(message=message, recipients=[to_phone], sender_id=SENDER_ID)
-        print(f"[SMS] → {to_phone[:7]}****: {message[:120]}")
-    except Exception as e:
-        print(f"[SMS] failed: {e}")
 
 def get_resume_prompt(original_state, lang, student):
-    m = {"LANG": t(lang,"welcome_lang"), "LEVEL": t(lang,"welcome"),
-         "JSS_GRADE": t(lang,"jss_grade"), "SENIOR_GRADE": t(lang,"senior_grade"),
-         "TERM": t(lang,"term"), "SENIOR_PATHWAY": t(lang,"senior_pathway"),
-         "MATH": t(lang,"rate_math",opts=RATING_OPTIONS_SMS),
-         "SCIENCE": t(lang,"rate_science",opts=RATING_OPTIONS_SMS),
-         "SOCIAL": t(lang,"rate_social",opts=RATING_OPTIONS_SMS),
-         "CREATIVE": t(lang,"rate_creative",opts=RATING_OPTIONS_SMS),
-         "TECH": t(lang,"rate_technical",opts=RATING_OPTIONS_SMS),
-         "CAREER_SELECT": get_career_list_sms(student[5] or "", lang, student[3] or "")}
-    return m.get(original_state, t(lang, "resume_fallback"))
+    return flow_render("sms", original_state, student_fields(student)) or t(lang, "resume_fallback")
+
+
+# =============================================================
+#  INBOUND GUARD
+#  A post already seen within INBOUND_DEDUPE_WINDOW is a gateway
+#  retry and is dropped. For SMS the key is Africa's Talking's
+#  message id, or, when a post has none, (phone, the learner's
+#  current state, text): the same digit answering two different
+#  questions is two answers, the same text at the same step is a
+#  repeat. For USSD it is (sessionId, input path). Each phone
+#  also has a token bucket (INBOUND_RATE, INBOUND_BURST) shared by
+#  SMS and new USSD sessions; the first refused post is answered
+#  with "slow down", later ones are dropped until the bucket
+#  refills. State is in memory per worker, or in redis when
+#  INBOUND_GUARD_URL is set; a failing backend falls back to
+#  memory rather than blocking traffic.
+# =============================================================
+
+class RedisGuardBackend:
+    """Dedupe keys and per-phone buckets shared by every worker. Needs the optional `redis` package."""
+
+    TAKE = """
+        local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local b = redis.call('HMGET', KEYS[1], 't', 'ts', 'w')
+        local t = math.min(burst, (tonumber(b[1]) or burst) + math.max(0, now - (tonumber(b[2]) or now)) * rate)
+        local verdict, warned = 1, 0
+        if t >= 1 then t = t - 1
+        elseif b[3] == '1' then verdict, warned = -1, 1
+        else verdict, warned = 0, 1 end
+        redis.call('HSET', KEYS[1], 't', t, 'ts', now, 'w', warned)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return verdict
+    """
+    VERDICTS = {1: "ok", 0: "notify", -1: "drop"}
+
+    def __init__(self, url):
+        import redis.asyncio as redis
+        self._r = redis.from_url(url); self._take = self._r.register_script(self.TAKE)
+
+    async def claim(self, key, ttl):
+        return bool(await self._r.set(f"inbound:{key}", 1, nx=True, ex=max(1, round(ttl))))
+
+    async def release(self, key):
+        await self._r.delete(f"inbound:{key}")
+
+    async def take(self, phone, rate, burst):
+        return self.VERDICTS[int(await self._take(keys=[f"bucket:{phone}"], args=[rate, burst, time.time()]))]
+
+
+class InboundGuard:
+    """Idempotency window plus per-phone token buckets; `shed` counts what was dropped."""
+
+    def __init__(self, window, rate, burst, maxsize, backend=None):
+        self.window = window; self.rate = rate; self.burst = burst
+        self.maxsize = maxsize; self.backend = backend
+        self._seen: OrderedDict[str, float] = OrderedDict()     # key -> expiry
+        self._buckets: OrderedDict[str, list] = OrderedDict()   # phone -> [tokens, updated, warned]
+        self.shed = {"sms_duplicate": 0, "sms_rate_limited": 0, "ussd_duplicate": 0, "ussd_rate_limited": 0}
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.blake2b("\0".join(parts).encode(), digest_size=12).hexdigest()
+
+    async def first(self, key) -> bool:
+        """True unless key was already seen within the window."""
+        if not self.window: return True
+        if self.backend:
+            try: return await self.backend.claim(key, self.window)
+            except Exception as e: log_cache.warning("guard backend claim failed: %s", e)
+        now = time.monotonic()
+        expiry = self._seen.get(key)
+        if expiry and expiry > now: return False
+        self._seen[key] = now + self.window; self._seen.move_to_end(key)
+        while self._seen and (len(self._seen) > self.maxsize or next(iter(self._seen.values())) <= now):
+            self._seen.popitem(last=False)
+        return True
+
+    async def release(self, key):
+        """Forget a claimed key whose post failed, so its retry is handled."""
+        if not key or not self.window: return
+        if self.backend:
+            try: await self.backend.release(key); return
+            except Exception as e: log_cache.warning("guard backend release failed: %s", e)
+        self._seen.pop(key, None)
+
+    async def allow(self, phone) -> str:
+        """Take a token from phone's bucket: "ok", or "notify" for the first refusal since the last
+        accepted post and "drop" for the ones after it."""
+        if not self.rate: return "ok"
+        if self.backend:
+            try: return await self.backend.take(phone, self.rate, self.burst)
+            except Exception as e: log_cache.warning("guard backend take failed: %s", e)
+        now = time.monotonic()
+        b = self._buckets.get(phone)
+        if b is None:
+            b = self._buckets[phone] = [float(self.burst), now, False]
+            if len(self._buckets) > self.maxsize: self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(phone)
+        b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate); b[1] = now
+        if b[0] >= 1: b[0] -= 1; b[2] = False; return "ok"
+        if b[2]: return "drop"
+        b[2] = True; return "notify"
+
+    def stats(self) -> dict:
+        return {**self.shed, "keys": len(self._seen), "phones": len(self._buckets)}
+
+
+inbound_guard = InboundGuard(INBOUND_DEDUPE_WINDOW, INBOUND_RATE, INBOUND_BURST, INBOUND_TRACK_MAX,
+                             RedisGuardBackend(INBOUND_GUARD_URL) if INBOUND_GUARD_URL else None)
 
 
 # =============================================================
@@ -773,217 +2143,404 @@ def get_resume_prompt(original_state, lang, student):
 # =============================================================
 
 @app.post("/sms", response_class=PlainTextResponse)
-async def receive_sms(from_: str = Form(..., alias="from"), text: str = Form(...)):
-    phone = from_; text_clean = text.strip(); text_upper = text_clean.upper()
-    print(f"[SMS] from {phone[:7]}****: {text_clean}")
-    student = sms_get(phone)
+async def receive_sms(from_: str = Form(..., alias="from"), text: str = Form(...),
+                      msg_id: str = Form(default="", alias="id")):
+    ctx = begin_request("sms"); started = time.perf_counter()
+    try: return await handle_sms(ctx, from_, text, msg_id)
+    finally: end_request(ctx, time.perf_counter() - started)
+
+async def handle_sms(ctx, phone, text, msg_id=""):
+    text_clean = text.strip()
+    log_sms.info("in: %s", text_clean, extra={"phone": phone})
+    key = InboundGuard.key("sms", phone, msg_id) if msg_id else None
+    if key and not await inbound_guard.first(key):
+        ctx.state = "DUPLICATE"; inbound_guard.shed["sms_duplicate"] += 1; return ""
+    student = None
+    try:
+        verdict = await inbound_guard.allow(phone)
+        if verdict != "ok":                  # refused before any DB read: only "notify" needs the language
+            ctx.state = "RATE_LIMITED"; inbound_guard.shed["sms_rate_limited"] += 1
+            if verdict == "notify":
+                student = await get_student("sms", phone)
+                lang = student[1] if student and student[1] in UI else "en"
+                await send_reply(phone, t(lang,"slow_down"), lang)
+            return ""
+        student = await get_student("sms", phone)
+        if not key:
+            key = InboundGuard.key("sms", phone, (student[12] or "") if student else "", text_clean)
+            if not await inbound_guard.first(key):
+                ctx.state = "DUPLICATE"; inbound_guard.shed["sms_duplicate"] += 1; return ""
+        await sms_turn(ctx, phone, text_clean, student)
+    except Exception:
+        log_sms.exception("turn failed", extra={"phone": phone})
+        await sms_turn_failed(phone, key, student)
+    return ""
+
+async def sms_turn_failed(phone, key, before):
+    """Answer a turn that raised from whatever it managed to save.
+
+    sms_turn saves the next state before sending its prompt, so the learner
+    may already have moved on: re-read the row and repeat the question they
+    are at now. The dedupe key is only released if the state didn't move,
+    so a resend can't answer the next question with the same text.
+    """
+    try: student = await get_student("sms", phone)
+    except Exception: student = before
+    state = student[12] if student else None
+    if state == (before[12] if before else None): await inbound_guard.release(key)
+    lang = student[1] if student and student[1] in UI else "en"
+    prompt = state and flow_render("sms", state, student_fields(student))
+    try: await send_reply(phone, t(lang,"error") + (f"\n\n{prompt}" if prompt else ""), lang)
+    except SMSSendError: pass            # still answer the gateway 200, so it doesn't retry a half-done turn
+
+async def sms_turn(ctx, phone, text_clean, student):
+    text_upper = text_clean.upper()
     if text_upper == "START" or not student:
-        sms_save(phone, "state", "LANG"); sms_save(phone, "mode", "")
-        await send_reply(phone, t("en","welcome_lang")); return ""
+        ctx.state = "START"
+        await save_student("sms", phone, state="LANG", mode="")
+        await send_reply(phone, t("en","welcome_lang")); return
     lang  = student[1] if student[1] in UI else "en"
-    state = student[12]; mode = student[13] or ""
+    state = student[12] or "DONE"; mode = student[13] or ""   # no SMS state yet: learner came from USSD
+    ctx.state = state
     if text_upper == "MENU":
-        sms_save(phone, "state", "MODE_SELECT"); sms_save(phone, "mode", "")
-        await send_reply(phone, t(lang,"mode_select")); return ""
+        await save_student("sms", phone, state="MODE_SELECT", mode="")
+        await send_reply(phone, t(lang,"mode_select"), lang); return
     # RAG mode
     if state == "RAG_CHAT" or mode == "rag":
-        if state != "RAG_CHAT": sms_save(phone, "state", "RAG_CHAT")
-        await send_reply(phone, await ask_gemini_rag(phone, text_clean, lang)); return ""
+        if state != "RAG_CHAT": await save_student("sms", phone, state="RAG_CHAT")
+        await reply_gemini_rag(phone, text_clean, lang); return
     # RESUME
     if text_upper == "RESUME":
         orig = get_paused_state(state)
-        if orig: sms_save(phone, "state", orig); await send_reply(phone, get_resume_prompt(orig, lang, student))
-        else: await send_reply(phone, t(lang,"done"))
-        return ""
+        if orig: await save_student("sms", phone, state=orig); await send_reply(phone, get_resume_prompt(orig, lang, student), lang)
+        else: await send_reply(phone, t(lang,"done"), lang)
+        return
     # Paused
     paused_orig = get_paused_state(state)
     if paused_orig:
         if is_cbe_question(text_clean):
-            await send_reply(phone, await ask_gemini(phone, text_clean, lang=lang, context_state=paused_orig))
+            await send_reply(phone, await ask_gemini(phone, text_clean, lang=lang, context_state=paused_orig), lang)
         else:
-            await send_reply(phone, t(lang,"paused"))
-        return ""
+            await send_reply(phone, t(lang,"paused"), lang)
+        return
     # Mid-flow question
     if is_cbe_question(text_clean, state=state):
-        pause_state(phone, state, sms_save)
-        await send_reply(phone, await ask_gemini(phone, text_clean, lang=lang, context_state=state))
-        return ""
+        await pause_state(phone, state)
+        await send_reply(phone, await ask_gemini(phone, text_clean, lang=lang, context_state=state), lang)
+        return
     # MORE / CAREERS
-    if text_upper == "MORE":
-        pw = student[5]
-        if not pw: await send_reply(phone, t(lang,"no_pathway")); return ""
-        await send_reply(phone, get_all_careers_sms(pw, lang))
-        sms_save(phone, "state", "CAREER_SELECT_ALL"); return ""
-    if text_upper == "CAREERS":
-        pw = student[5]; gr = student[3] or ""
-        if not pw: await send_reply(phone, t(lang,"no_pathway")); return ""
-        await send_reply(phone, get_career_list_sms(pw, lang, gr))
-        sms_save(phone, "state", "CAREER_SELECT"); return ""
-    try:
-        if state == "LANG":
-            chosen = LANG_MAP.get(text_clean)
-            if not chosen: await send_reply(phone, t("en","welcome_lang")); return ""
-            sms_save(phone, "lang", chosen); sms_save(phone, "state", "MODE_SELECT")
-            await send_reply(phone, t(chosen, "mode_select"))
-        elif state == "MODE_SELECT":
-            if text_clean == "1":
-                sms_save(phone,"mode","assessment"); sms_save(phone,"state","LEVEL")
-                await send_reply(phone, t(lang,"welcome"))
-            elif text_clean == "2":
-                sms_save(phone,"mode","rag"); sms_save(phone,"state","RAG_CHAT")
-                await send_reply(phone, t(lang,"rag_welcome"))
-            else: await send_reply(phone, t(lang,"mode_err"))
-        elif state == "LEVEL":
-            if text_clean=="1": sms_save(phone,"level","JSS"); sms_save(phone,"state","JSS_GRADE"); await send_reply(phone,t(lang,"jss_grade"))
-            elif text_clean=="2": sms_save(phone,"level","Senior"); sms_save(phone,"state","SENIOR_GRADE"); await send_reply(phone,t(lang,"senior_grade"))
-            else: await send_reply(phone, t(lang,"level_err"))
-        elif state == "JSS_GRADE":
-            g = JSS_GRADES.get(text_clean)
-            if not g: await send_reply(phone,t(lang,"grade_err")); return ""
-            sms_save(phone,"grade",g); sms_save(phone,"state","TERM"); await send_reply(phone,t(lang,"term"))
-        elif state == "SENIOR_GRADE":
-            g = SENIOR_GRADES.get(text_clean)
-            if not g: await send_reply(phone,t(lang,"grade_err")); return ""
-            sms_save(phone,"grade",g); sms_save(phone,"state","SENIOR_PATHWAY"); await send_reply(phone,t(lang,"senior_pathway"))
-        elif state == "TERM":
-            tv = TERMS.get(text_clean)
-            if not tv: await send_reply(phone,t(lang,"term_err")); return ""
-            sms_save(phone,"term",tv); sms_save(phone,"state","MATH"); await send_reply(phone,t(lang,"rate_math",opts=RATING_OPTIONS_SMS))
-        elif state == "SENIOR_PATHWAY":
-            chosen = PATHWAYS.get(text_clean)
-            if not chosen: await send_reply(phone,t(lang,"pathway_err")); return ""
-            sms_save(phone,"pathway",chosen); sms_save(phone,"state","CAREER_SELECT")
-            await send_reply(phone,get_career_list_sms(chosen,lang,student[3] or ""))
-        elif state == "MATH":
-            sc = RATING_MAP.get(text_clean)
-            if not sc: await send_reply(phone,t(lang,"invalid_rating")); return ""
-            sms_save(phone,"math",sc); sms_save(phone,"state","SCIENCE"); await send_reply(phone,t(lang,"rate_science",opts=RATING_OPTIONS_SMS))
-        elif state == "SCIENCE":
-            sc = RATING_MAP.get(text_clean)
-            if not sc: await send_reply(phone,t(lang,"invalid_rating")); return ""
-            sms_save(phone,"science",sc); sms_save(phone,"state","SOCIAL"); await send_reply(phone,t(lang,"rate_social",opts=RATING_OPTIONS_SMS))
-        elif state == "SOCIAL":
-            sc = RATING_MAP.get(text_clean)
-            if not sc: await send_reply(phone,t(lang,"invalid_rating")); return ""
-            sms_save(phone,"social",sc); sms_save(phone,"state","CREATIVE"); await send_reply(phone,t(lang,"rate_creative",opts=RATING_OPTIONS_SMS))
-        elif state == "CREATIVE":
-            sc = RATING_MAP.get(text_clean)
-            if not sc: await send_reply(phone,t(lang,"invalid_rating")); return ""
-            sms_save(phone,"creative",sc); sms_save(phone,"state","TECH"); await send_reply(phone,t(lang,"rate_technical",opts=RATING_OPTIONS_SMS))
-        elif state == "TECH":
-            sc = RATING_MAP.get(text_clean)
-            if not sc: await send_reply(phone,t(lang,"invalid_rating")); return ""
-            sms_save(phone,"technical",sc); s2 = sms_get(phone)
-            gr = s2[3] or ""; tv = s2[4] or ""
-            if gr == "Grade 9":
-                pw = calculate_pathway_from_scores(s2[6],s2[7],s2[8],s2[9],s2[10])
-                sms_save(phone,"pathway",pw); sms_save(phone,"state","DONE")
-                await send_reply(phone, t(lang,"pathway_msg",pathway=pw))
-            else:
-                suggestions = await gemini_jss_suggestions(gr,tv,s2[6],s2[7],s2[8],s2[9],s2[10],lang)
-                sms_save(phone,"state","DONE")
-                await send_reply(phone, t(lang,"tracking_hdr",grade=gr,term=tv) + t(lang,"suggestion",suggestions=suggestions))
-        elif state == "CAREER_SELECT":
-            pw = student[5]
-            if not pw: await send_reply(phone,t(lang,"no_pathway")); return ""
-            if text_clean.isdigit() and 1 <= int(text_clean) <= 5:
-                idx = int(text_clean)-1
-                name,demand,trend,subjects,unis,reqs = SENIOR_CAREERS[pw][idx]
-                sms_save(phone,"career_interest",name); sms_save(phone,"state","DONE")
-                await send_reply(phone, get_career_detail_sms(pw,idx,lang))
-                await send_reply(phone, await gemini_career_narrative(student[3] or "",pw,name,subjects,demand,lang))
-            elif text_upper == "MORE":
-                await send_reply(phone,get_all_careers_sms(pw,lang)); sms_save(phone,"state","CAREER_SELECT_ALL")
-            else: await send_reply(phone,t(lang,"invalid_career"))
-        elif state == "CAREER_SELECT_ALL":
-            pw = student[5]
-            if not pw: await send_reply(phone,t(lang,"no_pathway")); return ""
-            if text_clean.isdigit() and 1 <= int(text_clean) <= 10:
-                idx = int(text_clean)-1
-                name,demand,trend,subjects,unis,reqs = SENIOR_CAREERS[pw][idx]
-                sms_save(phone,"career_interest",name); sms_save(phone,"state","DONE")
-                await send_reply(phone, get_career_detail_sms(pw,idx,lang))
-                await send_reply(phone, await gemini_career_narrative(student[3] or "",pw,name,subjects,demand,lang))
-            else: await send_reply(phone,t(lang,"invalid_career"))
-        else:
-            await send_reply(phone, t(lang,"done"))
-    except Exception as e:
-        print(f"[SMS] Error: {e}"); await send_reply(phone, t(lang,"error"))
-    return ""
+    if text_upper in ("MORE", "CAREERS"):
+        if not student[5]: await send_reply(phone, t(lang,"no_pathway"), lang); return
+        picker = "CAREER_SELECT_ALL" if text_upper == "MORE" else "CAREER_SELECT"
+        await send_reply(phone, flow_render("sms", picker, student_fields(student)), lang)
+        await save_student("sms", phone, state=picker); return
+    before = student_fields(student); f = dict(before)
+    with stage("render"): result = flow_step("sms", state, text_clean, f)
+    if result is None: await send_reply(phone, t(lang,"done"), lang); return
+    nxt, screen, effects, _ = result
+    changed = {k: v for k, v in f.items() if k in STUDENT_ALLOWED and v != before.get(k)}
+    if changed or nxt != state: await save_student("sms", phone, state=nxt, **changed)
+    if screen: await send_reply(phone, screen, _lang(f))
+    for kind, payload in effects: await SMS_EFFECTS[kind](phone, **payload)
 
 
 # =============================================================
 #  USSD DB HELPERS
 # =============================================================
 
-USSD_ALLOWED = {"lang","level","grade","term","pathway","math","science","social",
-                "creative","technical","career_interest","state","mode"}
-
-def ussd_save(phone, field, value):
-    if field not in USSD_ALLOWED: raise ValueError(f"Invalid field: {field}")
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("INSERT INTO ussd_students(phone) VALUES(%s) ON CONFLICT DO NOTHING", (phone,))
-    cur.execute(f"UPDATE ussd_students SET {field}=%s WHERE phone=%s", (value, phone))
-    conn.commit(); cur.close(); conn.close()
-
-def ussd_get(phone):
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("""SELECT phone,lang,level,grade,term,pathway,math,science,social,
-                          creative,technical,career_interest,state,mode
-                   FROM ussd_students WHERE phone=%s""", (phone,))
-    s = cur.fetchone(); cur.close(); conn.close(); return s
-
-def ussd_calculate_pathway(phone):
-    s = ussd_get(phone)
-    if not s: return None
-    pw = calculate_pathway_from_scores(s[6],s[7],s[8],s[9],s[10])
-    ussd_save(phone,"pathway",pw); return pw
-
-def ussd_reset(phone):
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("""UPDATE ussd_students
-                   SET lang=NULL,level=NULL,grade=NULL,term=NULL,pathway=NULL,
-                       math=NULL,science=NULL,social=NULL,creative=NULL,
-                       technical=NULL,career_interest=NULL,mode=NULL,state='LANG'
-                   WHERE phone=%s""", (phone,))
-    conn.commit(); cur.close(); conn.close()
+USSD_ASSESSMENT = [c for c in STUDENT_PROFILE if c != "lang"]
+
+async def ussd_persist(phone, state, fields):
+    """Write the session outcome into the shared profile.
+
+    A session that ran an assessment replaces the stored one (unset columns are
+    cleared); one that only browsed the assistant leaves the profile alone.
+    """
+    keep = {"lang": fields.get("lang"), "mode": fields.get("mode")} if fields.get("lang") else {}
+    if fields.get("level"): keep.update({k: fields.get(k) for k in USSD_ASSESSMENT})
+    await save_student("ussd", phone, state=state, **keep)
 
 def con(text): return f"CON {text}"
 def end(text): return f"END {text}"
 
+# =============================================================
+#  USSD SCREEN PAGER
+#  Every reply is measured in UTF-8 bytes before it leaves ("━",
+#  "•", "↑" are three each). Anything over USSD_SCREEN_MAX bytes
+#  is cut into pages on line (else word) breaks with
+#  "0. Next" / "00. Back" navigation. The pages live in memory keyed
+#  by sessionId, so paging costs no DB round trip; an END screen
+#  becomes CON pages with only its last page sent as END.
+# =============================================================
+
+USSD_NEXT, USSD_BACK = "0", "00"
+_NAV = {"first": f"\n{USSD_NEXT}. Next", "middle": f"\n{USSD_NEXT}. Next\n{USSD_BACK}. Back",
+        "last": f"\n{USSD_BACK}. Back"}
+# sid -> (ts, text that produced the page on screen, kind, pages, i)
+ussd_pages: OrderedDict[str, tuple[float, str, str, list[str], int]] = OrderedDict()
+
+def _expire(sessions: OrderedDict):
+    now = time.monotonic()
+    while sessions and now - next(iter(sessions.values()))[0] > USSD_SESSION_TTL:
+        sessions.popitem(last=False)
+
+def ussd_bytes(s: str) -> int:
+    return len(s.encode())
+
+def _fits(s: str, budget: int) -> int:
+    """Number of leading characters of s that fit in budget bytes."""
+    n = 0
+    for i, ch in enumerate(s):
+        n += ussd_bytes(ch)
+        if n > budget: return i
+    return len(s)
+
+def paginate_ussd(body: str, limit: int = USSD_SCREEN_MAX) -> list[str]:
+    """Cut a screen body into pages that fit in limit bytes with "CON " and the worst-case nav footer."""
+    if 4 + ussd_bytes(body) <= limit: return [body]
+    budget = limit - 4 - ussd_bytes(_NAV["middle"])
+    lines = []
+    for line in body.split("\n"):
+        while ussd_bytes(line) > budget:
+            n = _fits(line, budget)
+            cut = line.rfind(" ", 0, n + 1)
+            cut = cut if cut > 0 else n
+            lines.append(line[:cut]); line = line[cut:].lstrip()
+        lines.append(line)
+    pages, cur = [], ""
+    for line in lines:
+        if cur and ussd_bytes(cur) + 1 + ussd_bytes(line) > budget: pages.append(cur.rstrip("\n")); cur = line.lstrip("\n")
+        else: cur = f"{cur}\n{line}" if cur else line
+    if cur.strip(): pages.append(cur.rstrip("\n"))
+    return pages
+
+def _ussd_page(kind, pages, i):
+    if len(pages) == 1: return f"{kind} {pages[0]}"
+    if i == len(pages) - 1: return f"{kind} {pages[i]}" if kind == "END" else f"CON {pages[i]}{_NAV['last']}"
+    return f"CON {pages[i]}{_NAV['first' if i == 0 else 'middle']}"
+
+def ussd_render(session_id: str, text: str, reply: str, nav=()) -> str:
+    """Send reply as is if it fits, else remember its pages for this session and send page 1,
+    or the page the Next/Back inputs in nav lead to."""
+    ussd_pages.pop(session_id, None)
+    kind, body = reply[:3], reply[4:]
+    pages = paginate_ussd(body)
+    if len(pages) == 1: return reply
+    i = 0
+    for step in nav: i = min(i + 1, len(pages) - 1) if step == USSD_NEXT else max(i - 1, 0)
+    ussd_pages[session_id] = (time.monotonic(), text, kind, pages, i)
+    _expire(ussd_pages)
+    return _ussd_page(kind, pages, i)
+
+def ussd_turn_page(session_id: str, text: str) -> str | None:
+    """Screen for a Next/Back input on a paged screen; None if the input isn't paging."""
+    entry = ussd_pages.get(session_id)
+    if not entry: return None
+    _, seen, kind, pages, i = entry
+    if text == seen: return _ussd_page(kind, pages, i)          # repeated callback
+    step = text.rsplit("*", 1)[-1].strip()
+    if step not in (USSD_NEXT, USSD_BACK): return None
+    i = min(i + 1, len(pages) - 1) if step == USSD_NEXT else max(i - 1, 0)
+    ussd_pages[session_id] = (time.monotonic(), text, kind, pages, i); ussd_pages.move_to_end(session_id)
+    return _ussd_page(kind, pages, i)
+
 def ussd_lang_screen():
     # Bilingual so ALL users can identify their language
-    return con("Welcome / Karibu\nEduTena CBE\n\nChagua / Select:\n1. English\n2. Kiswahili\n3. Kiluhya\n4. Gĩkũyũ")
+    return con(USSD_LANG_SCREEN)
 
 
 # =============================================================
 #  USSD BACKGROUND SMS TASKS
 # =============================================================
 
+# Run by the job workers below; exceptions propagate so the job is retried. Their
+# texts go out through deliver(): once generated, sending is a send_sms job of its
+# own that records each accepted part, so a refused part is retried from there on
+# and nothing the learner already has is sent again (nor Gemini asked again).
+
+async def deliver(phone, messages, lang):
+    """Send messages in order: directly from a webhook, as a send_sms job from a job."""
+    if _current_job.get() is None:
+        for message in messages: await send_reply(phone, message, lang)
+    else:
+        await enqueue_job("send_sms", phone=phone, messages=messages, lang=lang)
+
+async def _sms_send(phone, messages, lang, sent=0):
+    """send_sms job: skip the first `sent` parts, record each part accepted after that."""
+    done = 0
+    for message in messages:
+        n = len(sms_parts(message, lang))
+        if done + n > sent:
+            async def accepted(i, base=done): await job_progress(sent=base + i + 1)
+            await send_reply(phone, message, lang, skip=max(0, sent - done), on_part=accepted)
+        done += n
+
 async def _sms_career_detail(phone, pathway, career_idx, lang, grade):
-    try:
-        await send_reply(phone, get_career_detail_sms(pathway, career_idx, lang))
-        name, demand, trend, subjects, unis, reqs = SENIOR_CAREERS[pathway][career_idx]
-        await send_reply(phone, await gemini_career_narrative(grade, pathway, name, subjects, demand, lang))
-    except Exception as e: print(f"[USSD SMS career] {e}")
+    name, demand, trend, subjects, unis, reqs = SENIOR_CAREERS[pathway][career_idx]
+    narrative = await gemini_career_narrative(grade, pathway, name, subjects, demand, lang)
+    await deliver(phone, [get_career_detail_sms(pathway, career_idx, lang), narrative], lang)
 
 async def _sms_jss_suggestions(phone, grade, term, math, sci, soc, cre, tec, lang):
-    try:
-        suggestions = await gemini_jss_suggestions(grade, term, math, sci, soc, cre, tec, lang)
-        msg = (f"EduTena CBE — {grade} | {term}\n━━━━━━━━━━━━━━━━━━━━\n\n"
-               + t(lang,"suggestion", suggestions=suggestions)
-               + "\n\n" + t(lang,"resume_fallback"))
-        await send_reply(phone, msg)
-    except Exception as e: print(f"[USSD SMS JSS] {e}")
-
-async def _sms_rag_answer(phone, question, lang):
-    try:
-        header = {"en":"EduTena CBE Assistant\n━━━━━━━━━━━━━━━━━━━━\n\n",
-                  "sw":"Msaidizi wa EduTena CBE\n━━━━━━━━━━━━━━━━━━━━\n\n",
-                  "lh":"Msaidizi wa EduTena CBE\n━━━━━━━━━━━━━━━━━━━━\n\n",
-                  "ki":"Msaidizi wa EduTena CBE\n━━━━━━━━━━━━━━━━━━━━\n\n"}.get(lang,"")
-        await send_reply(phone, header + await ask_gemini_rag(phone, question, lang))
-    except Exception as e: print(f"[USSD SMS RAG] {e}")
+    suggestions = await gemini_jss_suggestions(grade, term, math, sci, soc, cre, tec, lang)
+    msg = (f"EduTena CBE — {grade} | {term}\n━━━━━━━━━━━━━━━━━━━━\n\n"
+           + t(lang,"suggestion", suggestions=suggestions)
+           + "\n\n" + t(lang,"resume_fallback"))
+    await deliver(phone, [msg], lang)
+
+async def _sms_rag_answer(phone, question, lang, history_turns=8):
+    header = {"en":"EduTena CBE Assistant\n━━━━━━━━━━━━━━━━━━━━\n\n",
+              "sw":"Msaidizi wa EduTena CBE\n━━━━━━━━━━━━━━━━━━━━\n\n",
+              "lh":"Msaidizi wa EduTena CBE\n━━━━━━━━━━━━━━━━━━━━\n\n",
+              "ki":"Msaidizi wa EduTena CBE\n━━━━━━━━━━━━━━━━━━━━\n\n"}.get(lang,"")
+    await reply_gemini_rag(phone, question, lang, history_turns, header)
+
+async def _sms_jss_tracking(phone, grade, term, math, sci, soc, cre, tec, lang):
+    suggestions = await gemini_jss_suggestions(grade, term, math, sci, soc, cre, tec, lang)
+    await deliver(phone, [t(lang,"tracking_hdr",grade=grade,term=term) + t(lang,"suggestion",suggestions=suggestions)], lang)
+
+# SMS runs a flow's side effects inline: they produce the reply itself.
+SMS_EFFECTS = {"career_detail": _sms_career_detail, "jss_suggestions": _sms_jss_tracking}
+
+
+# =============================================================
+#  BACKGROUND JOBS
+#  Every job is a row in `jobs` first, so a restart loses nothing.
+#  The in-memory queue is bounded; anything that doesn't fit (or
+#  is due for a retry, or was orphaned by a dead worker) is picked
+#  up by the sweeper. Claiming is a conditional UPDATE, so several
+#  uvicorn workers can share the table without running a job twice.
+# =============================================================
+
+JOB_HANDLERS = {
+    "career_detail":   _sms_career_detail,
+    "jss_suggestions": _sms_jss_suggestions,
+    "rag_answer":      _sms_rag_answer,
+    "summarise_history": _summarise_history,
+    "send_sms":        _sms_send,
+}
+_current_job: ContextVar[int | None] = ContextVar("current_job", default=None)
+
+job_queue: asyncio.Queue = asyncio.Queue(maxsize=JOB_QUEUE_SIZE)
+job_metrics = {"enqueued": 0, "dequeued": 0, "done": 0, "retried": 0, "failed": 0, "overflow": 0,
+               "wait_total": 0.0, "wait_max": 0.0}
+_queued_ids: set[int] = set()
+_background_tasks: list[asyncio.Task] = []
+
+def _offer_job(job_id, kind, payload):
+    if job_id in _queued_ids: return
+    try: job_queue.put_nowait((time.monotonic(), job_id, kind, payload))
+    except asyncio.QueueFull: job_metrics["overflow"] += 1; return
+    _queued_ids.add(job_id)
+
+async def job_progress(**fields):
+    """Merge fields into the running job's stored payload; a retry is called with them."""
+    await db_execute("UPDATE jobs SET payload = payload || %s::jsonb, updated_at=NOW() WHERE id=%s",
+                     (json.dumps(fields), _current_job.get()))
+
+async def enqueue_job(kind, **payload):
+    if kind not in JOB_HANDLERS: raise ValueError(f"Unknown job: {kind}")
+    if request_id(): payload["_rid"] = request_id()
+    row = await db_fetchone("INSERT INTO jobs(kind,payload) VALUES(%s,%s::jsonb) RETURNING id",
+                            (kind, json.dumps(payload)))
+    job_metrics["enqueued"] += 1
+    _offer_job(row[0], kind, payload)
+
+async def _job_worker():
+    while True:
+        enqueued_at, job_id, kind, payload = await job_queue.get()
+        _queued_ids.discard(job_id)
+        wait = time.monotonic() - enqueued_at
+        job_metrics["dequeued"] += 1; job_metrics["wait_total"] += wait; job_metrics["wait_max"] = max(job_metrics["wait_max"], wait)
+        rid = payload.pop("_rid", None)
+        _request_ctx.set(RequestContext("job", kind, rid)); _current_job.set(job_id)
+        try:
+            claimed = await db_fetchone("""UPDATE jobs SET status='running', attempts=attempts+1, updated_at=NOW()
+                                           WHERE id=%s AND status='queued' RETURNING attempts""", (job_id,))
+            if not claimed: continue
+            try:
+                await JOB_HANDLERS[kind](**payload)
+            except Exception as e:
+                log_jobs.warning("attempt %d failed: %s: %s", claimed[0], type(e).__name__, e,
+                                 extra={"job": job_id, "kind": kind})
+                if claimed[0] < JOB_MAX_ATTEMPTS:
+                    job_metrics["retried"] += 1
+                    await db_execute("""UPDATE jobs SET status='queued', last_error=%s, updated_at=NOW(),
+                                               run_after=NOW() + make_interval(secs => %s) WHERE id=%s""",
+                                     (str(e), 2 ** claimed[0] + random.random(), job_id))
+                else:
+                    job_metrics["failed"] += 1
+                    await db_execute("UPDATE jobs SET status='failed', last_error=%s, updated_at=NOW() WHERE id=%s",
+                                     (str(e), job_id))
+                continue
+            job_metrics["done"] += 1
+            await db_execute("DELETE FROM jobs WHERE id=%s", (job_id,))
+        except Exception as e:
+            log_jobs.error("%s: %s", type(e).__name__, e, extra={"job": job_id, "kind": kind})
+        finally:
+            job_queue.task_done()
+
+async def _job_sweeper():
+    while True:
+        try:
+            await db_execute("""UPDATE jobs SET status='queued' WHERE status='running'
+                                AND updated_at < NOW() - make_interval(secs => %s)""", (JOB_STALE_AFTER,))
+            free = job_queue.maxsize - job_queue.qsize()
+            if free > 0:
+                rows = await db_fetchall("""SELECT id,kind,payload FROM jobs WHERE status='queued' AND run_after <= NOW()
+                                            ORDER BY id LIMIT %s""", (free,))
+                for job_id, kind, payload in rows: _offer_job(job_id, kind, payload)
+        except Exception as e:
+            log_jobs.error("sweeper %s: %s", type(e).__name__, e)
+        await asyncio.sleep(JOB_SWEEP_INTERVAL)
+
+def start_job_workers():
+    _background_tasks.extend(asyncio.create_task(_job_worker()) for _ in range(JOB_WORKERS))
+    _background_tasks.append(asyncio.create_task(_job_sweeper()))
+
+async def stop_job_workers():
+    for task in _background_tasks: task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+
+def job_stats():
+    n = job_metrics["dequeued"]
+    return {**job_metrics, "depth": job_queue.qsize(), "wait_avg": job_metrics["wait_total"] / n if n else 0.0}
+
+
+# =============================================================
+#  USSD SESSION ENGINE
+#  The gateway sends the whole input path ("1*2*3") on every
+#  callback, so the screen is a pure function of it: replay the
+#  steps through flow_step starting at LANG. The last result per
+#  sessionId is kept, so the usual callback (same path plus one
+#  step) applies just that step and a repeated callback gets the
+#  same screen without re-running side effects. The student row is
+#  written only when a session reaches a terminal screen.
+# =============================================================
+
+USSD_TERMINAL = {"RESULT", "DONE"}
+# sid -> (ts, steps, state, fields, rendered reply)
+ussd_sessions: OrderedDict[str, tuple[float, tuple, str, dict, str]] = OrderedDict()
+
+def ussd_steps(text: str) -> tuple:
+    """Input path without page navigation, which never changes the flow state."""
+    return tuple(s for s in (p.strip() for p in text.split("*")) if s not in (USSD_NEXT, USSD_BACK)) if text else ()
+
+def ussd_nav(text: str) -> tuple:
+    """The Next/Back inputs at the end of the path (empty if the last input is an answer)."""
+    parts = [p.strip() for p in text.split("*")] if text else []
+    n = len(parts)
+    while n and parts[n - 1] in (USSD_NEXT, USSD_BACK): n -= 1
+    return tuple(parts[n:])
+
+def ussd_replay(steps, state="LANG", fields=None):
+    """Run steps from state; returns (state, fields, reply, side effects of the last step)."""
+    f = dict(fields or {}); reply, effects = ussd_lang_screen(), []
+    for step in steps:
+        result = flow_step("ussd", state, step, f) or _flow_reset("ussd", f)
+        state, screen, effects, final = result
+        reply = end(screen) if final else con(screen)
+    return state, f, reply, effects
 
 
 # =============================================================
@@ -995,167 +2552,111 @@ async def ussd_callback(
     sessionId: str = Form(...), serviceCode: str = Form(...),
     phoneNumber: str = Form(...), text: str = Form(default="")
 ):
-    phone = phoneNumber
-    steps = [s.strip() for s in text.split("*")] if text else []
-    step  = steps[-1] if steps else ""
-    print(f"[USSD] session={sessionId} phone={phone[:7]}**** steps={steps}")
-    student = ussd_get(phone)
-    if not text or not student:
-        ussd_save(phone, "state", "LANG"); return ussd_lang_screen()
-    state = student[12]
-    lang  = student[1] if student[1] in UI else "en"
+    ctx = begin_request("ussd"); started = time.perf_counter()
+    try: return await handle_ussd(ctx, sessionId, phoneNumber, text)
+    finally: end_request(ctx, time.perf_counter() - started)
+
+async def handle_ussd(ctx, sessionId, phone, text):
+    log_ussd.info("in: %r", text, extra={"phone": phone, "session": sessionId})
+    ctx.state = "PAGE"
+    paged = ussd_turn_page(sessionId, text)
+    if paged: return paged
+    steps, nav = ussd_steps(text), ussd_nav(text)
+    if nav:
+        # Paging on a worker without this session's pages (another worker, a restart, expiry): the
+        # answer before the Next/Back already ran its jobs and write, so only rebuild the screen.
+        with stage("render"):
+            state, fields, reply, _ = ussd_replay(steps)
+            out = ussd_render(sessionId, text, reply, nav)
+        ussd_sessions[sessionId] = (time.monotonic(), steps, state, fields, out)
+        ussd_sessions.move_to_end(sessionId); _expire(ussd_sessions)
+        return out
+    prev = ussd_sessions.get(sessionId)
+    if prev and prev[1] == steps:                      # same screen, no side effects
+        ctx.state = "REPEAT"; inbound_guard.shed["ussd_duplicate"] += 1; return prev[4]
+    # Seen by another worker (shared backend): rebuild the screen, but its side effects already ran there.
+    key = InboundGuard.key("ussd", sessionId, text)
+    fresh = await inbound_guard.first(key)
+    if not fresh: inbound_guard.shed["ussd_duplicate"] += 1
+    elif not steps and await inbound_guard.allow(phone) != "ok":
+        ctx.state = "RATE_LIMITED"; inbound_guard.shed["ussd_rate_limited"] += 1
+        return end(t("en","slow_down"))
+    fields = {}
+    ctx.state = prev[2] if prev and steps[:len(prev[1])] == prev[1] else "LANG"
     try:
-        if state == "LANG":
-            chosen = LANG_MAP.get(step)
-            if not chosen: return con(t("en","invalid_lang"))
-            ussd_save(phone,"lang",chosen); ussd_save(phone,"state","MODE_SELECT")
-            return con(t(chosen,"mode_ussd_2"))
-
-        elif state == "MODE_SELECT":
-            if step == "1":
-                ussd_save(phone,"mode","assessment"); ussd_save(phone,"state","LEVEL")
-                return con(t(lang,"welcome"))
-            elif step == "2":
-                ussd_save(phone,"mode","rag"); ussd_save(phone,"state","USSD_RAG_TOPIC")
-                return con(t(lang,"ussd_rag_menu"))
-            else: return con(t(lang,"mode_ussd_err"))
-
-        elif state == "USSD_RAG_TOPIC":
-            topics = {
-                "1": "Can you explain in detail what CBE (Competency Based Education) and CBC (Competency Based Curriculum) mean in Kenya? How is it different from what came before and why was it introduced?",
-                "2": "Please explain the three Senior Secondary CBE pathways in detail — STEM, Social Sciences, and Arts & Sports Science. What subjects does each contain, what competencies are assessed, and what careers does each pathway lead to?",
-                "3": "How does a student build a CBE competency portfolio for university entry? What should it include, how is it assessed, who reviews it, and which universities in Kenya already accept CBE portfolios?",
-                "4": "What is the full difference between the old 844 KCSE system and the new CBE system in Kenya? How does university entry work now versus before? What does this mean for students currently in school?",
-                "5": "How do Kenyan universities and colleges admit students under CBE? Which specific institutions have confirmed CBE portfolio pathways, what are their requirements, and how does the process work step by step?",
-            }
-            if step in topics:
-                ussd_save(phone,"state","DONE")
-                asyncio.create_task(_sms_rag_answer(phone, topics[step], lang))
-                return end(t(lang,"ussd_rag_sending"))
-            elif step == "6":
-                ussd_save(phone,"state","DONE"); return end(t(lang,"ussd_rag_sms_tip"))
-            else: return con(t(lang,"ussd_rag_menu"))
-
-        elif state == "LEVEL":
-            if step=="1": ussd_save(phone,"level","JSS"); ussd_save(phone,"state","JSS_GRADE"); return con(t(lang,"jss_grade"))
-            elif step=="2": ussd_save(phone,"level","Senior"); ussd_save(phone,"state","SENIOR_GRADE"); return con(t(lang,"senior_grade"))
-            else: return con(t(lang,"level_err"))
-
-        elif state == "JSS_GRADE":
-            g = JSS_GRADES.get(step)
-            if not g: return con(t(lang,"grade_err"))
-            ussd_save(phone,"grade",g); ussd_save(phone,"state","TERM"); return con(t(lang,"term"))
-
-        elif state == "SENIOR_GRADE":
-            g = SENIOR_GRADES.get(step)
-            if not g: return con(t(lang,"grade_err"))
-            ussd_save(phone,"grade",g); ussd_save(phone,"state","SENIOR_PATHWAY")
-            return con(t(lang,"senior_pathway"))
-
-        elif state == "TERM":
-            tv = TERMS.get(step)
-            if not tv: return con(t(lang,"term_err"))
-            ussd_save(phone,"term",tv); ussd_save(phone,"state","MATH")
-            return con(t(lang,"rate_math",opts=RATING_OPTIONS_USSD))
-
-        elif state == "SENIOR_PATHWAY":
-            chosen = PATHWAYS.get(step)
-            if not chosen: return con(t(lang,"pathway_err"))
-            ussd_save(phone,"pathway",chosen); ussd_save(phone,"state","USSD_CAREER_SELECT")
-            return con(get_career_ussd_list(chosen))
-
-        elif state == "MATH":
-            sc = RATING_MAP.get(step)
-            if not sc: return con(t(lang,"invalid_rating"))
-            ussd_save(phone,"math",sc); ussd_save(phone,"state","SCIENCE"); return con(t(lang,"rate_science",opts=RATING_OPTIONS_USSD))
-
-        elif state == "SCIENCE":
-            sc = RATING_MAP.get(step)
-            if not sc: return con(t(lang,"invalid_rating"))
-            ussd_save(phone,"science",sc); ussd_save(phone,"state","SOCIAL"); return con(t(lang,"rate_social",opts=RATING_OPTIONS_USSD))
-
-        elif state == "SOCIAL":
-            sc = RATING_MAP.get(step)
-            if not sc: return con(t(lang,"invalid_rating"))
-            ussd_save(phone,"social",sc); ussd_save(phone,"state","CREATIVE"); return con(t(lang,"rate_creative",opts=RATING_OPTIONS_USSD))
-
-        elif state == "CREATIVE":
-            sc = RATING_MAP.get(step)
-            if not sc: return con(t(lang,"invalid_rating"))
-            ussd_save(phone,"creative",sc); ussd_save(phone,"state","TECH"); return con(t(lang,"rate_technical",opts=RATING_OPTIONS_USSD))
-
-        elif state == "TECH":
-            sc = RATING_MAP.get(step)
-            if not sc: return con(t(lang,"invalid_rating"))
-            ussd_save(phone,"technical",sc); s2 = ussd_get(phone)
-            gr = s2[3] or ""; tv = s2[4] or ""
-            m,sci,so,cr,tc = s2[6],s2[7],s2[8],s2[9],s2[10]
-            if gr == "Grade 9":
-                pw = calculate_pathway_from_scores(m,sci,so,cr,tc)
-                ussd_save(phone,"pathway",pw); ussd_save(phone,"state","RESULT")
-                scores_d = {"Math":m or 0,"Science":sci or 0,"Social":so or 0,"Creative":cr or 0,"Technical":tc or 0}
-                top2 = sorted(scores_d.items(), key=lambda x:-x[1])[:2]
-                top_str = " & ".join(n for n,_ in top2)
-                return con(t(lang,"ussd_pathway_result", pathway=pw, top=top_str, summary=score_summary(m,sci,so,cr,tc)))
+        with stage("render"):
+            if prev and steps[:len(prev[1])] == prev[1]:
+                state, fields, reply, effects = ussd_replay(steps[len(prev[1]):], prev[2], prev[3])
             else:
-                asyncio.create_task(_sms_jss_suggestions(phone,gr,tv,m,sci,so,cr,tc,lang))
-                ussd_save(phone,"state","DONE")
-                scores_d = {"Math":m or 0,"Science":sci or 0,"Social Studies":so or 0,"Creative Arts":cr or 0,"Technical":tc or 0}
-                sorted_sc = sorted(scores_d.items(),key=lambda x:-x[1])
-                strongest = sorted_sc[0][0]
-                weak_list = [n for n,v in sorted_sc if v<=2]
-                weak_str  = ", ".join(weak_list[:2]) if weak_list else ("None" if lang=="en" else "Hakuna")
-                return con(t(lang,"ussd_jss_result",grade=gr,term=tv,strongest=strongest,weak=weak_str))
-
-        elif state == "RESULT":
-            pw = student[5] or ussd_calculate_pathway(phone)
-            if step=="1":
-                ussd_save(phone,"state","USSD_CAREER_SELECT"); return con(get_career_ussd_list(pw))
-            elif step=="2":
-                careers = SENIOR_CAREERS.get(pw,[])
-                lines = f"{pw} — All:\n"
-                for i,(name,demand,*_) in enumerate(careers,1): lines += f"{i}. {name[:15]} {demand}\n"
-                ussd_save(phone,"state","USSD_CAREER_SELECT_ALL"); return con(lines)
-            elif step=="3": ussd_reset(phone); return ussd_lang_screen()
-            else: return end(t(lang,"thank_you"))
-
-        elif state == "USSD_CAREER_SELECT":
-            pw = student[5]
-            if step.isdigit() and 1 <= int(step) <= 6:
-                idx = int(step)-1
-                ussd_save(phone,"career_interest",SENIOR_CAREERS[pw][idx][0])
-                ussd_save(phone,"state","DONE")
-                asyncio.create_task(_sms_career_detail(phone,pw,idx,lang,student[3] or ""))
-                # Show full detail on USSD END screen (same structure as SMS)
-                return end(get_career_ussd_end(pw,idx,lang))
-            elif step=="7":
-                careers = SENIOR_CAREERS.get(pw,[])
-                lines = f"{pw} — All:\n"
-                for i,(name,demand,*_) in enumerate(careers,1): lines += f"{i}. {name[:15]} {demand}\n"
-                ussd_save(phone,"state","USSD_CAREER_SELECT_ALL"); return con(lines)
-            else: return con(get_career_ussd_list(pw))
-
-        elif state == "USSD_CAREER_SELECT_ALL":
-            pw = student[5]
-            if step.isdigit() and 1 <= int(step) <= 10:
-                idx = int(step)-1
-                ussd_save(phone,"career_interest",SENIOR_CAREERS[pw][idx][0])
-                ussd_save(phone,"state","DONE")
-                asyncio.create_task(_sms_career_detail(phone,pw,idx,lang,student[3] or ""))
-                return end(get_career_ussd_end(pw,idx,lang))
-            else:
-                careers = SENIOR_CAREERS.get(pw,[])
-                lines = f"{pw} — All:\n"
-                for i,(name,demand,*_) in enumerate(careers,1): lines += f"{i}. {name[:15]} {demand}\n"
-                return con(lines)
+                state, fields, reply, effects = ussd_replay(steps)
+        if fresh:
+            for kind, payload in effects: await enqueue_job(kind, phone=phone, **payload)
+            unchanged = prev is not None and (prev[2], prev[3]) == (state, fields)
+            if effects or (not unchanged and (state in USSD_TERMINAL or reply.startswith("END"))):
+                await ussd_persist(phone, state, fields)
+    except Exception:
+        if fresh: await inbound_guard.release(key)      # the retry must run the jobs and the write
+        log_ussd.exception("flow step failed", extra={"phone": phone, "session": sessionId})
+        return end(t(fields.get("lang") or "en","error"))
+    with stage("render"): out = ussd_render(sessionId, text, reply)
+    ussd_sessions[sessionId] = (time.monotonic(), steps, state, fields, out)
+    ussd_sessions.move_to_end(sessionId); _expire(ussd_sessions)
+    return out
 
-        elif state == "DONE":
-            if step=="1": ussd_reset(phone); return ussd_lang_screen()
-            else: return end(t(lang,"thank_you"))
 
-        else:
-            ussd_reset(phone); return ussd_lang_screen()
+# =============================================================
+#  ADMIN API
+# =============================================================
 
-    except Exception as e:
-        print(f"[USSD] Error: {e}")
-        return end(t(lang if student else "en","error"))
+@app.get("/admin/cohort")
+async def admin_cohort(channel: str | None = None, level: str | None = None, grade: str | None = None,
+                       term: str | None = None, group_by: str | None = None,
+                       x_admin_token: str = Header(default="")):
+    """Pathway/subject report over every assessed student, optionally filtered and grouped."""
+    if not ADMIN_TOKEN or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN): raise HTTPException(403)
+    if channel not in (None, "sms", "ussd"): raise HTTPException(400, "channel must be sms or ussd")
+    if group_by not in (None, *cohort.GROUP_COLUMNS):
+        raise HTTPException(400, f"group_by must be one of {', '.join(cohort.GROUP_COLUMNS)}")
+    return await asyncio.to_thread(_cohort_report, group_by, channel=channel, level=level, grade=grade, term=term)
+
+def _cohort_report(group_by, **filters):
+    # Building the arrays (object columns, float conversion, np.unique) costs about 2 s per
+    # million learners, so the load runs in this thread too, on a connection of its own,
+    # instead of on the event loop every webhook on this worker shares.
+    import psycopg
+    with psycopg.connect(DATABASE_URL) as conn:
+        return cohort.report(cohort.load(conn, **filters), group_by)
+
+
+# =============================================================
+#  METRICS ENDPOINT
+# =============================================================
+
+_overhead: float | None = None
+
+def _gauges(prefix: str, values: dict, labels: str = "") -> list[str]:
+    return [f"{prefix}_{k}{labels} {v}" for k, v in values.items() if isinstance(v, (int, float))]
+
+# async so it runs on the loop: the histograms and counters it walks are only
+# ever mutated there, never while a scrape is iterating them.
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus text exposition of request/stage histograms and the in-process counters."""
+    global _overhead
+    if _overhead is None: _overhead = instrumentation_overhead()    # once per worker, ~10 ms
+    lines = request_latency.prometheus("edutena_request_seconds", "Webhook latency by channel and state.",
+                                       ("channel", "state"))
+    lines += stage_latency.prometheus("edutena_stage_seconds", "Time per hot-path stage by channel and state.",
+                                      ("stage", "channel", "state"))
+    lines += _gauges("edutena_student_cache", student_cache.stats())
+    lines += _gauges("edutena_llm_cache", llm_cache.stats())
+    lines += _gauges("edutena_jobs", job_stats())
+    lines += _gauges("edutena_sms", sms_dispatcher.stats)
+    lines += _gauges("edutena_sms_billing", sms_billing)
+    lines += _gauges("edutena_db_pool", db_pool.get_stats())
+    for label, usage in llm_usage.items(): lines += _gauges("edutena_llm", usage, f'{{label="{label}"}}')
+    for label, s in prompt_stats.items(): lines += _gauges("edutena_prompt", s, f'{{label="{label}"}}')
+    lines += _gauges("edutena_log", log_metrics)
+    lines += _gauges("edutena_inbound", inbound_guard.stats())
+    lines.append(f"edutena_instrumentation_overhead_seconds {_overhead:.9f}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,201 @@
+"""Whole-cohort pathway scoring and reports.
+
+    python cohort.py report [--channel sms|ussd] [--grade "Grade 9"] [--group-by grade] [--format json|csv]
+    python cohort.py parity
+
+Loads the five subject ratings of every assessed learner with one streamed
+query into an int8 NumPy matrix, then computes predicted pathways,
+strongest/weakest subjects, rating distributions and means for the whole
+cohort, or per channel (last used)/level/grade/term, in vectorised passes.
+
+pathway_codes() is the array form of app.calculate_pathway_from_scores;
+verify_parity() checks the two agree on every possible rating combination.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+
+import numpy as np
+
+SUBJECTS      = ("math", "science", "social", "creative", "technical")
+PATHWAY_NAMES = ("STEM", "Social Sciences", "Arts & Sports Science")
+RATING_LABELS = {4: "E", 3: "M", 2: "A", 1: "B", 0: "unrated"}
+GROUP_COLUMNS = ("channel", "level", "grade", "term")
+BATCH_ROWS    = 50_000
+
+CHANNELS      = ("sms", "ussd")
+
+
+# =============================================================
+#  SCORING
+# =============================================================
+
+def pathway_codes(scores: np.ndarray) -> np.ndarray:
+    """Index into PATHWAY_NAMES for each row of an (n, 5) rating matrix; 0 = unrated."""
+    s = scores.astype(np.int16)
+    stem = s[:, 0] + s[:, 1] + s[:, 4]
+    soc, arts = 2 * s[:, 2], 2 * s[:, 3]
+    return np.where((stem >= soc) & (stem >= arts), 0, np.where(soc >= arts, 1, 2)).astype(np.int8)
+
+
+def strongest(scores: np.ndarray) -> np.ndarray:
+    """Index into SUBJECTS of each row's highest rating (first on ties)."""
+    return scores.argmax(axis=1).astype(np.int8)
+
+
+def weakest(scores: np.ndarray) -> np.ndarray:
+    """Index into SUBJECTS of each row's lowest rated subject (first on ties)."""
+    return np.where(scores == 0, 99, scores).argmin(axis=1).astype(np.int8)
+
+
+def verify_parity(scalar) -> list:
+    """Combinations where pathway_codes disagrees with scalar(math, science, social, creative, technical)."""
+    combos = list(itertools.product(range(5), repeat=len(SUBJECTS)))
+    vec = pathway_codes(np.array(combos, dtype=np.int8))
+    bad = []
+    for combo, code in zip(combos, vec):
+        expected = scalar(*(v or None for v in combo))
+        if PATHWAY_NAMES[code] != expected: bad.append((combo, PATHWAY_NAMES[code], expected))
+    return bad
+
+
+# =============================================================
+#  LOADING
+# =============================================================
+
+class Cohort:
+    """Ratings as an (n, 5) int8 matrix plus categorical codes for the group columns."""
+
+    def __init__(self, scores, labels):
+        self.scores = scores
+        self.labels = labels        # column -> (int32 codes, list of names)
+
+    def __len__(self): return len(self.scores)
+
+
+class _Builder:
+    """Turns fetched row batches into arrays as they arrive, so raw tuples never pile up."""
+
+    def __init__(self):
+        self.scores, self.labels = [], {c: [] for c in GROUP_COLUMNS}
+
+    def add(self, rows):
+        cols = list(zip(*rows))
+        for c, col in zip(GROUP_COLUMNS, cols):
+            self.labels[c].append(np.array([v or "" for v in col], dtype=object))
+        block = np.array(cols[len(GROUP_COLUMNS):], dtype=np.float32).T      # NULL -> nan
+        self.scores.append(np.nan_to_num(block, nan=0).astype(np.int8))
+
+    def finish(self) -> Cohort:
+        if not self.scores: return Cohort(np.zeros((0, len(SUBJECTS)), np.int8),
+                                          {c: (np.zeros(0, np.int32), []) for c in GROUP_COLUMNS})
+        labels = {}
+        for c, parts in self.labels.items():
+            names, codes = np.unique(np.concatenate(parts).astype(str), return_inverse=True)
+            labels[c] = (codes.astype(np.int32), names.tolist())
+        return Cohort(np.concatenate(self.scores), labels)
+
+
+def cohort_query(channel=None, level=None, grade=None, term=None):
+    """SQL and params for every assessed student, optionally filtered."""
+    where, params = ["COALESCE(math,science,social,creative,technical) IS NOT NULL"], []
+    for col, val in (("last_channel", channel), ("level", level), ("grade", grade), ("term", term)):
+        if val: where.append(f"{col} = %s"); params.append(val)
+    return (f"SELECT last_channel, level, grade, term, {', '.join(SUBJECTS)} FROM learners "
+            f"WHERE {' AND '.join(where)}", params)
+
+
+def load(conn, **filters) -> Cohort:
+    """Stream the cohort through a server-side cursor on a sync psycopg connection.
+
+    The admin API runs this, with report(), in a worker thread: building the arrays
+    is CPU-bound and would stall the event loop.
+    """
+    sql, params = cohort_query(**filters)
+    out = _Builder()
+    with conn.cursor(name="cohort") as cur:
+        cur.execute(sql, params)
+        while rows := cur.fetchmany(BATCH_ROWS): out.add(rows)
+    return out.finish()
+
+
+# =============================================================
+#  REPORTS
+# =============================================================
+
+def report(cohort: Cohort, group_by: str | None = None) -> dict:
+    """Per-group counts, pathway/strongest/weakest distributions, rating histograms and means."""
+    if group_by: codes, names = cohort.labels[group_by]
+    else: codes, names = np.zeros(len(cohort), np.int32), ["all"]
+    g, s = len(names), cohort.scores
+    count = lambda values, k: np.bincount(codes * k + values, minlength=g * k).reshape(g, k)
+    students = np.bincount(codes, minlength=g)
+    complete = np.bincount(codes, weights=(s > 0).all(axis=1), minlength=g)
+    pathways = count(pathway_codes(s), len(PATHWAY_NAMES))
+    strong, weak = count(strongest(s), len(SUBJECTS)), count(weakest(s), len(SUBJECTS))
+    ratings = [count(s[:, j].astype(np.int32), 5) for j in range(len(SUBJECTS))]
+    sums = [np.bincount(codes, weights=s[:, j], minlength=g) for j in range(len(SUBJECTS))]
+    groups = {}
+    for i, name in enumerate(names):
+        rated = [int(students[i] - ratings[j][i, 0]) for j in range(len(SUBJECTS))]
+        groups[name or "unknown"] = {
+            "students": int(students[i]), "complete": int(complete[i]),
+            "pathways":  dict(zip(PATHWAY_NAMES, pathways[i].tolist())),
+            "strongest": dict(zip(SUBJECTS, strong[i].tolist())),
+            "weakest":   dict(zip(SUBJECTS, weak[i].tolist())),
+            "ratings":   {subj: {RATING_LABELS[r]: int(ratings[j][i, r]) for r in (4, 3, 2, 1, 0)}
+                          for j, subj in enumerate(SUBJECTS)},
+            "mean":      {subj: round(float(sums[j][i]) / rated[j], 2) if rated[j] else None
+                          for j, subj in enumerate(SUBJECTS)},
+        }
+    return {"group_by": group_by, "students": int(len(cohort)), "groups": groups}
+
+
+def report_rows(rep: dict):
+    """Flatten a report into CSV rows, one per group."""
+    header = (["group", "students", "complete"] + [f"pathway:{p}" for p in PATHWAY_NAMES]
+              + [f"strongest:{s}" for s in SUBJECTS] + [f"weakest:{s}" for s in SUBJECTS]
+              + [f"mean:{s}" for s in SUBJECTS])
+    yield header
+    for name, grp in rep["groups"].items():
+        yield ([name, grp["students"], grp["complete"]] + list(grp["pathways"].values())
+               + list(grp["strongest"].values()) + list(grp["weakest"].values()) + list(grp["mean"].values()))
+
+
+# =============================================================
+#  CLI
+# =============================================================
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="EduTena cohort pathway reports.")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("report", help="score every assessed student and print a report")
+    r.add_argument("--db", default=os.getenv("DATABASE_URL"))
+    r.add_argument("--channel", choices=CHANNELS)
+    r.add_argument("--level"); r.add_argument("--grade"); r.add_argument("--term")
+    r.add_argument("--group-by", choices=GROUP_COLUMNS)
+    r.add_argument("--format", choices=("json", "csv"), default="json")
+    r.add_argument("--out", help="file to write (default: stdout)")
+    sub.add_parser("parity", help="check pathway_codes against app.calculate_pathway_from_scores")
+    args = p.parse_args(argv)
+    if args.cmd == "parity":
+        from app import calculate_pathway_from_scores
+        bad = verify_parity(calculate_pathway_from_scores)
+        print(json.dumps({"combinations": 5 ** len(SUBJECTS), "mismatches": bad}))
+        sys.exit(1 if bad else 0)
+    if not args.db: sys.exit("Set DATABASE_URL or pass --db.")
+    import psycopg
+    with psycopg.connect(args.db) as conn:
+        rep = report(load(conn, channel=args.channel, level=args.level, grade=args.grade, term=args.term),
+                     args.group_by)
+    out = open(args.out, "w", newline="") if args.out else sys.stdout
+    if args.format == "json": json.dump(rep, out, indent=2); out.write("\n")
+    else: csv.writer(out).writerows(report_rows(rep))
+    if args.out: out.close()
+
+
+if __name__ == "__main__":
+    main()
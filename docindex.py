@@ -0,0 +1,296 @@
+"""Offline retrieval index over the documents in data/.
+
+    python docindex.py build [--data data] [--out index] [--full]
+
+Extracts PDF / DOCX / TXT files, splits them into overlapping word chunks
+and writes a BM25 inverted index as flat NumPy arrays. At query time the
+arrays are memory-mapped, so only the postings for the question's terms
+are touched and the prompt gets the top-k chunks instead of whole files.
+
+Each build writes a new generation directory under --out and then flips
+the CURRENT pointer with an atomic rename, so a running server never sees
+a half-written index. A per-file and per-chunk SHA-256 manifest lets a
+rebuild skip extraction for unchanged files and reuse the term counts of
+unchanged chunks.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+import sys
+import time
+import zipfile
+from collections import Counter
+from xml.etree import ElementTree
+
+import numpy as np
+
+log = logging.getLogger("edutena.docs")
+
+CHUNK_WORDS   = 160
+CHUNK_OVERLAP = 40
+BM25_K1 = 1.2
+BM25_B  = 0.75
+KEEP_GENERATIONS = 2
+SUPPORTED = (".pdf", ".docx", ".txt", ".md")
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+_STOPWORDS = frozenset("""a an and are as at be but by can do does for from has have how i if in into is it
+its me my no not of on or our she so that the their them then there these they this to
+was we were what when where which who why will with you your""".split())
+
+
+# =============================================================
+#  EXTRACTION + CHUNKING
+# =============================================================
+
+def extract_text(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        from pypdf import PdfReader
+        return "\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+    if ext == ".docx":
+        ns = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+        with zipfile.ZipFile(path) as z:
+            root = ElementTree.fromstring(z.read("word/document.xml"))
+        return "\n".join("".join(t.text or "" for t in p.iter(f"{ns}t")) for p in root.iter(f"{ns}p"))
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+def chunk_text(text, size=CHUNK_WORDS, overlap=CHUNK_OVERLAP):
+    words = text.split()
+    step = size - overlap
+    return [" ".join(words[i:i + size]) for i in range(0, max(len(words) - overlap, 1), step) if words[i:i + size]]
+
+def tokenize(text):
+    return [w for w in _TOKEN.findall(text.lower()) if w not in _STOPWORDS and len(w) > 1]
+
+def list_documents(data_dir):
+    return sorted(f for f in os.listdir(data_dir)
+                  if f.lower().endswith(SUPPORTED) and not f.startswith((".", "~$")))
+
+
+# =============================================================
+#  BUILD
+# =============================================================
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""): h.update(block)
+    return h.hexdigest()
+
+def write_index(out_dir, chunks, sources, term_counts=None, manifest=None):
+    """chunks: list of (source_idx, text). Writes meta.json + flat arrays into out_dir.
+
+    term_counts optionally carries a precomputed Counter per chunk (None = tokenize).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    postings: dict[str, dict[int, int]] = {}
+    doc_len = np.zeros(len(chunks), dtype=np.float32)
+    for cid, (_, text) in enumerate(chunks):
+        counts = (term_counts and term_counts[cid]) or Counter(tokenize(text))
+        doc_len[cid] = sum(counts.values())
+        for tok, tf in counts.items():
+            postings.setdefault(tok, {})[cid] = tf
+    vocab, docs, tfs, pos = {}, [], [], 0
+    for term in sorted(postings):
+        plist = postings[term]
+        vocab[term] = [pos, len(plist)]; pos += len(plist)
+        docs.extend(plist); tfs.extend(plist.values())
+    encoded = [text.encode("utf-8") for _, text in chunks]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    np.save(os.path.join(out_dir, "post_doc.npy"), np.asarray(docs, dtype=np.int32))
+    np.save(os.path.join(out_dir, "post_tf.npy"), np.asarray(tfs, dtype=np.uint16))
+    np.save(os.path.join(out_dir, "doc_len.npy"), doc_len)
+    np.save(os.path.join(out_dir, "chunk_off.npy"), offsets)
+    np.save(os.path.join(out_dir, "chunk_src.npy"), np.asarray([s for s, _ in chunks], dtype=np.int32))
+    with open(os.path.join(out_dir, "chunks.bin"), "wb") as f:
+        f.write(b"".join(encoded))
+    with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": 1, "k1": BM25_K1, "b": BM25_B, "n_chunks": len(chunks),
+                   "avgdl": float(doc_len.mean()) if len(chunks) else 0.0,
+                   "sources": sources, "vocab": vocab}, f, ensure_ascii=False)
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"files": manifest or {}}, f, ensure_ascii=False)
+
+def current_generation(root):
+    """Directory of the live index under root, or None."""
+    try:
+        with open(os.path.join(root, "CURRENT"), encoding="utf-8") as f:
+            return os.path.join(root, f.read().strip())
+    except FileNotFoundError:
+        return root if os.path.exists(os.path.join(root, "meta.json")) else None
+
+def _publish(root, gen):
+    tmp = os.path.join(root, "CURRENT.tmp")
+    with open(tmp, "w", encoding="utf-8") as f: f.write(gen)
+    os.replace(tmp, os.path.join(root, "CURRENT"))
+    gens = sorted(d for d in os.listdir(root) if d.startswith("gen-"))
+    for old in gens[:-KEEP_GENERATIONS]: shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+
+def build_index(data_dir, root, full=False):
+    """(Re)build the index under root, re-extracting only new or changed files."""
+    prev = None if full else DocIndex.open(root)
+    prev_files = prev.manifest if prev else {}
+    prev_by_sha = {sha: f["first"] + i for f in prev_files.values() for i, sha in enumerate(f["chunks"])}
+    sources, chunks, reuse_ids, files = [], [], [], {}
+    stats = {"files_extracted": 0, "files_reused": 0}
+    for name in list_documents(data_dir):
+        digest = _file_sha256(os.path.join(data_dir, name))
+        old = prev_files.get(name)
+        if old and old["sha256"] == digest:
+            texts = [prev.chunk(old["first"] + i) for i in range(len(old["chunks"]))]
+            stats["files_reused"] += 1
+        else:
+            texts = chunk_text(extract_text(os.path.join(data_dir, name)))
+            stats["files_extracted"] += 1
+        shas = [_sha256(t.encode("utf-8")) for t in texts]
+        files[name] = {"sha256": digest, "first": len(chunks), "chunks": shas}
+        sources.append(name)
+        for text, sha in zip(texts, shas):
+            chunks.append((len(sources) - 1, text)); reuse_ids.append(prev_by_sha.get(sha))
+    reused = sum(r is not None for r in reuse_ids)
+    stats.update(documents=len(sources), chunks=len(chunks), chunks_reused=reused, chunks_rebuilt=len(chunks) - reused)
+    if prev and files == prev_files:
+        return {**stats, "generation": os.path.basename(prev.path), "unchanged": True}
+    prev_counts = prev.chunk_terms(r for r in reuse_ids if r is not None) if prev else {}
+    os.makedirs(root, exist_ok=True)
+    gen = f"gen-{int(time.time() * 1000)}"
+    tmp = os.path.join(root, f".tmp-{gen}")
+    write_index(tmp, chunks, sources, [prev_counts.get(r) for r in reuse_ids], files)
+    os.rename(tmp, os.path.join(root, gen))
+    _publish(root, gen)
+    if prev: prev.close()
+    return {**stats, "generation": gen, "unchanged": False}
+
+
+# =============================================================
+#  QUERY
+# =============================================================
+
+class IndexWatcher:
+    """Serves the live DocIndex and picks up a newly published generation.
+
+    CURRENT is re-read at most every check_interval seconds; when it points
+    somewhere new the fresh index is opened and swapped in with a single
+    attribute assignment, so in-flight readers keep a consistent view.
+    """
+
+    def __init__(self, root, check_interval=30.0):
+        self.root = root; self.check_interval = check_interval
+        self._gen = None; self._index = None; self._next_check = 0.0
+
+    def current(self):
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            gen = current_generation(self.root)
+            if gen != self._gen:
+                old, self._index = self._index, (DocIndex(gen) if gen else None)
+                self._gen = gen
+                if gen: log.info("serving index %s", gen)
+                else: log.warning("no index at %s", self.root)
+                if old: old.close()
+        return self._index
+
+
+class DocIndex:
+    """Read-only BM25 index; arrays and chunk text are memory-mapped."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        try:
+            with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+                self.manifest = json.load(f)["files"]
+        except FileNotFoundError:
+            self.manifest = {}
+        self.path = path
+        self.k1 = meta["k1"]; self.b = meta["b"]; self.n = meta["n_chunks"]; self.avgdl = meta["avgdl"] or 1.0
+        self.sources = meta["sources"]; self.vocab = meta["vocab"]
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        self.post_doc = load("post_doc.npy"); self.post_tf = load("post_tf.npy")
+        self.doc_len = load("doc_len.npy"); self.chunk_off = load("chunk_off.npy")
+        self.chunk_src = load("chunk_src.npy")
+        self._fh = open(os.path.join(path, "chunks.bin"), "rb")
+        self._text = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ) if self.chunk_off[-1] else b""
+
+    @classmethod
+    def open(cls, root):
+        """Return the live index under root, or None when it hasn't been built yet."""
+        gen = current_generation(root)
+        return cls(gen) if gen else None
+
+    def chunk(self, i):
+        return self._text[int(self.chunk_off[i]):int(self.chunk_off[i + 1])].decode("utf-8")
+
+    def search(self, query, k=4):
+        """Top-k (text, score, source) for query, best first."""
+        terms = [self.vocab[t] for t in set(tokenize(query)) if t in self.vocab]
+        if not terms or not self.n: return []
+        scores = np.zeros(self.n, dtype=np.float32)
+        for start, count in terms:
+            docs = self.post_doc[start:start + count]
+            tf = self.post_tf[start:start + count].astype(np.float32)
+            idf = math.log(1 + (self.n - count + 0.5) / (count + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / self.avgdl)
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + norm)
+        top = np.argpartition(-scores, k)[:k] if self.n > k else np.arange(self.n)
+        top = top[np.argsort(-scores[top])]
+        return [(self.chunk(i), float(scores[i]), self.sources[self.chunk_src[i]]) for i in top if scores[i] > 0]
+
+    def chunk_terms(self, ids):
+        """Term counts per chunk id, recovered from the postings (used to skip re-tokenizing)."""
+        wanted = np.fromiter(set(ids), dtype=np.int32)
+        out = {int(i): Counter() for i in wanted}
+        if not len(wanted): return out
+        for term, (start, count) in self.vocab.items():
+            docs = self.post_doc[start:start + count]
+            hit = np.isin(docs, wanted)
+            if hit.any():
+                for d, tf in zip(docs[hit], self.post_tf[start:start + count][hit]): out[int(d)][term] = int(tf)
+        return out
+
+    def close(self):
+        if isinstance(self._text, mmap.mmap): self._text.close()
+        self._fh.close()
+
+
+# =============================================================
+#  CLI
+# =============================================================
+
+def main(argv=None):
+    here = os.path.dirname(os.path.abspath(__file__))
+    p = argparse.ArgumentParser(description="Build or query the EduTena document index.")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="index new/changed documents in --data and publish a new generation")
+    b.add_argument("--data", default=os.path.join(here, "data"))
+    b.add_argument("--out", default=os.getenv("DOC_INDEX_DIR", os.path.join(here, "index")))
+    b.add_argument("--full", action="store_true", help="ignore the previous generation and rebuild everything")
+    q = sub.add_parser("query", help="print the top-k chunks for a question")
+    q.add_argument("question")
+    q.add_argument("--index", default=os.getenv("DOC_INDEX_DIR", os.path.join(here, "index")))
+    q.add_argument("-k", type=int, default=4)
+    args = p.parse_args(argv)
+    if args.cmd == "build":
+        print(json.dumps(build_index(args.data, args.out, args.full)))
+    else:
+        idx = DocIndex.open(args.index)
+        if idx is None: sys.exit(f"No index at {args.index}; run `python docindex.py build` first.")
+        for text, score, src in idx.search(args.question, args.k):
+            print(f"[{score:.2f}] {src}: {text[:200]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,493 @@
+"""End-to-end load test for the /sms and /ussd webhooks.
+
+    DATABASE_URL=postgresql://localhost/edutena_bench python loadtest.py run --users 50 --iterations 10 --out bench.json
+    python loadtest.py compare before.json after.json
+    python loadtest.py sms --users 200 --replies 20 --shared 0.3
+    python loadtest.py render --repeat 2000
+    DATABASE_URL=postgresql://localhost/edutena_bench python loadtest.py retention --rows 5000000
+
+Runs the app in-process against a local Postgres, with the fake SMS gateway
+(SMS_FAKE_LATENCY) and a stub Gemini server on localhost whose latency is
+configurable, then replays full SMS and USSD journeys as Africa's Talking
+form posts from many concurrent learners. Reports requests/sec, p50/p95/p99
+latency per (channel, state), Postgres statements per request and cold
+start (import plus the startup hook, with its statement count), and writes
+everything as JSON so two commits can be compared.
+
+Use a scratch database: tables are created on startup and the benchmark
+learners (phones starting PHONE_PREFIX) are deleted afterwards unless
+--keep-data is given.
+
+`sms` needs no database: it pushes replies through send_reply and the
+outbound dispatcher into the fake gateway and reports messages/sec, API
+calls and per-reply latency, with a share of canned bodies that several
+learners receive (the ones worth batching).
+
+`render` times flow_render for every screen in SCREENS, per channel and
+language, and the USSD paginator on each USSD screen: microseconds per call,
+no I/O.
+
+`retention` seeds chat_history with millions of rows for PHONE_PREFIX
+phones (generate_series, spread over --days), then times conversation
+lookups before and after one compact_chat_history() pass. Compaction
+runs over the whole table, so again: a scratch database.
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+PHONE_PREFIX = "+25499"
+SERVICE_CODE = "*384*1#"
+
+# name -> (channel, [(state being answered, reply)]). USSD replies are joined
+# into the cumulative text path the gateway sends; "DIAL" is the opening request.
+JOURNEYS = {
+    "sms_senior": ("sms", [("START", "START"), ("LANG", "1"), ("MODE_SELECT", "1"), ("LEVEL", "2"),
+                           ("SENIOR_GRADE", "1"), ("SENIOR_PATHWAY", "1"), ("CAREER_SELECT", "2")]),
+    "sms_jss":    ("sms", [("START", "START"), ("LANG", "2"), ("MODE_SELECT", "1"), ("LEVEL", "1"),
+                           ("JSS_GRADE", "1"), ("TERM", "2"), ("MATH", "1"), ("SCIENCE", "2"),
+                           ("SOCIAL", "3"), ("CREATIVE", "4"), ("TECH", "2")]),
+    "sms_rag":    ("sms", [("START", "START"), ("LANG", "1"), ("MODE_SELECT", "2"),
+                           ("RAG_CHAT", "Which subjects are in the STEM pathway?"),
+                           ("RAG_CHAT", "And what careers does it lead to?")]),
+    "ussd_grade9": ("ussd", [("DIAL", ""), ("LANG", "1"), ("MODE_SELECT", "1"), ("LEVEL", "1"),
+                             ("JSS_GRADE", "3"), ("TERM", "1"), ("MATH", "1"), ("SCIENCE", "1"),
+                             ("SOCIAL", "3"), ("CREATIVE", "2"), ("TECH", "1"), ("RESULT", "1"),
+                             ("USSD_CAREER_SELECT", "2")]),
+    "ussd_senior": ("ussd", [("DIAL", ""), ("LANG", "2"), ("MODE_SELECT", "1"), ("LEVEL", "2"),
+                             ("SENIOR_GRADE", "2"), ("SENIOR_PATHWAY", "2"), ("USSD_CAREER_SELECT", "7"),
+                             ("USSD_CAREER_SELECT_ALL", "9")]),
+    "ussd_rag":   ("ussd", [("DIAL", ""), ("LANG", "1"), ("MODE_SELECT", "2"), ("USSD_RAG_TOPIC", "2")]),
+}
+
+_label = contextvars.ContextVar("label", default="background")
+statements: dict[str, int] = defaultdict(int)
+
+
+# =============================================================
+#  STUB GEMINI
+# =============================================================
+
+class StubGemini:
+    """Minimal HTTP/1.1 server speaking generateContent and streamGenerateContent (SSE)."""
+
+    ANSWER = ("Competency Based Education focuses on what learners can do. The STEM pathway covers "
+              "Mathematics, Sciences and Technical subjects. Careers include engineering, medicine and "
+              "software development. Talk to your teachers about subject choices early. ") * 2
+
+    def __init__(self, latency, jitter, chunks=6, cut_after=None, fail_first=0):
+        self.latency = latency; self.jitter = jitter; self.chunks = chunks
+        self.cut_after = cut_after          # drop the connection after this many stream events
+        self.fail_first = fail_first        # answer this many requests with 429 first
+        self.calls = 0; self.connections = 0; self.server = None
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close(); await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+                path = head[0].split(" ")[1]
+                length = next((int(h.split(":", 1)[1]) for h in head[1:] if h.lower().startswith("content-length:")), 0)
+                await reader.readexactly(length)
+                self.calls += 1
+                if self.calls <= self.fail_first:
+                    writer.write(b"HTTP/1.1 429 Too Many Requests\r\nRetry-After: 0\r\nContent-Length: 0\r\n\r\n")
+                    await writer.drain(); continue
+                await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+                usage = {"promptTokenCount": 900, "candidatesTokenCount": 120}
+                if ":streamGenerateContent" in path:
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                                 b"Transfer-Encoding: chunked\r\n\r\n")
+                    step = -(-len(self.ANSWER) // self.chunks)
+                    for k, i in enumerate(range(0, len(self.ANSWER), step)):
+                        if k == self.cut_after: return
+                        event = {"candidates": [{"content": {"parts": [{"text": self.ANSWER[i:i + step]}]}}],
+                                 "usageMetadata": usage}
+                        if i + step >= len(self.ANSWER): event["candidates"][0]["finishReason"] = "STOP"
+                        data = f"data: {json.dumps(event)}\r\n\r\n".encode()
+                        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                        await writer.drain(); await asyncio.sleep(self.latency / self.chunks)
+                    writer.write(b"0\r\n\r\n")
+                else:
+                    body = json.dumps({"candidates": [{"content": {"parts": [{"text": self.ANSWER}]},
+                                                       "finishReason": "STOP"}], "usageMetadata": usage}).encode()
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                                 b"Content-Length: %d\r\n\r\n" % len(body) + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# =============================================================
+#  DRIVER
+# =============================================================
+
+def _count_statements():
+    """Attribute every psycopg statement to the request (contextvar) that issued it."""
+    import psycopg
+    original = psycopg.AsyncCursor.execute
+    async def execute(self, *args, **kwargs):
+        statements[_label.get()] += 1
+        return await original(self, *args, **kwargs)
+    psycopg.AsyncCursor.execute = execute
+
+
+async def _journey(client, name, phone, samples, errors):
+    channel, steps = JOURNEYS[name]
+    session = f"ATUid_{random.getrandbits(48):012x}"; path = []
+    for state, reply in steps:
+        if channel == "sms":
+            url, data = "/sms", {"from": phone, "text": reply, "id": f"{random.getrandbits(64):016x}"}
+        else:
+            if state != "DIAL": path.append(reply)
+            url, data = "/ussd", {"sessionId": session, "serviceCode": SERVICE_CODE,
+                                  "phoneNumber": phone, "text": "*".join(path)}
+        key = f"{channel}:{state}"
+        token = _label.set(key); t0 = time.perf_counter()
+        try:
+            r = await client.post(url, data=data)
+            if r.status_code != 200: errors[key] += 1
+        except Exception as e:
+            errors[key] += 1; print(f"[loadtest] {key}: {type(e).__name__}: {e}", file=sys.stderr)
+        finally:
+            samples[key].append(time.perf_counter() - t0); _label.reset(token)
+
+
+async def _user(client, uid, iterations, mix, samples, errors):
+    phone = f"{PHONE_PREFIX}{uid:07d}"
+    names, weights = zip(*mix.items())
+    rng = random.Random(uid)
+    for _ in range(iterations):
+        await _journey(client, rng.choices(names, weights)[0], phone, samples, errors)
+
+
+def _percentiles(values):
+    a = np.asarray(values) * 1000
+    p50, p95, p99 = np.percentile(a, [50, 95, 99])
+    return {"count": len(a), "mean_ms": round(float(a.mean()), 2), "p50_ms": round(float(p50), 2),
+            "p95_ms": round(float(p95), 2), "p99_ms": round(float(p99), 2), "max_ms": round(float(a.max()), 2)}
+
+
+def _commit():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError: return None
+
+
+async def run(args) -> dict:
+    stub = StubGemini(args.gemini_latency, args.gemini_jitter)
+    port = await stub.start()
+    os.environ.update({
+        "DATABASE_URL": args.db, "GEMINI_API_KEY": "stub",
+        "GEMINI_URL": f"http://127.0.0.1:{port}/v1beta/models/stub:generateContent",
+        "SMS_FAKE_LATENCY": str(args.sms_latency), "LLM_CACHE_WARMUP": "",
+        # Scripted learners have no think time between replies, so every iteration would hit the
+        # per-phone bucket; de-duplication stays on (posts carry an id like the gateway's).
+        "INBOUND_RATE": "0",
+    })
+    _count_statements()
+    import httpx
+    t0 = time.perf_counter()
+    import app as service
+    import_s = time.perf_counter() - t0
+
+    mix = dict((k, float(v)) for k, v in (p.split("=") for p in args.mix.split(","))) if args.mix \
+        else {name: 1.0 for name in JOURNEYS}
+    unknown = set(mix) - set(JOURNEYS)
+    if unknown: sys.exit(f"Unknown journeys: {', '.join(sorted(unknown))}")
+
+    t0 = time.perf_counter()
+    await service.app.router.startup()
+    startup = {"import_ms": round(1000 * import_s, 1), "startup_ms": round(1000 * (time.perf_counter() - t0), 1),
+               "db_statements": sum(statements.values())}
+    statements.clear()                      # schema setup isn't part of the load
+    samples, errors = defaultdict(list), defaultdict(int)
+    transport = httpx.ASGITransport(app=service.app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(_user(client, uid, args.iterations, mix, samples, errors)
+                                   for uid in range(args.users)))
+            elapsed = time.perf_counter() - started
+        try: await asyncio.wait_for(service.job_queue.join(), args.drain_timeout)
+        except asyncio.TimeoutError: print("[loadtest] background jobs still running", file=sys.stderr)
+        await service.sms_dispatcher.drain()
+        if not args.keep_data:
+            like = PHONE_PREFIX + "%"
+            for sql in ("DELETE FROM learners WHERE phone LIKE %s", "DELETE FROM chat_history WHERE phone LIKE %s",
+                        "DELETE FROM chat_summaries WHERE phone LIKE %s",
+                        "DELETE FROM jobs WHERE payload->>'phone' LIKE %s"):
+                token = _label.set("cleanup")
+                try: await service.db_execute(sql, (like,))
+                finally: _label.reset(token)
+        report = {
+            "commit": _commit(), "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {"users": args.users, "iterations": args.iterations, "mix": mix,
+                       "gemini_latency": args.gemini_latency, "gemini_jitter": args.gemini_jitter,
+                       "sms_latency": args.sms_latency},
+            "requests": sum(len(v) for v in samples.values()),
+            "errors": sum(errors.values()),
+            "duration_s": round(elapsed, 3),
+            "startup": startup,
+        }
+        report["rps"] = round(report["requests"] / elapsed, 1)
+        report["latency"] = _percentiles([x for v in samples.values() for x in v])
+        report["states"] = {key: {**_percentiles(v), "errors": errors.get(key, 0),
+                                  "db_statements_per_request": round(statements.get(key, 0) / len(v), 2)}
+                            for key, v in sorted(samples.items())}
+        request_statements = sum(statements.get(key, 0) for key in samples)
+        report["db_statements_per_request"] = round(request_statements / max(report["requests"], 1), 2)
+        report["db_statements_background"] = statements.get("background", 0)
+        report["gemini_calls"] = stub.calls
+        report["jobs"] = service.job_stats()
+        report["sms"] = dict(service.sms_dispatcher.stats)
+        report["sms_billing"] = dict(service.sms_billing)
+        report["student_cache"] = service.student_cache.stats()
+        report["inbound"] = service.inbound_guard.stats()
+        return report
+    finally:
+        await service.app.router.shutdown()
+        await stub.stop()
+
+
+async def sms_run(args) -> dict:
+    os.environ.update({"SMS_FAKE_LATENCY": str(args.sms_latency), "LOG_LEVEL": "WARNING"})
+    import app as service
+    gateway = service.FakeSMSGateway(args.sms_latency)
+    service.sms_dispatcher = service.SMSDispatcher(gateway, args.window, service.SMS_BATCH_MAX,
+                                                   service.TokenBucket(args.rate, args.rate))
+    canned = [service.t("en", key) for key in ("done", "thank_you", "paused", "no_pathway")]
+    rng = random.Random(0); latencies = []
+
+    async def learner(uid):
+        phone = f"{PHONE_PREFIX}{uid:07d}"
+        for i in range(args.replies):
+            body = rng.choice(canned) if rng.random() < args.shared else \
+                f"{uid}/{i}: " + StubGemini.ANSWER[:args.length]
+            t0 = time.perf_counter()
+            await service.send_reply(phone, body)
+            latencies.append(time.perf_counter() - t0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(learner(uid) for uid in range(args.users)))
+    elapsed = time.perf_counter() - started
+    await service.sms_dispatcher.drain()
+    stats = service.sms_dispatcher.stats
+    return {"commit": _commit(), "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {"users": args.users, "replies": args.replies, "shared": args.shared,
+                       "length": args.length, "window": args.window, "rate": args.rate,
+                       "sms_latency": args.sms_latency},
+            "replies": len(latencies), "messages": stats["messages"], "api_calls": stats["api_calls"],
+            "failed": stats["failed"], "duration_s": round(elapsed, 3),
+            "messages_per_s": round(stats["messages"] / elapsed, 1), "latency": _percentiles(latencies)}
+
+
+async def retention_run(args) -> dict:
+    os.environ.update({"DATABASE_URL": args.db, "LOG_LEVEL": "WARNING", "LLM_CACHE_WARMUP": "",
+                       "CHAT_KEEP_TURNS": str(args.keep_turns), "CHAT_RETENTION_DAYS": str(args.retention_days)})
+    import app as service
+    await service.app.router.startup()
+    rng = random.Random(0)
+
+    async def lookups():
+        took = []
+        for _ in range(args.lookups):
+            phone = f"{PHONE_PREFIX}{rng.randrange(args.phones):07d}"
+            t0 = time.perf_counter(); await service.load_conversation(phone)
+            took.append(time.perf_counter() - t0)
+        return _percentiles(took)
+
+    async def count():
+        return (await service.db_fetchone("SELECT count(*) FROM chat_history WHERE phone LIKE %s",
+                                          (PHONE_PREFIX + "%",)))[0]
+
+    try:
+        t0 = time.perf_counter()
+        async with service.db_pool.connection() as conn:
+            cur = conn.cursor()
+            if service.CHAT_PARTITIONED:         # the app only creates partitions from this month on
+                now = time.gmtime()
+                for m in range(now.tm_mon - args.days // 28 - 1, now.tm_mon):
+                    lo, hi = service._month_start(now.tm_year, m), service._month_start(now.tm_year, m + 1)
+                    await cur.execute(f"CREATE TABLE IF NOT EXISTS chat_history_p{lo[:7].replace('-', '')} "
+                                      f"PARTITION OF chat_history FOR VALUES FROM ('{lo}') TO ('{hi}')")
+            await cur.execute("""INSERT INTO chat_history(phone, role, message, created_at)
+                                 SELECT %s || lpad((g %% %s)::text, 7, '0'),
+                                        CASE WHEN (g / %s) %% 2 = 0 THEN 'user' ELSE 'assistant' END,
+                                        repeat('x', %s), NOW() - random() * %s * INTERVAL '1 day'
+                                 FROM generate_series(1, %s) g""",
+                              (PHONE_PREFIX, args.phones, args.phones, args.length, args.days, args.rows))
+            await cur.execute("ANALYZE chat_history")
+        seed_s = time.perf_counter() - t0
+        before = {"rows": await count(), "lookup": await lookups()}
+        t0 = time.perf_counter()
+        compacted = await service.compact_chat_history()
+        compact_s = time.perf_counter() - t0
+        after = {"rows": await count(), "lookup": await lookups()}
+        return {"commit": _commit(), "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "config": {"rows": args.rows, "phones": args.phones, "days": args.days, "length": args.length,
+                           "keep_turns": args.keep_turns, "retention_days": args.retention_days,
+                           "partitioned": service.CHAT_PARTITIONED},
+                "seed_s": round(seed_s, 1), "compact_s": round(compact_s, 1), "compacted": compacted,
+                "before": before, "after": after}
+    finally:
+        if not args.keep_data:
+            await service.db_execute("DELETE FROM chat_history WHERE phone LIKE %s", (PHONE_PREFIX + "%",))
+        await service.app.router.shutdown()
+
+
+RENDER_FIELDS = {"level": "Senior", "grade": "Grade 10", "term": "Term 1", "pathway": "STEM"}
+SMS_ONLY_SCREENS = ("RAG_CHAT", "CAREER_SELECT", "CAREER_SELECT_ALL")
+
+
+def render_run(args) -> dict:
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import app as service
+    def per_call(fn):
+        best = float("inf")
+        for _ in range(3):                  # best of three runs of --repeat calls
+            t0 = time.perf_counter()
+            for _ in range(args.repeat): fn()
+            best = min(best, time.perf_counter() - t0)
+        return round(best / args.repeat * 1e6, 2)
+    screens = {}
+    for state in service.SCREENS:
+        for channel in ("sms", "ussd"):
+            if state.startswith("USSD_") if channel == "sms" else state in SMS_ONLY_SCREENS: continue
+            for lang in service.UI:
+                f = {**RENDER_FIELDS, "lang": lang}
+                body = service.flow_render(channel, state, f)
+                row = {"render_us": per_call(lambda: service.flow_render(channel, state, f)),
+                       "bytes": len(body.encode())}
+                if channel == "ussd":
+                    row["paginate_us"] = per_call(lambda: service.paginate_ussd(body))
+                    row["pages"] = len(service.paginate_ussd(body))
+                screens[f"{channel}:{state}:{lang}"] = row
+    return {"commit": _commit(), "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {"repeat": args.repeat, "fields": RENDER_FIELDS}, "screens": screens}
+
+
+def compare(a: dict, b: dict):
+    """Print p95 and statements/request per state, before -> after."""
+    def delta(x, y): return f"{(y - x) / x * 100:+.0f}%" if x else "n/a"
+    print(f"commit   {a.get('commit')} -> {b.get('commit')}")
+    print(f"rps      {a['rps']} -> {b['rps']} ({delta(a['rps'], b['rps'])})")
+    print(f"p95      {a['latency']['p95_ms']} -> {b['latency']['p95_ms']} ms "
+          f"({delta(a['latency']['p95_ms'], b['latency']['p95_ms'])})")
+    print(f"db/req   {a['db_statements_per_request']} -> {b['db_statements_per_request']}")
+    sa, sb = a.get("startup"), b.get("startup")
+    if sa and sb:
+        print(f"startup  {sa['import_ms'] + sa['startup_ms']:.0f} -> {sb['import_ms'] + sb['startup_ms']:.0f} ms "
+              f"(import {sa['import_ms']} -> {sb['import_ms']}, {sa['db_statements']} -> {sb['db_statements']} statements)")
+    print(f"\n{'state':<32}{'p95 ms':>22}{'db/req':>16}")
+    for key in sorted(set(a["states"]) | set(b["states"])):
+        x, y = a["states"].get(key), b["states"].get(key)
+        if not (x and y): print(f"{key:<32}{'only in ' + ('before' if x else 'after'):>22}"); continue
+        print(f"{key:<32}{x['p95_ms']:>9} -> {y['p95_ms']:<9}"
+              f"{x['db_statements_per_request']:>7} -> {y['db_statements_per_request']:<6}")
+
+
+# =============================================================
+#  CLI
+# =============================================================
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Load-test the EduTena /sms and /ussd webhooks.")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("run", help="replay journeys against the app in-process")
+    r.add_argument("--db", default=os.getenv("DATABASE_URL"), help="scratch Postgres (default: DATABASE_URL)")
+    r.add_argument("--users", type=int, default=50, help="concurrent learners")
+    r.add_argument("--iterations", type=int, default=10, help="journeys per learner")
+    r.add_argument("--mix", default="", help="journey weights, e.g. sms_rag=2,ussd_grade9=1 (default: all equal)")
+    r.add_argument("--gemini-latency", type=float, default=0.8, help="stub Gemini mean latency, seconds")
+    r.add_argument("--gemini-jitter", type=float, default=0.2)
+    r.add_argument("--sms-latency", type=float, default=0.05, help="fake SMS gateway latency, seconds")
+    r.add_argument("--drain-timeout", type=float, default=60, help="seconds to wait for background jobs")
+    r.add_argument("--keep-data", action="store_true", help="leave the benchmark learners in the database")
+    r.add_argument("--out", help="write the JSON report here (default: stdout)")
+    c = sub.add_parser("compare", help="compare two JSON reports")
+    c.add_argument("before"); c.add_argument("after")
+    s = sub.add_parser("sms", help="outbound SMS throughput (messages/sec), no database")
+    s.add_argument("--users", type=int, default=200, help="concurrent learners")
+    s.add_argument("--replies", type=int, default=20, help="replies per learner")
+    s.add_argument("--shared", type=float, default=0.3, help="share of replies that are canned bodies")
+    s.add_argument("--length", type=int, default=300, help="characters in a one-off reply")
+    s.add_argument("--window", type=float, default=float(os.getenv("SMS_BATCH_WINDOW", "0.25")),
+                   help="batch window, seconds (default: SMS_BATCH_WINDOW)")
+    s.add_argument("--rate", type=float, default=1000, help="gateway API calls per second")
+    s.add_argument("--sms-latency", type=float, default=0.05, help="fake SMS gateway latency, seconds")
+    s.add_argument("--out", help="write the JSON report here (default: stdout)")
+    t = sub.add_parser("retention", help="seed millions of chat_history rows, time lookups and compaction")
+    t.add_argument("--db", default=os.getenv("DATABASE_URL"), help="scratch Postgres (default: DATABASE_URL)")
+    t.add_argument("--rows", type=int, default=2_000_000, help="chat_history rows to seed")
+    t.add_argument("--phones", type=int, default=20_000, help="learners the rows are spread over")
+    t.add_argument("--days", type=int, default=240, help="seeded rows are spread over this many days back")
+    t.add_argument("--length", type=int, default=200, help="characters per message")
+    t.add_argument("--keep-turns", type=int, default=40, help="CHAT_KEEP_TURNS for the compaction pass")
+    t.add_argument("--retention-days", type=int, default=180, help="CHAT_RETENTION_DAYS for the compaction pass")
+    t.add_argument("--lookups", type=int, default=500, help="conversation lookups timed before and after")
+    t.add_argument("--keep-data", action="store_true", help="leave the seeded rows in the database")
+    t.add_argument("--out", help="write the JSON report here (default: stdout)")
+    d = sub.add_parser("render", help="time flow_render and the USSD paginator per screen")
+    d.add_argument("--repeat", type=int, default=2000, help="calls per timing")
+    d.add_argument("--out", help="write the JSON report here (default: stdout)")
+    args = p.parse_args(argv)
+    if args.cmd == "compare":
+        with open(args.before) as fa, open(args.after) as fb: compare(json.load(fa), json.load(fb))
+        return
+    if args.cmd == "sms":
+        report = asyncio.run(sms_run(args))
+        if args.out:
+            with open(args.out, "w") as f: f.write(json.dumps(report, indent=2) + "\n")
+        print(f"{report['messages']} messages in {report['api_calls']} API calls, {report['messages_per_s']} msg/s, "
+              f"p95 {report['latency']['p95_ms']} ms per reply" + (f" -> {args.out}" if args.out else ""))
+        return
+    if args.cmd == "render":
+        report = render_run(args)
+        if args.out:
+            with open(args.out, "w") as f: f.write(json.dumps(report, indent=2) + "\n")
+        print(f"{'screen':<40}{'render us':>10}{'paginate us':>13}{'bytes':>7}{'pages':>6}")
+        for key, row in report["screens"].items():
+            print(f"{key:<40}{row['render_us']:>10}{row.get('paginate_us', ''):>13}{row['bytes']:>7}"
+                  f"{row.get('pages', ''):>6}")
+        return
+    if not args.db: sys.exit("Set DATABASE_URL or pass --db (use a scratch database).")
+    if args.cmd == "retention":
+        report = asyncio.run(retention_run(args))
+        if args.out:
+            with open(args.out, "w") as f: f.write(json.dumps(report, indent=2) + "\n")
+        b, a = report["before"], report["after"]
+        print(f"seeded {args.rows} rows in {report['seed_s']} s; compaction {report['compact_s']} s "
+              f"({b['rows']} -> {a['rows']} rows); lookup p95 {b['lookup']['p95_ms']} -> {a['lookup']['p95_ms']} ms"
+              + (f" -> {args.out}" if args.out else ""))
+        return
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f: f.write(text + "\n")
+        print(f"{report['requests']} requests, {report['rps']} req/s, p95 {report['latency']['p95_ms']} ms, "
+              f"{report['db_statements_per_request']} DB statements/request -> {args.out}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+EduTena CBE — SMS encoding and splitting
+
+A message that is pure GSM 03.38 text is billed per 160 characters
+(153 per part once concatenated). One character outside that alphabet
+— an emoji, a box-drawing rule, a Gĩkũyũ ĩ/ũ — switches the whole
+message to UCS-2 at 70 characters (67 concatenated), roughly doubling
+the segment count.
+
+This module works out which encoding a text needs, how many segments
+it bills as, optionally transliterates it down to GSM-7, and splits
+long text at sentence boundaries into numbered parts that each stay
+within a segment budget.
+"""
+
+import re
+import unicodedata
+
+GSM7_BASIC = ("@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+              "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+GSM7_EXT   = "^{}\\[~]|€\f"          # sent as ESC + char: two septets each
+_GSM7      = set(GSM7_BASIC) | set(GSM7_EXT)
+
+# Per-segment capacity: (single message, each part of a concatenated one)
+CAPACITY = {"GSM-7": (160, 153), "UCS-2": (70, 67)}
+
+# Characters with a sensible GSM-7 stand-in. Anything else outside the
+# alphabet is decomposed (ĩ -> i) or, failing that, dropped.
+_TRANSLIT = {
+    "━": "-", "─": "-", "═": "=", "│": "|", "•": "-", "·": "-", "–": "-", "—": "-",
+    "‘": "'", "’": "'", "‚": "'", "“": '"', "”": '"', "„": '"', "…": "...",
+    "«": '"', "»": '"', "→": "->", "←": "<-", "✓": "OK", "✔": "OK", "✅": "OK",
+    "❌": "X", "✗": "X", "⭐": "*", "★": "*", " ": " ", "​": "",
+}
+
+_SENTENCE = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def encoding(text: str) -> str:
+    """The cheapest encoding that can carry text unchanged."""
+    return "GSM-7" if all(ch in _GSM7 for ch in text) else "UCS-2"
+
+
+def units(text: str, enc: str | None = None) -> int:
+    """Septets (GSM-7) or UTF-16 code units (UCS-2) the text occupies."""
+    enc = enc or encoding(text)
+    if enc == "GSM-7": return len(text) + sum(ch in GSM7_EXT for ch in text)
+    return len(text.encode("utf-16-le")) // 2
+
+
+def segments(text: str) -> int:
+    """Billable segments for text sent as a single (possibly concatenated) SMS."""
+    enc = encoding(text); n = units(text, enc)
+    single, multi = CAPACITY[enc]
+    return 1 if n <= single else -(-n // multi)
+
+
+def transliterate(text: str) -> str:
+    """Rewrite text into the GSM-7 alphabet, keeping it readable."""
+    out = []
+    for ch in text:
+        if ch in _GSM7: out.append(ch); continue
+        if ch in _TRANSLIT: out.append(_TRANSLIT[ch]); continue
+        base = "".join(c for c in unicodedata.normalize("NFKD", ch) if not unicodedata.combining(c))
+        out.append(base if base and all(c in _GSM7 for c in base) else "")
+    # Dropped emoji leave stray spaces; rules turn into long dash runs.
+    s = re.sub(r"-{6,}", "-" * 20, "".join(out))
+    return re.sub(r" *\n *", "\n", re.sub(r"[ \t]{2,}", " ", s))
+
+
+def _cut(text: str, enc: str, budget: int) -> int:
+    """Longest prefix of text within budget units, ending on a sentence or word if possible."""
+    if units(text, enc) <= budget: return len(text)
+    lo, hi = 0, len(text)
+    while lo < hi:                       # largest i with units(text[:i]) <= budget
+        mid = (lo + hi + 1) // 2
+        if units(text[:mid], enc) <= budget: lo = mid
+        else: hi = mid - 1
+    window = text[:lo]
+    ends = [m.end() for m in _SENTENCE.finditer(window)]
+    if ends and ends[-1] >= lo // 2: return ends[-1]
+    space = window.rfind(" ")
+    return space + 1 if space > 0 else lo
+
+
+def fit(text: str, max_segments: int = 1) -> int:
+    """Length of the first part split() would cut from text (unnumbered)."""
+    enc = encoding(text)
+    single, multi = CAPACITY[enc]
+    return _cut(text, enc, single if max_segments == 1 else multi * max_segments)
+
+
+def split(text: str, max_segments: int = 1, number: bool = True) -> list[str]:
+    """Split text into parts that each bill at most max_segments segments.
+
+    Text that already fits is returned as-is. Otherwise parts are cut at
+    sentence (else word) boundaries and, with number=True, prefixed "k/n ".
+    """
+    text = text.strip()
+    if segments(text) <= max_segments: return [text]
+    enc = encoding(text)
+    single, multi = CAPACITY[enc]
+    budget = single if max_segments == 1 else multi * max_segments
+    parts, total = [], 9
+    while True:                          # re-cut if the "k/n " prefix grew a digit
+        prefix = len(f"{total}/{total} ") if number else 0
+        parts, rest = [], text
+        while rest:
+            i = _cut(rest, enc, budget - prefix)
+            parts.append(rest[:i].strip()); rest = rest[i:].lstrip()
+        if not number or len(str(len(parts))) <= len(str(total)): break
+        total = 10 ** len(str(len(parts))) - 1
+    if number: parts = [f"{k}/{len(parts)} {p}" for k, p in enumerate(parts, 1)]
+    return parts
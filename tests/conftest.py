@@ -0,0 +1,58 @@
+"""Shared fixtures: the app imported with a fake SMS gateway and an in-memory learners table."""
+import os
+import re
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SMS_FAKE_LATENCY", "0")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+
+class FakeDB:
+    """Just enough Postgres for the learner select/upsert; every other statement is recorded and ignored."""
+
+    def __init__(self, learner_cols):
+        self.cols = learner_cols.split(",")
+        self.learners = {}; self.statements = []
+
+    def _row(self, phone):
+        r = self.learners.get(phone)
+        return tuple(r.get(c) for c in self.cols) if r else None
+
+    async def fetchone(self, sql, params=None):
+        self.statements.append(sql)
+        if sql.startswith("SELECT") and "FROM learners WHERE phone" in sql: return self._row(params[0])
+        m = re.match(r"INSERT INTO learners\(([^)]*)\)", sql)
+        if m:
+            r = self.learners.setdefault(params[0], {"lang": "en"})
+            r.update(zip(m.group(1).split(","), params)); return self._row(params[0])
+        return None
+
+    async def fetchall(self, sql, params=None):
+        self.statements.append(sql); return []
+
+    async def execute(self, sql, params=None):
+        self.statements.append(sql)
+
+
+@pytest.fixture
+def service(monkeypatch):
+    import app
+    db = FakeDB(app.LEARNER_COLS)
+    monkeypatch.setattr(app, "db_fetchone", db.fetchone)
+    monkeypatch.setattr(app, "db_fetchall", db.fetchall)
+    monkeypatch.setattr(app, "db_execute", db.execute)
+    monkeypatch.setattr(app, "student_cache", app.StudentCache(1000, 60))
+    monkeypatch.setattr(app, "inbound_guard", app.InboundGuard(
+        app.INBOUND_DEDUPE_WINDOW, app.INBOUND_RATE, app.INBOUND_BURST, 1000))
+    sent, jobs = [], []
+    real_send_reply = app.send_reply
+    async def send_reply(phone, message, lang="en"): sent.append((phone, message))
+    async def enqueue_job(kind, **payload): jobs.append((kind, payload))
+    monkeypatch.setattr(app, "send_reply", send_reply)
+    monkeypatch.setattr(app, "enqueue_job", enqueue_job)
+    app.ussd_sessions.clear(); app.ussd_pages.clear()
+    return SimpleNamespace(app=app, db=db, sent=sent, jobs=jobs, real_send_reply=real_send_reply)
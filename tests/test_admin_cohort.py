@@ -0,0 +1,28 @@
+import asyncio
+import threading
+
+import psycopg
+
+ROWS = [("sms", "JSS", "Grade 9", "Term 1", 4, 4, 1, 1, 4), ("ussd", "JSS", "Grade 8", "Term 2", 1, 1, 4, 2, None)]
+
+
+class FakeConnection:
+    """A sync psycopg connection serving ROWS from its server-side cursor, noting the thread it ran on."""
+
+    threads = []
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): pass
+    def cursor(self, name=None): return self
+    def execute(self, sql, params=None): self.threads.append(threading.current_thread()); self.rows = list(ROWS)
+    def fetchmany(self, n): rows, self.rows = self.rows[:n], self.rows[n:]; return rows
+
+
+def test_cohort_report_is_built_off_the_event_loop(service, monkeypatch):
+    app = service.app
+    monkeypatch.setattr(app, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(psycopg, "connect", lambda url: FakeConnection())
+    report = asyncio.run(app.admin_cohort(group_by="grade", x_admin_token="secret"))
+    assert report["students"] == 2
+    assert report["groups"]["Grade 9"]["pathways"]["STEM"] == 1
+    assert FakeConnection.threads and FakeConnection.threads[-1] is not threading.main_thread()
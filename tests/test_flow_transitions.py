@@ -0,0 +1,127 @@
+"""Transition tests for the flow engine, generated from the FLOW table itself.
+
+Every table-driven state is stepped with each of its options and with bad
+input, on both channels. The handler states (TECH outcome, RAG topics, RESULT,
+career pickers, DONE) are checked against the table of expectations below.
+"""
+import pytest
+
+import app
+
+CHANNELS = ("sms", "ussd")
+BAD_INPUTS = ("x", "99", "", "MORE")
+FIELDS = {"lang": "sw", "level": "Senior", "grade": "Grade 10", "pathway": "STEM"}
+
+TABLE = [s for s, rule in app.FLOW.items() if isinstance(rule, dict)]
+HANDLERS = [s for s, rule in app.FLOW.items() if callable(rule)]
+
+
+def resolve(rule, value, channel):
+    nxt = rule["next"]
+    if isinstance(nxt, dict) and value in nxt: nxt = nxt[value]
+    return app._per(nxt, channel)
+
+
+@pytest.mark.parametrize("channel", CHANNELS)
+@pytest.mark.parametrize("state", TABLE)
+def test_each_option_sets_its_field_and_moves_on(state, channel):
+    rule = app.FLOW[state]
+    for step, value in rule["options"].items():
+        f = dict(FIELDS)
+        nxt, screen, effects, final = app.flow_step(channel, state, step, f)
+        assert f[rule["field"]] == value
+        expected = resolve(rule, value, channel)
+        if callable(expected):               # outcome handlers are covered in EXPECTED below
+            assert nxt in ("DONE", "RESULT"); continue
+        assert (nxt, screen, effects, final) == (expected, app.flow_render(channel, expected, f), [], False)
+
+
+@pytest.mark.parametrize("channel", CHANNELS)
+@pytest.mark.parametrize("state", TABLE)
+def test_bad_input_repeats_the_state_with_its_error(state, channel):
+    rule = app.FLOW[state]
+    for step in BAD_INPUTS:
+        f = dict(FIELDS)
+        lang = rule.get("error_lang") or app._lang(f)
+        assert app.flow_step(channel, state, step, f) == (state, app.t(lang, app._per(rule["error"], channel)), [], False)
+        assert f == FIELDS
+
+
+GRADE9 = {"lang": "en", "grade": "Grade 9", "math": 4, "science": 4, "social": 1, "creative": 1, "technical": 4}
+GRADE7 = {**GRADE9, "grade": "Grade 7", "term": "Term 1"}
+SENIOR = {"lang": "en", "pathway": "STEM", "grade": "Grade 10"}
+
+# (channel, state, fields, input) -> (next state, effect kinds, final)
+EXPECTED = [
+    ("sms",  "TECH", GRADE9, "1", ("DONE", [], False)),
+    ("ussd", "TECH", GRADE9, "1", ("RESULT", [], False)),
+    ("sms",  "TECH", GRADE7, "1", ("DONE", ["jss_suggestions"], False)),
+    ("ussd", "TECH", GRADE7, "1", ("DONE", ["jss_suggestions"], False)),
+    ("ussd", "USSD_RAG_TOPIC", SENIOR, "1", ("DONE", ["rag_answer"], True)),
+    ("ussd", "USSD_RAG_TOPIC", SENIOR, "5", ("DONE", ["rag_answer"], True)),
+    ("ussd", "USSD_RAG_TOPIC", SENIOR, "6", ("DONE", [], True)),
+    ("ussd", "USSD_RAG_TOPIC", SENIOR, "9", ("USSD_RAG_TOPIC", [], False)),
+    ("ussd", "RESULT", GRADE9, "1", ("USSD_CAREER_SELECT", [], False)),
+    ("ussd", "RESULT", GRADE9, "2", ("USSD_CAREER_SELECT_ALL", [], False)),
+    ("ussd", "RESULT", GRADE9, "3", ("LANG", [], False)),
+    ("ussd", "RESULT", GRADE9, "4", ("RESULT", [], True)),
+    ("sms",  "CAREER_SELECT", SENIOR, "1", ("DONE", ["career_detail"], False)),
+    ("sms",  "CAREER_SELECT", SENIOR, "5", ("DONE", ["career_detail"], False)),
+    ("sms",  "CAREER_SELECT", SENIOR, "6", ("CAREER_SELECT", [], False)),
+    ("sms",  "CAREER_SELECT", SENIOR, "more", ("CAREER_SELECT_ALL", [], False)),
+    ("sms",  "CAREER_SELECT", {"lang": "en"}, "1", ("CAREER_SELECT", [], False)),
+    ("sms",  "CAREER_SELECT_ALL", SENIOR, "10", ("DONE", ["career_detail"], False)),
+    ("sms",  "CAREER_SELECT_ALL", SENIOR, "11", ("CAREER_SELECT_ALL", [], False)),
+    ("ussd", "USSD_CAREER_SELECT", SENIOR, "6", ("DONE", ["career_detail"], True)),
+    ("ussd", "USSD_CAREER_SELECT", SENIOR, "7", ("USSD_CAREER_SELECT_ALL", [], False)),
+    ("ussd", "USSD_CAREER_SELECT", SENIOR, "8", ("USSD_CAREER_SELECT", [], False)),
+    ("ussd", "USSD_CAREER_SELECT_ALL", SENIOR, "10", ("DONE", ["career_detail"], True)),
+    ("ussd", "USSD_CAREER_SELECT_ALL", SENIOR, "7", ("DONE", ["career_detail"], True)),
+    ("sms",  "DONE", SENIOR, "1", ("DONE", [], False)),
+    ("ussd", "DONE", SENIOR, "1", ("LANG", [], False)),
+    ("ussd", "DONE", SENIOR, "2", ("DONE", [], True)),
+]
+
+
+@pytest.mark.parametrize("channel,state,fields,step,expected", EXPECTED,
+                         ids=[f"{c}-{s}-{i!r}" for c, s, _, i, _ in EXPECTED])
+def test_handler_states(channel, state, fields, step, expected):
+    f = dict(fields)
+    nxt, screen, effects, final = app.flow_step(channel, state, step, f)
+    assert (nxt, [kind for kind, _ in effects], final) == expected
+    assert screen or effects
+
+
+def test_every_state_is_covered_and_reachable():
+    outcomes = {s for s in TABLE if any(callable(resolve(app.FLOW[s], v, c))
+                                        for v in app.FLOW[s]["options"].values() for c in CHANNELS)}
+    assert {s for _, s, _, _, _ in EXPECTED} == set(HANDLERS) | outcomes
+    only = {"sms": ("CAREER_SELECT", "CAREER_SELECT_ALL"), "ussd": ("USSD_RAG_TOPIC", "RESULT",
+                                                                     "USSD_CAREER_SELECT", "USSD_CAREER_SELECT_ALL")}
+    for channel in CHANNELS:
+        seen, todo = set(), [("LANG", {})]
+        while todo:
+            state, fields = todo.pop()
+            for step in [str(n) for n in range(1, 11)] + ["MORE"]:
+                f = dict(fields)
+                result = app.flow_step(channel, state, step, f)    # None: not a FLOW state (SMS RAG_CHAT)
+                node = result and (result[0], f.get("grade"), bool(f.get("pathway")))   # what routing depends on
+                if node and node not in seen: seen.add(node); todo.append((result[0], f))
+        other = only["ussd" if channel == "sms" else "sms"]
+        assert {node[0] for node in seen} & set(app.FLOW) == set(app.FLOW) - set(other), channel
+
+
+# Whole journeys, as a learner would type them on USSD: path -> (state, final screen kind, jobs).
+JOURNEYS = {
+    "1*1*1*3*1*1*1*3*2*1":   ("RESULT", "CON", []),                       # Grade 9 assessment
+    "1*1*1*1*2*1*2*3*4*4":   ("DONE", "CON", ["jss_suggestions"]),        # Grade 7 tracking
+    "1*1*2*1*1*7*9":         ("DONE", "END", ["career_detail"]),          # Senior, all careers
+    "2*2*3":                 ("DONE", "END", ["rag_answer"]),             # Swahili, assistant topic
+    "1*1*1*3*1*1*1*3*2*1*3": ("LANG", "CON", []),                         # start again
+}
+
+
+@pytest.mark.parametrize("path", JOURNEYS)
+def test_ussd_journeys(path):
+    state, _, reply, effects = app.ussd_replay(app.ussd_steps(path))
+    assert (state, reply[:3], [kind for kind, _ in effects]) == JOURNEYS[path]
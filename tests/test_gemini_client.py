@@ -0,0 +1,23 @@
+import asyncio
+
+from loadtest import StubGemini
+
+CALLS = 5
+
+
+def test_gemini_calls_share_one_connection(service, monkeypatch):
+    app = service.app
+    stub = StubGemini(0, 0)
+    monkeypatch.setattr(app, "GEMINI_KEY", "stub")
+    monkeypatch.setattr(app, "gemini_client", None)
+
+    async def go():
+        port = await stub.start()
+        monkeypatch.setattr(app, "GEMINI_URL", f"http://127.0.0.1:{port}/v1beta/models/stub:generateContent")
+        app.gemini_client = app.new_gemini_client()
+        try: return [await app.gemini_post({"contents": []}, "test") for _ in range(CALLS)]
+        finally: await app.gemini_client.aclose(); await stub.stop()
+
+    responses = asyncio.run(go())
+    assert [r.status_code for r in responses] == [200] * CALLS
+    assert stub.calls == CALLS and stub.connections == 1
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from loadtest import StubGemini
+
+PHONE = "+254700000002"
+
+
+@pytest.fixture
+def gemini(service, monkeypatch):
+    app = service.app
+    monkeypatch.setattr(app, "GEMINI_KEY", "stub")
+    monkeypatch.setattr(app, "GEMINI_STREAM", True)
+    monkeypatch.setattr(app, "llm_cache", app.LLMCache(100, 3600))
+    monkeypatch.setattr(app, "gemini_client", None)
+    monkeypatch.setattr(app, "GEMINI_STREAM_URL", "")
+    saved = []
+    async def save_turn(*args): saved.append(args)
+    monkeypatch.setattr(app, "save_turn", save_turn)
+    service.saved = saved
+    return service
+
+
+def run_rag(service, stub, **kwargs):
+    app = service.app
+    async def go():
+        port = await stub.start()
+        app.GEMINI_STREAM_URL = f"http://127.0.0.1:{port}/v1beta/models/stub:streamGenerateContent"
+        app.gemini_client = app.new_gemini_client()
+        try: await app.reply_gemini_rag(PHONE, "What is CBE?", "en", **kwargs)
+        finally: await app.gemini_client.aclose(); await stub.stop()
+    asyncio.run(go())
+
+
+def test_complete_stream_is_sent_cached_and_saved(gemini):
+    run_rag(gemini, StubGemini(0, 0, chunks=4), history_turns=0)
+    sent = " ".join(m for _, m in gemini.sent)
+    assert StubGemini.ANSWER.split(". ")[0] in sent
+    assert gemini.app.llm_cache.stats()["size"] == 1
+    assert len(gemini.saved) == 1
+
+
+def test_stream_cut_off_is_not_cached_or_saved(gemini):
+    run_rag(gemini, StubGemini(0, 0, chunks=4, cut_after=2), history_turns=0)
+    assert gemini.sent[-1][1].endswith(gemini.app.t("en", "error"))
+    assert gemini.app.llm_cache.stats()["size"] == 0
+    assert gemini.saved == []
+
+
+def test_stream_is_retried_on_429(gemini):
+    stub = StubGemini(0, 0, chunks=4, fail_first=2)
+    run_rag(gemini, stub, history_turns=0)
+    assert stub.calls == 3
+    assert StubGemini.ANSWER.split(". ")[0] in " ".join(m for _, m in gemini.sent)
+    assert len(gemini.saved) == 1
@@ -0,0 +1,24 @@
+import asyncio
+
+import pytest
+
+PHONE = "+254700000001"
+ROWS = [(i, "user" if i % 2 else "assistant", f"message {i}") for i in range(1, 15)]   # 7 exchanges
+
+
+@pytest.mark.parametrize("keep,upto", [(3, 8), (0, 14), (7, None), (10, None)])
+def test_newest_exchanges_stay_raw(service, monkeypatch, keep, upto):
+    app = service.app
+    folded = []
+    async def fetchall(sql, params=None): return ROWS
+    async def gemini_call(prompt, *a): folded.append(prompt); return "summary"
+    async def execute(sql, params=None): folded.append(params)
+    monkeypatch.setattr(app, "HISTORY_KEEP_RAW", keep)
+    monkeypatch.setattr(app, "db_fetchall", fetchall)
+    monkeypatch.setattr(app, "db_execute", execute)
+    monkeypatch.setattr(app, "gemini_call", gemini_call)
+    asyncio.run(app._summarise_history(PHONE))
+    if upto is None: assert not folded; return
+    prompt, params = folded
+    assert params == (PHONE, "summary", upto)
+    assert f"message {upto}\n" in prompt and f"message {upto + 1}\n" not in prompt
@@ -0,0 +1,87 @@
+import asyncio
+
+from loadtest import JOURNEYS
+
+PHONE = "+254700000001"
+
+
+def sms(service, text, msg_id=""):
+    return asyncio.run(service.app.receive_sms(from_=PHONE, text=text, msg_id=msg_id))
+
+
+def test_same_digit_at_successive_steps_is_an_answer(service):
+    _, steps = JOURNEYS["sms_jss"]                # "1" and "2" each answer several questions in a row
+    for _, reply in steps: sms(service, reply)
+    assert not any(service.app.inbound_guard.shed.values())
+    assert service.db.learners[PHONE]["technical"] is not None
+
+
+def test_gateway_retry_is_dropped(service):
+    sms(service, "START", "m1"); sms(service, "1", "m2")
+    replies = len(service.sent)
+    sms(service, "1", "m2")
+    assert len(service.sent) == replies
+    assert service.app.inbound_guard.shed["sms_duplicate"] == 1
+
+
+def test_same_text_at_same_step_without_id_is_dropped(service):
+    sms(service, "START"); sms(service, "9"); sms(service, "9")       # invalid LANG reply, sent twice
+    assert service.app.inbound_guard.shed["sms_duplicate"] == 1
+
+
+def test_flood_is_answered_once_then_dropped(service):
+    burst = service.app.inbound_guard.burst
+    for i in range(burst + 5): sms(service, f"question {i}", f"m{i}")
+    slow = [m for _, m in service.sent if m == service.app.t("en", "slow_down")]
+    assert len(slow) == 1
+    assert service.app.inbound_guard.shed["sms_rate_limited"] == 5
+
+
+def test_failed_sms_turn_releases_its_key(service, monkeypatch):
+    sms(service, "START", "m1")
+    save = service.app.save_student
+    async def down(*a, **k): raise ConnectionError("db down")
+    monkeypatch.setattr(service.app, "save_student", down)
+    sms(service, "1", "m2")
+    assert service.sent[-1][1] == service.app.t("en", "error") + "\n\n" + service.app.t("en", "welcome_lang")
+    monkeypatch.setattr(service.app, "save_student", save)
+    sms(service, "1", "m2")                                   # the gateway's retry
+    assert service.db.learners[PHONE]["sms_state"] == "MODE_SELECT"
+
+
+def test_turn_failing_after_its_save_reprompts_the_next_question(service, monkeypatch):
+    app = service.app
+    sms(service, "START", "m1")
+    send = app.send_reply
+    async def refused(phone, message, lang="en"):
+        monkeypatch.setattr(app, "send_reply", send); raise app.SMSSendError("refused")
+    monkeypatch.setattr(app, "send_reply", refused)           # the prompt after LANG was saved fails
+    sms(service, "1", "m2")
+    assert service.db.learners[PHONE]["sms_state"] == "MODE_SELECT"
+    assert service.sent[-1][1] == app.t("en", "error") + "\n\n" + app.t("en", "mode_select")
+    sms(service, "1", "m2")                                   # a resend must not answer MODE_SELECT with it
+    assert app.inbound_guard.shed["sms_duplicate"] == 1
+    assert service.db.learners[PHONE]["sms_state"] == "MODE_SELECT"
+
+
+def test_dropped_flood_does_not_read_the_learner(service, monkeypatch):
+    app = service.app
+    for i in range(app.inbound_guard.burst + 1): sms(service, f"question {i}", f"m{i}")
+    async def read(*a): raise AssertionError("learner read for a dropped message")
+    monkeypatch.setattr(app, "get_student", read)
+    sms(service, "again", "m-last")
+    assert app.inbound_guard.shed["sms_rate_limited"] == 2
+
+
+def test_failed_ussd_turn_runs_its_jobs_on_retry(service, monkeypatch):
+    ussd = lambda text: asyncio.run(service.app.ussd_callback(
+        sessionId="s1", serviceCode="*384*1#", phoneNumber=PHONE, text=text))
+    path = "1*2*1"                                            # English, CBE assistant, first topic
+    ussd(""); ussd("1"); ussd("1*2")
+    enqueue = service.app.enqueue_job
+    async def down(kind, **payload): raise ConnectionError("db down")
+    monkeypatch.setattr(service.app, "enqueue_job", down)
+    assert ussd(path).startswith("END")
+    monkeypatch.setattr(service.app, "enqueue_job", enqueue)
+    ussd(path)
+    assert service.jobs and service.jobs[-1][0] == "rag_answer"
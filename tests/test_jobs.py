@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+import pytest
+
+PHONE = "+254700000003"
+
+
+class DownGateway:
+    def send(self, message, recipients, sender_id=None): raise ConnectionError("gateway unreachable")
+
+
+@pytest.fixture
+def gateway_down(service, monkeypatch):
+    app = service.app
+    monkeypatch.setattr(app, "send_reply", service.real_send_reply)
+    monkeypatch.setattr(app, "sms_dispatcher", app.SMSDispatcher(DownGateway(), 0, 100, app.TokenBucket(100, 100)))
+    return service
+
+
+def test_send_reply_raises_when_the_gateway_fails(gateway_down):
+    with pytest.raises(gateway_down.app.SMSSendError):
+        asyncio.run(gateway_down.app.send_reply(PHONE, "hello"))
+
+
+CAREER_JOB = {"phone": PHONE, "pathway": "STEM", "career_idx": 0, "lang": "en", "grade": "Grade 10"}
+LONG = " ".join(f"Sentence {i} about the STEM pathway." for i in range(40))      # several parts
+
+
+class FlakyGateway(DownGateway):
+    """Accepts the first `accept` sends, then refuses."""
+
+    def __init__(self, app, accept):
+        self.ok = app.FakeSMSGateway(); self.accept = accept
+
+    def send(self, message, recipients, sender_id=None):
+        if len(self.ok.sent) >= self.accept: return super().send(message, recipients, sender_id)
+        return self.ok.send(message, recipients, sender_id)
+
+
+def run_job(service, monkeypatch, kind, payload):
+    """Run one job through a worker; returns the (sql, params) it wrote."""
+    app, db = service.app, service.db
+    writes = []
+    async def claim(sql, params=None):
+        db.statements.append(sql)
+        return (1,) if sql.lstrip().startswith("UPDATE jobs SET status='running'") else None
+    async def execute(sql, params=None): writes.append((sql, params))
+    monkeypatch.setattr(app, "db_fetchone", claim)
+    monkeypatch.setattr(app, "db_execute", execute)
+    async def go():
+        monkeypatch.setattr(app, "job_queue", asyncio.Queue())
+        app._offer_job(1, kind, dict(payload))
+        worker = asyncio.create_task(app._job_worker())
+        await app.job_queue.join(); worker.cancel()
+    asyncio.run(go())
+    return writes
+
+
+def test_job_hands_its_texts_to_a_send_sms_job(gateway_down, monkeypatch):
+    app = gateway_down.app
+    done = app.job_metrics["done"]
+    writes = run_job(gateway_down, monkeypatch, "career_detail", CAREER_JOB)
+    assert app.job_metrics["done"] == done + 1          # generating never waits on the gateway
+    assert [k for k, _ in gateway_down.jobs] == ["send_sms"]
+    messages = gateway_down.jobs[0][1]["messages"]
+    assert messages[0] == app.get_career_detail_sms("STEM", 0, "en") and len(messages) == 2
+    assert any(sql.startswith("DELETE FROM jobs") for sql, _ in writes)
+
+
+def test_send_sms_job_whose_send_fails_is_retried(gateway_down, monkeypatch):
+    app = gateway_down.app
+    with pytest.raises(app.SMSSendError):
+        asyncio.run(app.JOB_HANDLERS["send_sms"](PHONE, ["hello"], "en"))
+    retried = app.job_metrics["retried"]
+    writes = run_job(gateway_down, monkeypatch, "send_sms", {"phone": PHONE, "messages": ["hello"], "lang": "en"})
+    assert app.job_metrics["retried"] == retried + 1
+    assert any("status='queued'" in sql for sql, _ in writes)
+    assert not any(sql.startswith("DELETE FROM jobs") for sql, _ in writes)
+
+
+def test_send_sms_retry_resumes_after_the_delivered_parts(gateway_down, monkeypatch):
+    app = gateway_down.app
+    parts = app.sms_parts(LONG, "en")
+    assert len(parts) >= 3
+    flaky = FlakyGateway(app, 2)
+    monkeypatch.setattr(app.sms_dispatcher, "gateway", flaky)
+    job = {"phone": PHONE, "messages": ["first", LONG], "lang": "en"}
+    writes = run_job(gateway_down, monkeypatch, "send_sms", job)
+    progress = [json.loads(params[0]) for sql, params in writes if "payload || " in sql]
+    assert progress == [{"sent": 1}, {"sent": 2}]
+    retry = app.FakeSMSGateway()
+    monkeypatch.setattr(app.sms_dispatcher, "gateway", retry)
+    run_job(gateway_down, monkeypatch, "send_sms", {**job, **progress[-1]})
+    assert [m for m, _ in flaky.ok.sent + retry.sent] == ["first"] + parts
+
+
+def test_refused_stream_part_is_queued_not_resent(gateway_down, monkeypatch):
+    app = gateway_down.app
+    flaky = FlakyGateway(app, 1)
+    monkeypatch.setattr(app.sms_dispatcher, "gateway", flaky)
+    async def go():
+        out = app.SMSStreamer(PHONE, "en")
+        await out.feed(LONG); await out.close()
+    asyncio.run(go())
+    (kind, payload), = gateway_down.jobs
+    assert kind == "send_sms"
+    assert flaky.ok.sent[0][0] + " " + " ".join(payload["messages"]) == LONG
+
+
+def test_sms_turn_survives_a_gateway_outage(gateway_down):
+    assert asyncio.run(gateway_down.app.receive_sms(from_=PHONE, text="START", msg_id="m1")) == ""
@@ -0,0 +1,13 @@
+import asyncio
+
+PHONE = "+254700000004"
+
+
+def test_metrics_exports_request_and_stage_histograms(service):
+    app = service.app
+    asyncio.run(app.receive_sms(from_=PHONE, text="START", msg_id="m1"))
+    asyncio.run(app.receive_sms(from_=PHONE, text="1", msg_id="m2"))
+    text = asyncio.run(app.metrics())
+    assert 'edutena_request_seconds_count{channel="sms",state="START"}' in text
+    assert 'edutena_stage_seconds_bucket{stage="render",channel="sms",state="LANG",le="+Inf"}' in text
+    assert "edutena_instrumentation_overhead_seconds" in text
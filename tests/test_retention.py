@@ -0,0 +1,46 @@
+import asyncio
+import contextlib
+
+PHONES = [f"+2547{i:08d}" for i in range(3)]
+
+
+class FakeConnection:
+    """Records statements and commits; a DELETE matching a `backlog` key removes its rows a batch at a time."""
+
+    def __init__(self, backlog):
+        self.backlog = dict(backlog); self.log = []
+
+    def cursor(self): return self
+
+    async def execute(self, sql, params=None):
+        sql = " ".join(sql.split()); self.log.append(sql); self.rows = []; self.rowcount = 0
+        if "advisory" in sql: self.rows = [(True,)]
+        elif "HAVING" in sql: self.rows = [(p,) for p in PHONES]
+        elif sql.startswith("DELETE"):
+            match = next(k for k in self.backlog if k in sql)
+            self.rowcount = min(params[-1], self.backlog[match]); self.backlog[match] -= self.rowcount
+        return self
+
+    async def fetchone(self): return self.rows[0] if self.rows else None
+    async def fetchall(self): return self.rows
+    async def commit(self): self.log.append("COMMIT")
+    async def rollback(self): self.log.append("ROLLBACK")
+
+
+def test_compaction_deletes_in_committed_batches(service, monkeypatch):
+    app = service.app
+    conn = FakeConnection({"days =>": 12, "unnest": 7, "llm_cache": 0})
+    monkeypatch.setattr(app, "CHAT_RETENTION_BATCH", 5)
+    monkeypatch.setattr(app.db_pool, "connection", contextlib.asynccontextmanager(lambda: _yield(conn)))
+    result = asyncio.run(app.compact_chat_history())
+    assert result == {"partitions_dropped": 0, "expired": 12, "trimmed": 7, "llm_cache_expired": 0}
+    deletes = [i for i, s in enumerate(conn.log) if s.startswith("DELETE")]
+    assert len(deletes) == 3 + 2 + 1               # 5+5+2 expired, 5+2 trimmed, an empty llm_cache batch
+    assert all(conn.log[i + 1] == "COMMIT" for i in deletes)
+    assert all(s.endswith("LIMIT %s)") for s in conn.log if s.startswith("DELETE"))
+    assert not any("row_number" in s for s in conn.log)
+    assert conn.log[-1].startswith("SELECT pg_advisory_unlock")
+
+
+async def _yield(conn):
+    yield conn
@@ -0,0 +1,27 @@
+import asyncio
+import time
+
+SLOW = 1.0      # seconds the gateway takes to accept one send
+
+
+def test_slow_gateway_does_not_hold_up_ussd(service, monkeypatch):
+    app = service.app
+    gateway = app.FakeSMSGateway(latency=SLOW)
+    monkeypatch.setattr(app, "send_reply", service.real_send_reply)
+    monkeypatch.setattr(app, "sms_dispatcher", app.SMSDispatcher(gateway, 0, 100, app.TokenBucket(100, 100)))
+
+    async def go():
+        sms = asyncio.create_task(app.receive_sms(from_="+254700000004", text="START", msg_id="m1"))
+        await asyncio.sleep(0.05)                       # the send is now blocking a worker thread
+        started = time.perf_counter()
+        for text in ("", "1", "1*1", "1*1*1"):
+            screen = await app.ussd_callback(sessionId="s1", serviceCode="*384#",
+                                             phoneNumber="+254700000005", text=text)
+            assert screen.startswith("CON")
+        took = time.perf_counter() - started
+        assert not sms.done() and not gateway.sent
+        await sms
+        return took
+
+    assert asyncio.run(go()) < SLOW / 4
+    assert gateway.sent == [(app.t("en", "welcome_lang"), ["+254700000004"])]
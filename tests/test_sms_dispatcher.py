@@ -0,0 +1,30 @@
+import asyncio
+import time
+
+WINDOW = 0.5
+
+
+def dispatcher(app):
+    gateway = app.FakeSMSGateway()
+    return gateway, app.SMSDispatcher(gateway, WINDOW, 100, app.TokenBucket(100, 100))
+
+
+def test_one_off_bodies_skip_the_window(service):
+    gateway, d = dispatcher(service.app)
+    async def go():
+        started = time.perf_counter()
+        for part in ("(1/3) first", "(2/3) second", "(3/3) third"):
+            assert (await d.send("+254700000006", part))["status"] == "Success"
+        return time.perf_counter() - started
+    assert asyncio.run(go()) < WINDOW
+    assert len(gateway.sent) == 3
+
+
+def test_repeated_body_is_coalesced(service):
+    gateway, d = dispatcher(service.app)
+    async def go():
+        await d.send("+254700000007", "Thank you!")
+        return await asyncio.gather(*(d.send(f"+25470000001{i}", "Thank you!") for i in range(5)))
+    assert all(r["status"] == "Success" for r in asyncio.run(go()))
+    assert gateway.sent[1:] == [("Thank you!", [f"+25470000001{i}" for i in range(5)])]
+    assert d.stats["api_calls"] == 2
@@ -0,0 +1,76 @@
+import pytest
+
+import app
+import smstext
+
+
+@pytest.mark.parametrize("text,enc", [
+    ("Habari! Your results are ready.", "GSM-7"),
+    ("Café à 5€ {ok}", "GSM-7"),                 # accents in the basic set, € and {} in the extension
+    ("Nĩ wega", "UCS-2"),                         # Gĩkũyũ ĩ
+    ("Mũrũthi", "UCS-2"),
+    ("Well done 🎉", "UCS-2"),
+    ("━━━━", "UCS-2"),
+])
+def test_encoding(text, enc):
+    assert smstext.encoding(text) == enc
+
+
+def test_extension_characters_count_twice():
+    assert smstext.units("abc") == 3
+    assert smstext.units("a€b") == 4
+    assert smstext.units("^{}\\[~]|€") == 18
+    assert smstext.units("🎉") == 2                # surrogate pair in UCS-2
+    assert smstext.units("ĩ") == 1
+
+
+@pytest.mark.parametrize("text,n", [
+    ("a" * 160, 1), ("a" * 161, 2), ("a" * 306, 2), ("a" * 307, 3),
+    ("a" * 159 + "€", 2),                         # 161 septets
+    ("ĩ" * 70, 1), ("ĩ" * 71, 2), ("ĩ" * 134, 2), ("ĩ" * 135, 3),
+    ("a" * 69 + "🎉", 2),                         # 71 UTF-16 units
+])
+def test_segment_boundaries(text, n):
+    assert smstext.segments(text) == n
+
+
+def test_text_that_fits_is_not_numbered():
+    assert smstext.split("  Short reply.  ") == ["Short reply."]
+    assert smstext.split("a" * 160) == ["a" * 160]
+
+
+def sentences(n):
+    return " ".join(f"Sentence {k:02d} is about careers in the STEM pathway." for k in range(n))
+
+
+@pytest.mark.parametrize("count", [2, 9, 10, 12])
+def test_split_numbers_parts_and_each_fits_a_segment(count):
+    parts = smstext.split(sentences(3 * count - 1))
+    assert [p.split(" ", 1)[0] for p in parts] == [f"{k}/{len(parts)}" for k in range(1, len(parts) + 1)]
+    assert all(smstext.segments(p) == 1 for p in parts)
+    assert " ".join(p.split(" ", 1)[1] for p in parts) == sentences(3 * count - 1)
+
+
+def test_split_recuts_when_the_prefix_grows_a_digit():
+    # Ten 155-char words fit one per part under a "9/9 " prefix, but
+    # "10/10 " + 155 is 161 septets: the text must be cut again.
+    text = " ".join([c * 155 for c in "abcdefghij"])
+    parts = smstext.split(text)
+    assert len(parts) > 10 and all(p.startswith(f"{k}/{len(parts)} ") for k, p in enumerate(parts, 1))
+    assert all(smstext.units(p) <= 160 for p in parts)
+    assert "".join(p.split(" ", 1)[1] for p in parts) == text.replace(" ", "")
+
+
+def test_transliterate_maps_to_gsm7():
+    out = smstext.transliterate("Nĩ wega — “great” ✅ 🎉\n━━━━━━━━")
+    assert smstext.encoding(out) == "GSM-7"
+    assert out.startswith('Ni wega - "great" OK')
+
+
+def test_transliteration_is_opt_in(monkeypatch):
+    text = "Nĩ wega 🎉"
+    monkeypatch.setattr(app, "SMS_GSM7_LANGS", set())
+    assert app.sms_parts(text, "ki") == [text]
+    monkeypatch.setattr(app, "SMS_GSM7_LANGS", {"ki"})
+    assert app.sms_parts(text, "ki") == ["Ni wega"]
+    assert app.sms_parts(text, "en") == [text]
@@ -0,0 +1,76 @@
+"""Every USSD screen, in every language, fits USSD_SCREEN_MAX bytes on every page."""
+import asyncio
+
+import app
+
+CAREER = "1*1*2*1*1*1"          # English, assessment, Senior, Grade 10, STEM, first career: a paged END
+
+
+def screens():
+    """Every distinct USSD reply reachable from the language menu, walked depth-first."""
+    out = {app.ussd_lang_screen()}
+    todo, seen = [("LANG", {})], set()
+    while todo:
+        state, fields = todo.pop()
+        for step in map(str, range(1, 10)):
+            f = dict(fields)
+            state2, screen, _, final = app.flow_step("ussd", state, step, f) or app._flow_reset("ussd", f)
+            out.add(app.end(screen) if final else app.con(screen))
+            node = (state2, tuple(sorted(f.items())))
+            if not final and node not in seen:
+                seen.add(node); todo.append((state2, f))
+    return out
+
+
+def all_pages(reply):
+    pages = app.paginate_ussd(reply[4:])
+    return [app._ussd_page(reply[:3], pages, i) for i in range(len(pages))]
+
+
+def test_every_screen_fits_on_every_page():
+    replies = screens()
+    for lang in app.UI:
+        assert any(app.t(lang, "thank_you") in r for r in replies), lang
+    too_long = [(page, app.ussd_bytes(page)) for reply in replies for page in all_pages(reply)
+                if app.ussd_bytes(page) > app.USSD_SCREEN_MAX]
+    assert not too_long, f"{len(too_long)} pages over {app.USSD_SCREEN_MAX} bytes, first: {too_long[0]}"
+
+
+def test_page_boundary_is_in_bytes():
+    room = app.USSD_SCREEN_MAX - 4
+    assert app.paginate_ussd("a" * room) == ["a" * room]
+    assert len(app.paginate_ussd("a" * (room + 1))) == 2
+    assert len(app.paginate_ussd("━" * (room // 3 + 1))) == 2          # fits in characters, not in bytes
+    pages = app.paginate_ussd("━" * 200)
+    assert "".join(pages) == "━" * 200                                  # never cut inside a character
+    assert all(app.ussd_bytes(app._ussd_page("CON", pages, i)) <= app.USSD_SCREEN_MAX for i in range(len(pages)))
+
+
+def test_next_and_back_walk_the_pages():
+    reply = app.ussd_replay(app.ussd_steps(CAREER))[2]
+    pages = app.paginate_ussd(reply[4:])
+    sid, text = "nav", CAREER
+    assert app.ussd_render(sid, text, reply) == app._ussd_page("END", pages, 0)
+    for i in list(range(1, len(pages))) + [len(pages) - 1]:          # Next past the end stays on the last page
+        text += "*0"
+        assert app.ussd_turn_page(sid, text) == app._ussd_page("END", pages, i)
+    assert app.ussd_turn_page(sid, text).startswith("END")
+    text += "*00"
+    assert app.ussd_turn_page(sid, text) == app._ussd_page("END", pages, len(pages) - 2)
+    assert app.ussd_turn_page(sid, text + "*1") is None                # an answer is not paging
+    app.ussd_pages.clear()
+
+
+def test_paging_without_page_state_only_rerenders(service):
+    ussd = lambda text: asyncio.run(service.app.ussd_callback(
+        sessionId="lost", serviceCode="*384#", phoneNumber="+254700000008", text=text))
+    first = ussd(CAREER)
+    assert [k for k, _ in service.jobs] == ["career_detail"]
+    writes = len(service.db.statements)
+    app.ussd_pages.clear(); app.ussd_sessions.clear()                  # e.g. the next post lands on another worker
+    pages = all_pages(app.ussd_replay(app.ussd_steps(CAREER))[2])
+    assert first == pages[0]
+    assert ussd(CAREER + "*0*0") == pages[2]
+    assert ussd(CAREER + "*0*0*00") == pages[1]
+    assert [k for k, _ in service.jobs] == ["career_detail"]
+    assert len(service.db.statements) == writes